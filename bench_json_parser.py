@@ -0,0 +1,200 @@
+"""
+AI回复JSON解析基准
+
+从日志中提取 "DeepSeek原始回复" 作为语料，对比旧的清理+json.loads方案和 LLMJSONParser：
+吞吐量、解析成功数，以及标准JSON可解析时两者结果是否一致（检查静默篡改）；
+标准JSON解析不了的写法（单引号、未加引号的键、末尾逗号、多个对象、前后说明文字）
+用内置的人工标注样本核对解析结果
+
+用法: python bench_json_parser.py [日志文件 ...]   （默认 logs/*.log 和 nohup.out）
+"""
+import glob
+import json
+import os
+import re
+import sys
+import time
+
+os.makedirs('logs', exist_ok=True)
+from ds_bin_sol_mi_v8 import AIAnalyzer, LLMJSONParser
+
+MARKER = 'DeepSeek原始回复: '
+LOG_LINE = re.compile(r'^\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}')
+
+# 人工标注样本：(回复, 期望解析结果)，均为json.loads无法直接解析的写法
+LABELLED = [
+    (
+        "{'signal': 'BUY', 'reason': '突破阻力', 'stop_loss': 98.5, 'take_profit': 104, "
+        "'confidence': 'HIGH', 'risk_level': 'LOW'}",
+        {'signal': 'BUY', 'reason': '突破阻力', 'stop_loss': 98.5, 'take_profit': 104,
+         'confidence': 'HIGH', 'risk_level': 'LOW'}
+    ),
+    (
+        '{signal: "SELL", reason: "跌破支撑", stop_loss: 102, take_profit: 95.5, '
+        'confidence: "MEDIUM", risk_level: "HIGH",}',
+        {'signal': 'SELL', 'reason': '跌破支撑', 'stop_loss': 102, 'take_profit': 95.5,
+         'confidence': 'MEDIUM', 'risk_level': 'HIGH'}
+    ),
+    (
+        '分析如下：\n```json\n{\n  "signal": "HOLD",\n  "reason": "震荡整理",\n  "stop_loss": 97,\n'
+        '  "take_profit": 103,\n  "confidence": "LOW",\n  "risk_level": "MEDIUM",\n}\n```\n以上仅供参考',
+        {'signal': 'HOLD', 'reason': '震荡整理', 'stop_loss': 97, 'take_profit': 103,
+         'confidence': 'LOW', 'risk_level': 'MEDIUM'}
+    ),
+    (
+        '初步判断 {"signal": "BUY", "reason": "草稿"}，修正后: {"signal": "SELL", "reason": "量价背离", '
+        '"stop_loss": 101.2, "take_profit": 96, "confidence": "MEDIUM", "risk_level": "MEDIUM"}',
+        {'signal': 'SELL', 'reason': '量价背离', 'stop_loss': 101.2, 'take_profit': 96,
+         'confidence': 'MEDIUM', 'risk_level': 'MEDIUM'}
+    ),
+    (
+        '{"signal": "BUY", "reason": "It\'s 突破{阻力}", "stop_loss": 98, "take_profit": 104, '
+        '"confidence": "HIGH", "risk_level": "LOW"}',
+        {'signal': 'BUY', 'reason': "It's 突破{阻力}", 'stop_loss': 98, 'take_profit': 104,
+         'confidence': 'HIGH', 'risk_level': 'LOW'}
+    ),
+    (
+        "{signal: 'HOLD', reason: '时间: 15:00 前观望, 等待确认', stop_loss: 97.5, take_profit: 102.5, "
+        "confidence: 'LOW', risk_level: 'LOW'}",
+        {'signal': 'HOLD', 'reason': '时间: 15:00 前观望, 等待确认', 'stop_loss': 97.5, 'take_profit': 102.5,
+         'confidence': 'LOW', 'risk_level': 'LOW'}
+    ),
+]
+
+
+def load_corpus(paths):
+    """提取回复文本（回复可能跨多行，直到下一条日志记录为止）"""
+    corpus = []
+    for path in paths:
+        current = None
+        with open(path, encoding='utf-8', errors='ignore') as f:
+            for line in f:
+                if MARKER in line:
+                    if current is not None:
+                        corpus.append(''.join(current).rstrip('\n'))
+                    current = [line.split(MARKER, 1)[1]]
+                elif current is not None and not LOG_LINE.match(line):
+                    current.append(line)
+                elif current is not None:
+                    corpus.append(''.join(current).rstrip('\n'))
+                    current = None
+        if current is not None:
+            corpus.append(''.join(current).rstrip('\n'))
+    return corpus
+
+
+def legacy_clean(json_str):
+    """旧版 _clean_json_string（仅用于对比）"""
+    try:
+        json.loads(json_str)
+        return json_str
+    except json.JSONDecodeError:
+        pass
+
+    result = []
+    in_string = False
+    string_quote = None
+    for i, char in enumerate(json_str):
+        if char in ('"', "'"):
+            if i > 0 and json_str[i-1] == '\\':
+                result.append(char)
+            elif not in_string:
+                in_string = True
+                string_quote = char
+                result.append('"')
+            elif char == string_quote:
+                in_string = False
+                string_quote = None
+                result.append('"')
+            else:
+                result.append(char)
+        else:
+            result.append(char)
+
+    cleaned = ''.join(result)
+    cleaned = re.sub(r'(\s*)(\w+)(\s*):', r'\1"\2"\3:', cleaned)
+    cleaned = re.sub(r',(\s*[}\]])', r'\1', cleaned)
+    return cleaned
+
+
+def legacy_parse(response):
+    start_idx = response.find('{')
+    end_idx = response.rfind('}') + 1
+    if start_idx == -1 or end_idx == 0:
+        return None
+    try:
+        return json.loads(legacy_clean(response[start_idx:end_idx]))
+    except json.JSONDecodeError:
+        return None
+
+
+def new_parse(response):
+    return LLMJSONParser.parse(response, AIAnalyzer.REQUIRED_FIELDS)
+
+
+def strict_parse(response):
+    """标准JSON能直接解析的回复，作为一致性基准"""
+    start_idx = response.find('{')
+    end_idx = response.rfind('}') + 1
+    if start_idx == -1 or end_idx == 0:
+        return None
+    try:
+        return json.loads(response[start_idx:end_idx])
+    except json.JSONDecodeError:
+        return None
+
+
+def bench(name, parser, corpus, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        results = [parser(response) for response in corpus]
+    elapsed = time.perf_counter() - start
+    total = len(corpus) * rounds
+    ok = sum(1 for result in results if result is not None)
+    print(f"{name:<8} {total / elapsed:>10.0f} 条/秒  成功 {ok}/{len(corpus)}")
+    return results
+
+
+def check_labelled():
+    """核对人工标注样本，返回新方案结果与标注不一致的条数"""
+    mismatched = 0
+    legacy_ok = 0
+    for response, expected in LABELLED:
+        legacy_ok += legacy_parse(response) == expected
+        result = new_parse(response)
+        if result != expected:
+            mismatched += 1
+            print(f"标注样本不一致: {response[:80]!r}\n  期望 {expected}\n  实际 {result}")
+    print(f"标注样本: {len(LABELLED)} 条，旧方案正确 {legacy_ok} 条，新方案不一致 {mismatched} 条")
+    return mismatched
+
+
+def main():
+    mismatched = check_labelled()
+
+    paths = sys.argv[1:] or sorted(glob.glob('logs/*.log')) + glob.glob('nohup.out')
+    corpus = load_corpus(paths)
+    if not corpus:
+        print(f"未在 {paths} 中找到 '{MARKER.strip()}' 记录")
+        return 1
+
+    rounds = max(1, 10000 // len(corpus))
+    print(f"语料: {len(corpus)} 条回复，来自 {len(paths)} 个文件，每种方案运行 {rounds} 轮")
+
+    legacy = bench('旧方案', legacy_parse, corpus, rounds)
+    new = bench('新方案', new_parse, corpus, rounds)
+
+    corrupted = 0
+    for response, old_result, new_result in zip(corpus, legacy, new):
+        expected = strict_parse(response)
+        if expected is not None and new_result is not None and new_result != expected:
+            corrupted += 1
+            print(f"结果不一致: {response[:120]!r}")
+    recovered = sum(1 for old_result, new_result in zip(legacy, new) if old_result is None and new_result is not None)
+
+    print(f"新方案额外解析成功 {recovered} 条，与标准JSON结果不一致 {corrupted} 条")
+    return 1 if corrupted or mismatched else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
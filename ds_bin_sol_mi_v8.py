@@ -17,15 +17,25 @@ import requests
 from datetime import datetime, timedelta
 import hmac
 import hashlib
+import gzip
 import base64
 import urllib.parse
 import asyncio
 import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from typing import Dict, List, Optional, Tuple, Any
-from dataclasses import dataclass
+from dataclasses import dataclass, replace
+from collections import deque, OrderedDict
+import math
+import sqlite3
 import logging
 from enum import Enum
 
+try:
+    import websocket  # websocket-client，仅K线推送模式需要
+except ImportError:
+    websocket = None
+
 # ============================================================================
 # 配置日志系统
 # ============================================================================
@@ -42,6 +52,10 @@ logger = logging.getLogger(__name__)
 # 加载环境变量
 load_dotenv()
 
+# 写时复制：缓存的K线DataFrame以浅视图交给调用方，底层数组对外只读，修改时才拷贝（pandas 3.0起默认开启）
+if int(pd.__version__.split('.')[0]) < 3:
+    pd.set_option('mode.copy_on_write', True)
+
 # ============================================================================
 # 枚举定义
 # ============================================================================
@@ -73,6 +87,9 @@ class TradeConfig:
     execution_interval: int = 15
     test_mode: bool = False
     data_points: int = 96
+    incremental_indicators: bool = True
+    base_timeframe: str = '1m'
+    resample_timeframes: bool = True
     contract_size: float = 1.0
     min_amount: float = 0.01
     
@@ -85,6 +102,24 @@ class TradeConfig:
     # API重试配置
     retry_config: Dict = None
     
+    # 行情推送配置
+    stream_config: Dict = None
+    
+    # 本地K线库配置
+    store_config: Dict = None
+    
+    # K线缓存配置
+    cache_config: Dict = None
+    
+    # AI调用配置
+    ai_config: Dict = None
+    
+    # 下单配置
+    order_config: Dict = None
+    
+    # 移动止损配置
+    trailing_config: Dict = None
+    
     def __post_init__(self):
         """初始化后处理"""
         if self.timeframes is None:
@@ -118,6 +153,94 @@ class TradeConfig:
                 'retry_delay': 1,
                 'exponential_backoff': True
             }
+        
+        if self.stream_config is None:
+            self.stream_config = {
+                'enable_kline_stream': os.getenv('ENABLE_KLINE_STREAM', 'False').lower() == 'true',
+                'ws_base_url': os.getenv('BINANCE_WS_URL', 'wss://fstream.binance.com/ws'),
+                'stale_seconds': 30,
+                'reconnect_delay': 1,
+                'max_reconnect_delay': 60,
+                'ping_interval': 20,
+                'enable_user_stream': os.getenv('ENABLE_USER_STREAM', 'False').lower() == 'true',
+                'listen_key_keepalive': 1800,   # listenKey续期间隔（秒），有效期60分钟
+                'fill_wait': 1.0                # 下单后等待推送确认成交的最长秒数
+            }
+        
+        if self.store_config is None:
+            self.store_config = {
+                'enable_candle_store': os.getenv('ENABLE_CANDLE_STORE', 'True').lower() == 'true',
+                'path': os.getenv('CANDLE_STORE_PATH', 'data/candles.db'),
+                'history_points': 500,
+                'page_size': 1000,
+                'empty_ttl': 86400             # 空页标记的有效秒数（可能是维护或限频造成的临时空页），到期后重新确认
+            }
+        
+        if self.cache_config is None:
+            self.cache_config = {
+                'open_candle_refresh': 60,     # 未收盘K线最长缓存秒数，0表示只在收盘时刷新
+                'close_delay_ms': 500,         # 收盘后等待交易所定稿的毫秒数
+                'time_sync_interval': 3600     # 服务器时间偏移重新校准间隔（秒）
+            }
+        
+        if self.ai_config is None:
+            self.ai_config = {
+                'enable_response_cache': os.getenv('ENABLE_AI_CACHE', 'True').lower() == 'true',
+                'cache_ttl': 1800,             # 缓存有效秒数（默认两个15分钟周期）
+                'cache_size': 64,
+                'rsi_bucket': 10,              # RSI量化分档宽度
+                'history_token_budget': 300,   # 交易历史在提示词中的token预算
+                'history_max_rows': 12,
+                'stream_response': os.getenv('AI_STREAM', 'True').lower() == 'true',  # 流式读取，JSON完整即停止
+                'stream_usage_wait': 3.0,      # JSON完整后继续读取末尾用量块的最长秒数
+                'model': os.getenv('AI_MODEL', 'deepseek-chat'),
+                'alt_base_url': os.getenv('AI_ALT_BASE_URL'),    # 对冲请求的备用OpenAI兼容接口
+                'alt_api_key': os.getenv('AI_ALT_API_KEY'),
+                'alt_model': os.getenv('AI_ALT_MODEL'),
+                'alt_fast_model': os.getenv('AI_ALT_FAST_MODEL'),  # 备用接口的快速模型，未设置时用备用接口自身模型
+                'decision_deadline': float(os.getenv('AI_DEADLINE', 25)),   # 决策硬截止（秒），超时走备用信号
+                'hedge_delay': float(os.getenv('AI_HEDGE_DELAY', 6)),      # 主接口超过该秒数未返回则发出对冲请求
+                'enable_gate': os.getenv('ENABLE_AI_GATE', 'False').lower() == 'true',  # 特征无明显变化时跳过AI
+                'gate_threshold': 1.0,         # 特征变化评分阈值
+                'gate_max_staleness': 3600,    # 最长不调用AI的秒数
+                'gate_atr_jump': 0.3,          # ATR相对变化超过30%计分
+                'gate_pnl_step': 1.0,          # 持仓盈亏每跨过1%计分
+                'gate_price_move': 1.0,        # 价格变化超过1%计分
+                'gate_sharp_move': 1.5,        # 周期之间价格变化超过1.5%提前触发
+                'gate_poll_interval': 30,      # 周期外急变检查间隔（秒）
+                'enable_speculation': os.getenv('AI_SPECULATE', 'False').lower() == 'true',  # 收盘前预先分析
+                'speculation_lead': int(os.getenv('AI_SPECULATION_LEAD', 20)),   # 收盘前多少秒发起预分析
+                'speculation_tolerance': 0.15, # 收盘价相对预分析价格的最大偏移（%）
+                'enable_routing': os.getenv('AI_ROUTING', 'False').lower() == 'true',  # 规则/快速/完整三档路由
+                'fast_model': os.getenv('AI_FAST_MODEL', os.getenv('AI_MODEL', 'deepseek-chat')),
+                'route_rsi_range': (40, 60),   # 规则档要求RSI处于该区间
+                'route_bb_width': 0.02,        # 规则档要求布林带宽度不超过2%
+                'cassette_mode': os.getenv('AI_CASSETTE', 'off').lower(),  # off / record / replay
+                'cassette_path': os.getenv('AI_CASSETTE_PATH', 'logs/ai_cassette.jsonl.gz')
+            }
+        
+        if self.order_config is None:
+            self.order_config = {
+                'bracket_batch': True,         # 止损止盈通过batchOrders一次提交
+                # 某条腿重试后仍失败时的处理：keep_stop 保留已挂的止损，all_or_none 撤掉已挂的另一条腿
+                'bracket_rollback': os.getenv('BRACKET_ROLLBACK', 'keep_stop'),
+                'working_type': 'CONTRACT_PRICE',
+                'bracket_tolerance_pct': 0.05  # 现有止损止盈与目标价偏差在该比例（%）内视为一致，不改单
+            }
+        
+        if self.trailing_config is None:
+            self.trailing_config = {
+                'enable_trailing': os.getenv('ENABLE_TRAILING_STOP', 'False').lower() == 'true',
+                # 分档：最大浮盈（价格%）达到档位后，止损跟随最优价回撤 ATR×倍数，格式 "盈利%:ATR倍数,..."
+                'tiers': sorted(
+                    tuple(float(value) for value in item.split(':'))
+                    for item in os.getenv('TRAILING_TIERS', '1:2,2:1.5,4:1').split(',') if item.strip()
+                ),
+                'lock_breakeven': True,        # 进入任一档位后止损不低于开仓价
+                'min_interval': float(os.getenv('TRAILING_MIN_INTERVAL', 2)),  # 两次改单最小间隔（秒）
+                'min_step_pct': 0.1,           # 新止损相对现止损至少改善0.1%才改单
+                'stream_suffix': 'markPrice@1s'
+            }
 
 @dataclass
 class SignalData:
@@ -261,6 +384,74 @@ class DingTalkManager:
         title = alert_titles.get(alert_type, "⚠️ 系统通知")
         return self.send_message(title, message, level)
 
+class PerformanceMetrics:
+    """性能指标记录器（计数器 + 耗时样本，线程安全，可导出JSON）"""
+    
+    def __init__(self, export_path: str = None, max_samples: int = 1000):
+        self.export_path = export_path
+        self.max_samples = max_samples
+        self.lock = threading.Lock()
+        self.counters: Dict[str, float] = {}
+        self.samples: Dict[str, deque] = {}
+    
+    def increment(self, name: str, value: float = 1):
+        """累加计数器"""
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+    
+    def record(self, name: str, seconds: float):
+        """记录一次耗时（秒）"""
+        with self.lock:
+            if name not in self.samples:
+                self.samples[name] = deque(maxlen=self.max_samples)
+            self.samples[name].append(seconds)
+    
+    def percentile(self, name: str, q: float) -> Optional[float]:
+        """耗时分位数（q取0-100）"""
+        with self.lock:
+            values = list(self.samples.get(name, ()))
+        if not values:
+            return None
+        return float(np.percentile(values, q))
+    
+    def snapshot(self) -> Dict:
+        """当前全部指标"""
+        with self.lock:
+            counters = dict(self.counters)
+            samples = {name: list(values) for name, values in self.samples.items()}
+        
+        latencies = {}
+        for name, values in samples.items():
+            if values:
+                latencies[name] = {
+                    'count': len(values),
+                    'last': values[-1],
+                    'mean': float(np.mean(values)),
+                    'p50': float(np.percentile(values, 50)),
+                    'p99': float(np.percentile(values, 99))
+                }
+        
+        return {
+            'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'counters': counters,
+            'latency': latencies
+        }
+    
+    def export(self) -> bool:
+        """把指标快照写入JSON文件"""
+        if not self.export_path:
+            return False
+        try:
+            snapshot = self.snapshot()
+            tmp_path = f"{self.export_path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(snapshot, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.export_path)
+            return True
+        except Exception as e:
+            logger.error(f"导出性能指标失败: {e}")
+            return False
+
 class RetryManager:
     """重试管理器"""
     
@@ -311,6 +502,29 @@ class RetryManager:
             logger.error(f"最后错误: {last_exception}")
         return None
 
+class SerializedExchange:
+    """
+    交易所实例加锁代理
+    
+    sync ccxt实例的会话、限频计时和最近响应不是线程安全的；交易周期、移动止损线程、
+    用户数据推送线程和后台状态报告共用带密钥的交易实例，所有方法调用经同一把可重入锁串行执行
+    """
+    
+    def __init__(self, exchange):
+        self._exchange = exchange
+        self.lock = threading.RLock()
+    
+    def __getattr__(self, name):
+        attr = getattr(self._exchange, name)
+        if not callable(attr):
+            return attr
+        
+        def locked(*args, **kwargs):
+            with self.lock:
+                return attr(*args, **kwargs)
+        
+        return locked
+
 class TechnicalAnalyzer:
     """技术分析器"""
     
@@ -372,8 +586,8 @@ class TechnicalAnalyzer:
             df['resistance'] = high.rolling(window=20).max()
             df['support'] = low.rolling(window=20).min()
             
-            # 填充NaN值
-            df = df.ffill().bfill()
+            # 填充NaN值（只向前填充，预热期保留NaN，避免引入未来数据）
+            df = df.ffill()
             
             logger.debug("技术指标计算完成")
             return df
@@ -382,12 +596,514 @@ class TechnicalAnalyzer:
             logger.error(f"技术指标计算失败: {e}")
             return df
 
+class UserDataStream:
+    """
+    Binance合约用户数据推送（listenKey + 定时续期）
+    
+    在内存中镜像持仓、钱包余额和未成交条件单，由 ACCOUNT_UPDATE / ORDER_TRADE_UPDATE 事件更新；
+    每次（重新）连接时先用REST拉取一次做基准，补上断线期间错过的事件
+    """
+    
+    CONDITIONAL_TYPES = ('STOP', 'STOP_MARKET', 'TAKE_PROFIT', 'TAKE_PROFIT_MARKET', 'TRAILING_STOP_MARKET')
+    
+    def __init__(self, exchange, config: TradeConfig):
+        self.exchange = exchange
+        self.config = config
+        self.stream_config = config.stream_config
+        
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+        self.positions: Dict[Tuple[str, str], Dict] = {}  # 键 (交易对, positionSide)，双向持仓多空分开
+        self.balances: Dict[str, Dict] = {}
+        self.open_orders: Dict[str, Dict] = {}
+        self.fills = deque(maxlen=100)
+        self.last_account_update = 0.0
+        self.last_order_update = 0.0
+        
+        self.listen_key = None
+        self.ws_app = None
+        self.thread = None
+        self.keepalive_thread = None
+        self.is_running = False
+        self.connected = False
+        self.seeded = False
+        self.reconnect_count = 0
+        self.reconnect_delay = self.stream_config['reconnect_delay']
+    
+    def _market_id(self) -> str:
+        try:
+            return self.exchange.market_id(self.config.symbol)
+        except Exception:
+            return self.config.symbol.split(':')[0].replace('/', '')
+    
+    def start(self) -> bool:
+        """启动推送线程和listenKey续期线程"""
+        if websocket is None:
+            logger.warning("未安装websocket-client，用户数据推送不可用，继续使用REST轮询")
+            return False
+        
+        if self.is_running:
+            return True
+        
+        self.is_running = True
+        self.thread = threading.Thread(target=self._run, name="user-data", daemon=True)
+        self.thread.start()
+        self.keepalive_thread = threading.Thread(target=self._keepalive_loop, name="listen-key", daemon=True)
+        self.keepalive_thread.start()
+        logger.info("用户数据推送已启动")
+        return True
+    
+    def stop(self):
+        """停止推送并关闭listenKey"""
+        self.is_running = False
+        if self.ws_app:
+            try:
+                self.ws_app.close()
+            except Exception:
+                pass
+        try:
+            if self.listen_key:
+                self.exchange.fapiPrivateDeleteListenKey()
+        except Exception:
+            pass
+        logger.info("用户数据推送已停止")
+    
+    def is_live(self) -> bool:
+        """镜像是否可用（已连接且已用REST建立基准）"""
+        return self.is_running and self.connected and self.seeded
+    
+    # ------------------------------------------------------------------
+    # 镜像查询
+    # ------------------------------------------------------------------
+    
+    def get_positions(self) -> List[Dict]:
+        """当前交易对全部持仓（双向持仓模式下多空各一条）"""
+        market_id = self._market_id()
+        with self.lock:
+            return [dict(position) for (symbol_id, _), position in self.positions.items()
+                    if symbol_id == market_id]
+    
+    def get_position(self) -> Optional[Dict]:
+        """当前交易对持仓（与 AccountStateService 格式一致，取第一条）"""
+        positions = self.get_positions()
+        return positions[0] if positions else None
+    
+    def get_wallet_balance(self, asset: str = 'USDT') -> Optional[Dict]:
+        """钱包余额 {'wallet', 'cross'}"""
+        with self.lock:
+            balance = self.balances.get(asset)
+            return dict(balance) if balance else None
+    
+    def get_open_orders(self) -> List[Dict]:
+        """当前交易对未成交条件单（ccxt订单格式）"""
+        market_id = self._market_id()
+        with self.lock:
+            return [dict(order) for order in self.open_orders.values()
+                    if order.get('info', {}).get('symbol', market_id) == market_id]
+    
+    def wait_for_account_update(self, since: float, timeout: float) -> bool:
+        """等待 since 之后的账户更新事件（下单后确认成交用）"""
+        deadline = time.time() + timeout
+        with self.condition:
+            while self.last_account_update < since:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+            return True
+    
+    # ------------------------------------------------------------------
+    # 连接管理
+    # ------------------------------------------------------------------
+    
+    def _run(self):
+        """推送主循环（断线自动重连，每次连接重新申请listenKey并做REST基准）"""
+        while self.is_running:
+            try:
+                self.listen_key = self.exchange.fapiPrivatePostListenKey()['listenKey']
+                
+                self.ws_app = websocket.WebSocketApp(
+                    f"{self.stream_config['ws_base_url']}/{self.listen_key}",
+                    on_open=self._on_open,
+                    on_message=self._on_message,
+                    on_error=self._on_error,
+                    on_close=self._on_close
+                )
+                self.ws_app.run_forever(ping_interval=self.stream_config['ping_interval'])
+                
+            except Exception as e:
+                logger.error(f"用户数据推送异常: {e}")
+            
+            self.connected = False
+            self.seeded = False
+            if not self.is_running:
+                break
+            
+            self.reconnect_count += 1
+            logger.warning(f"用户数据推送断开，{self.reconnect_delay}秒后重连 (第{self.reconnect_count}次)")
+            time.sleep(self.reconnect_delay)
+            self.reconnect_delay = min(self.reconnect_delay * 2, self.stream_config['max_reconnect_delay'])
+    
+    def _keepalive_loop(self):
+        """定时续期listenKey（有效期60分钟）"""
+        interval = self.stream_config['listen_key_keepalive']
+        while self.is_running:
+            for _ in range(interval):
+                if not self.is_running:
+                    return
+                time.sleep(1)
+            try:
+                self.exchange.fapiPrivatePutListenKey()
+                logger.debug("listenKey续期成功")
+            except Exception as e:
+                logger.error(f"listenKey续期失败，重新连接: {e}")
+                if self.ws_app:
+                    self.ws_app.close()
+    
+    def _on_open(self, ws):
+        self.connected = True
+        self.reconnect_delay = self.stream_config['reconnect_delay']
+        logger.info("用户数据推送连接成功")
+        # 连接建立后再做REST基准，之后的事件都会增量应用在基准之上
+        self._seed()
+    
+    def _on_error(self, ws, error):
+        logger.error(f"用户数据推送错误: {error}")
+    
+    def _on_close(self, ws, status_code, message):
+        self.connected = False
+        self.seeded = False
+        logger.warning(f"用户数据推送连接关闭: {status_code} {message}")
+    
+    def _seed(self):
+        """REST拉取持仓、余额和条件单作为镜像基准"""
+        try:
+            balance = self.exchange.fetch_balance()
+            positions = self.exchange.fetch_positions([self.config.symbol])
+            orders = self.exchange.fetch_open_orders(self.config.symbol, params={'stop': True})
+            
+            with self.condition:
+                usdt = balance.get('USDT', {})
+                asset = next((item for item in balance.get('info', {}).get('assets', [])
+                              if item.get('asset') == 'USDT'), {})
+                self.balances['USDT'] = {
+                    'wallet': float(asset.get('walletBalance') or usdt.get('total') or 0),
+                    'cross': float(asset.get('crossWalletBalance') or usdt.get('total') or 0)
+                }
+                
+                self.positions.clear()
+                for pos in positions:
+                    contracts = float(pos.get('contracts') or 0)
+                    if pos['symbol'] == self.config.symbol and contracts > 0:
+                        position_side = pos.get('info', {}).get('positionSide', 'BOTH')
+                        self.positions[(self._market_id(), position_side)] = {
+                            'side': pos['side'],
+                            'size': contracts,
+                            'entry_price': float(pos['entryPrice'] or 0),
+                            'unrealized_pnl': float(pos['unrealizedPnl'] or 0),
+                            'leverage': float(pos['leverage'] or self.config.leverage)
+                        }
+                
+                self.open_orders = {str(order['id']): order for order in orders}
+                self.last_account_update = time.time()
+                self.seeded = True
+                self.condition.notify_all()
+            
+            logger.info(f"用户数据镜像基准完成: 持仓{len(self.positions)}个, 条件单{len(self.open_orders)}个")
+            
+        except Exception as e:
+            logger.error(f"用户数据镜像基准失败，断开重连: {e}")
+            if self.ws_app:
+                self.ws_app.close()
+    
+    # ------------------------------------------------------------------
+    # 事件处理
+    # ------------------------------------------------------------------
+    
+    def _on_message(self, ws, message: str):
+        try:
+            data = json.loads(message)
+            event = data.get('e')
+            
+            if event == 'ACCOUNT_UPDATE':
+                self._apply_account_update(data.get('a', {}))
+            elif event == 'ORDER_TRADE_UPDATE':
+                self._apply_order_update(data.get('o', {}))
+            elif event == 'ALGO_UPDATE':
+                self._apply_algo_update(data.get('o', {}))
+            elif event == 'listenKeyExpired':
+                logger.warning("listenKey已过期，重新连接")
+                ws.close()
+                
+        except Exception as e:
+            logger.error(f"处理用户数据推送失败: {e}")
+    
+    def _apply_account_update(self, account: Dict):
+        """应用账户更新（余额、持仓）"""
+        with self.condition:
+            for balance in account.get('B', []):
+                self.balances[balance['a']] = {
+                    'wallet': float(balance['wb']),
+                    'cross': float(balance['cw'])
+                }
+            
+            for pos in account.get('P', []):
+                amount = float(pos['pa'])
+                position_side = pos.get('ps', 'BOTH')
+                key = (pos['s'], position_side)
+                if amount == 0:
+                    self.positions.pop(key, None)
+                    continue
+                
+                if position_side in ('LONG', 'SHORT'):
+                    side = position_side.lower()
+                else:
+                    side = 'long' if amount > 0 else 'short'
+                previous = self.positions.get(key, {})
+                self.positions[key] = {
+                    'side': side,
+                    'size': abs(amount),
+                    'entry_price': float(pos['ep']),
+                    'unrealized_pnl': float(pos['up']),
+                    'leverage': previous.get('leverage', float(self.config.leverage))
+                }
+            
+            self.last_account_update = time.time()
+            self.condition.notify_all()
+        
+        logger.debug(f"账户更新: {account.get('m', 'N/A')}")
+    
+    def _apply_order_update(self, order: Dict):
+        """应用订单更新（条件单增删、成交记录）"""
+        order_id = str(order['i'])
+        status = order['X']
+        order_type = order.get('ot') or order.get('o')
+        
+        with self.condition:
+            if order_type in self.CONDITIONAL_TYPES:
+                if status == 'NEW':
+                    self.open_orders[order_id] = {
+                        'id': order_id,
+                        'clientOrderId': order.get('c'),
+                        'type': order_type,
+                        'side': order['S'].lower(),
+                        'amount': float(order.get('q') or 0),
+                        'stopPrice': float(order.get('sp') or 0),
+                        'reduceOnly': bool(order.get('R')),
+                        'status': 'open',
+                        'info': {
+                            'symbol': order['s'],
+                            'orderId': order_id,
+                            'algoType': 'CONDITIONAL',
+                            'closePosition': 'true' if order.get('cp') else 'false',
+                            'type': order_type
+                        }
+                    }
+                else:
+                    self.open_orders.pop(order_id, None)
+            
+            if status in ('FILLED', 'PARTIALLY_FILLED'):
+                self.fills.append({
+                    'id': order_id,
+                    'side': order['S'].lower(),
+                    'type': order.get('o'),
+                    'status': status,
+                    'price': float(order.get('L') or 0),
+                    'average': float(order.get('ap') or 0),
+                    'filled': float(order.get('z') or 0),
+                    'realized_pnl': float(order.get('rp') or 0),
+                    'time': time.time()
+                })
+            
+            self.last_order_update = time.time()
+            self.condition.notify_all()
+        
+        logger.info(f"订单更新: {order_id} {order_type} {order['S']} {status}")
+    
+    def _apply_algo_update(self, order: Dict):
+        """应用算法条件单更新（条件单走algo接口时，触发前只推送ALGO_UPDATE）"""
+        order_id = str(order.get('aid'))
+        status = order.get('X')
+        
+        with self.condition:
+            if status == 'NEW':
+                self.open_orders[order_id] = {
+                    'id': order_id,
+                    'clientOrderId': order.get('caid'),
+                    'type': order.get('o'),
+                    'side': str(order.get('S', '')).lower(),
+                    'amount': float(order.get('q') or 0),
+                    'stopPrice': float(order.get('tp') or 0),
+                    'reduceOnly': bool(order.get('R')),
+                    'status': 'open',
+                    'info': {
+                        'symbol': order.get('s'),
+                        'algoId': order_id,
+                        'algoType': order.get('at', 'CONDITIONAL'),
+                        'closePosition': 'true' if order.get('cp') else 'false',
+                        'type': order.get('o')
+                    }
+                }
+            else:
+                self.open_orders.pop(order_id, None)
+            
+            self.last_order_update = time.time()
+            self.condition.notify_all()
+        
+        logger.info(f"条件单更新: {order_id} {order.get('o')} {order.get('S')} {status}")
+
+class AccountStateService:
+    """
+    账户状态快照服务
+    
+    余额和持仓每个交易周期只向交易所拉取一次，各管理器共享同一份快照；
+    下单成交后显式失效，下次读取时重新拉取。
+    接入用户数据推送后优先读取推送镜像，推送断开时回退到REST快照
+    """
+    
+    def __init__(self, exchange, config: TradeConfig, metrics: PerformanceMetrics = None, max_age: float = 60):
+        self.exchange = exchange
+        self.config = config
+        self.metrics = metrics
+        self.max_age = max_age  # 周期外调用时快照的最长有效秒数
+        self.balance_lock = threading.Lock()
+        self.position_lock = threading.Lock()
+        
+        self._balance: Optional[Dict] = None
+        self._balance_time = 0.0
+        self._balance_valid = False
+        self._position: Optional[Dict] = None
+        self._position_time = 0.0
+        self._position_valid = False
+        self._invalidated_at = 0.0
+        self.stream: Optional[UserDataStream] = None
+    
+    def attach_stream(self, stream: UserDataStream):
+        """接入用户数据推送镜像"""
+        self.stream = stream
+    
+    def _stream_ready(self) -> bool:
+        """推送镜像可用，且已包含最近一次失效之后的账户事件"""
+        if not self.stream or not self.stream.is_live():
+            return False
+        if self.stream.last_account_update >= self._invalidated_at:
+            return True
+        # 刚下完单，等推送确认成交（通常毫秒级），超时则回退REST
+        return self.stream.wait_for_account_update(
+            self._invalidated_at, self.config.stream_config['fill_wait'])
+    
+    def begin_cycle(self):
+        """新交易周期开始，丢弃上一周期的快照（推送镜像本身始终最新，无需等待新事件）"""
+        self._balance_valid = False
+        self._position_valid = False
+        logger.debug("账户快照失效: 新交易周期")
+    
+    def invalidate(self, reason: str = "", since: float = None):
+        """
+        使快照失效（下单成交、持仓变化后调用）
+        
+        Args:
+            since: 变化发生的时间（下单前的时间戳）；市价单的成交推送通常早于下单接口返回，
+                   按返回时间计会错过该推送而等满 fill_wait
+        """
+        self._balance_valid = False
+        self._position_valid = False
+        self._invalidated_at = since if since is not None else time.time()
+        logger.debug(f"账户快照失效: {reason}")
+    
+    def get_balance(self) -> Optional[Dict]:
+        """获取USDT余额快照 {'free', 'total'}，拉取失败时返回上一次快照"""
+        if self._stream_ready():
+            balance = self._balance_from_stream()
+            if balance is not None:
+                return balance
+        
+        with self.balance_lock:
+            if not self._is_fresh(self._balance_valid, self._balance_time):
+                balance = RetryManager.retry_operation(self._fetch_balance, max_retries=2, delay=1)
+                if balance is not None:
+                    self._balance = balance
+                    self._balance_time = time.time()
+                    self._balance_valid = True
+                else:
+                    logger.warning("获取余额失败，使用上次快照")
+            return self._balance
+    
+    def get_position(self) -> Optional[Dict]:
+        """获取当前持仓快照（无持仓为None），拉取失败时返回上一次快照"""
+        if self._stream_ready():
+            if self.metrics:
+                self.metrics.increment('account.position_stream')
+            return self.stream.get_position()
+        
+        with self.position_lock:
+            if not self._is_fresh(self._position_valid, self._position_time):
+                # 包一层元组区分“无持仓”和“拉取失败”
+                result = RetryManager.retry_operation(lambda: (self._fetch_position(),), max_retries=2, delay=1)
+                if result is not None:
+                    self._position = result[0]
+                    self._position_time = time.time()
+                    self._position_valid = True
+                else:
+                    logger.warning("获取持仓失败，使用上次快照")
+            return self._position
+    
+    def _balance_from_stream(self) -> Optional[Dict]:
+        """
+        由推送镜像估算余额：total 取钱包余额，
+        free 按 全仓钱包余额 + 未实现盈亏 - 持仓初始保证金 估算
+        """
+        wallet = self.stream.get_wallet_balance('USDT')
+        if wallet is None:
+            return None
+        
+        free = wallet['cross']
+        for position in self.stream.get_positions():
+            free += position['unrealized_pnl']
+            free -= position['size'] * position['entry_price'] / max(position['leverage'], 1)
+        
+        if self.metrics:
+            self.metrics.increment('account.balance_stream')
+        return {'free': max(free, 0.0), 'total': wallet['wallet']}
+    
+    def _is_fresh(self, valid: bool, fetched_at: float) -> bool:
+        return valid and time.time() - fetched_at < self.max_age
+    
+    def _fetch_balance(self) -> Dict:
+        """从交易所拉取余额"""
+        if self.metrics:
+            self.metrics.increment('account.balance_fetch')
+        balance = self.exchange.fetch_balance()
+        return {
+            'free': float(balance.get('USDT', {}).get('free', 1000)),
+            'total': float(balance.get('USDT', {}).get('total', 1000))
+        }
+    
+    def _fetch_position(self) -> Optional[Dict]:
+        """从交易所拉取持仓"""
+        if self.metrics:
+            self.metrics.increment('account.position_fetch')
+        positions = self.exchange.fetch_positions([self.config.symbol])
+        for pos in positions:
+            if pos['symbol'] == self.config.symbol:
+                contracts = float(pos['contracts'] or 0)
+                if contracts > 0:
+                    return {
+                        'side': pos['side'],
+                        'size': contracts,
+                        'entry_price': float(pos['entryPrice'] or 0),
+                        'unrealized_pnl': float(pos['unrealizedPnl'] or 0),
+                        'leverage': float(pos['leverage'] or self.config.leverage)
+                    }
+        return None
+
 class RiskManager:
     """风险管理器"""
     
-    def __init__(self, config: TradeConfig, exchange):
+    def __init__(self, config: TradeConfig, exchange, account_state: AccountStateService):
         self.config = config
         self.exchange = exchange
+        self.account_state = account_state
         self.daily_pnl = 0.0
         self.consecutive_losses = 0
         self.last_trade_time = None
@@ -397,13 +1113,7 @@ class RiskManager:
         
     def _get_starting_balance(self) -> float:
         """获取起始余额"""
-        try:
-            balance = self.exchange.fetch_balance()
-            if 'USDT' in balance:
-                return float(balance['USDT']['free'])
-            return 1000.0
-        except:
-            return 1000.0
+        return self._get_current_balance()
     
     def check_risk_limits(self) -> Tuple[bool, str]:
         """检查所有风险限制"""
@@ -460,50 +1170,12 @@ class RiskManager:
     
     def _get_current_balance(self) -> float:
         """获取当前余额"""
-        return RetryManager.retry_operation(
-            lambda: self._fetch_balance_safe(),
-            max_retries=2,
-            delay=1
-        ) or 1000.0
-    
-    def _fetch_balance_safe(self) -> float:
-        """安全获取余额"""
-        try:
-            balance = self.exchange.fetch_balance()
-            if 'USDT' in balance:
-                return float(balance['USDT']['free'])
-            return 1000.0
-        except Exception as e:
-            logger.error(f"获取余额失败: {e}")
-            return 1000.0
+        balance = self.account_state.get_balance()
+        return balance['free'] if balance else 1000.0
     
     def _get_current_position(self) -> Optional[Dict]:
         """获取当前持仓"""
-        return RetryManager.retry_operation(
-            lambda: self._fetch_position_safe(),
-            max_retries=2,
-            delay=1
-        )
-    
-    def _fetch_position_safe(self) -> Optional[Dict]:
-        """安全获取持仓"""
-        try:
-            positions = self.exchange.fetch_positions([self.config.symbol])
-            for pos in positions:
-                if pos['symbol'] == self.config.symbol:
-                    contracts = float(pos['contracts'] or 0)
-                    if contracts > 0:
-                        return {
-                            'side': pos['side'],
-                            'size': contracts,
-                            'entry_price': float(pos['entryPrice'] or 0),
-                            'unrealized_pnl': float(pos['unrealizedPnl'] or 0),
-                            'leverage': float(pos['leverage'] or self.config.leverage)
-                        }
-            return None
-        except Exception as e:
-            logger.error(f"获取持仓失败: {e}")
-            return None
+        return self.account_state.get_position()
     
     def record_trade(self, signal: str, pnl: float, reason: str):
         """记录交易"""
@@ -571,80 +1243,181 @@ class RiskManager:
 class OrderManager:
     """订单管理器"""
     
-    def __init__(self, exchange, symbol: str, config: TradeConfig):
+    def __init__(self, exchange, symbol: str, config: TradeConfig,
+                 account_state: AccountStateService = None):
         self.exchange = exchange
         self.symbol = symbol
         self.config = config
+        self.account_state = account_state
         self.active_orders = []
+        self.batch_supported = True  # 交易所拒绝批量条件单后改为单笔下单
+        # 串行化止损止盈变更（交易周期下单与移动止损线程各自读现有条件单再改单，并发会互相撤单或重复挂单）
+        self.bracket_lock = threading.RLock()
     
-    def cancel_existing_orders(self, side: str = None) -> int:
+    def cancel_existing_orders(self, side: str = None) -> Dict:
         """
         取消现有条件订单
         
+        不指定方向时算法条件单整单撤销，普通挂单全为条件单时也整单撤销（不误撤手动限价单）；
+        指定方向或整单撤销不可用时，普通单走batchOrders批量撤销，算法单逐笔撤销
+        
         Args:
             side: 指定取消的方向（'buy'或'sell'），None表示取消所有
             
         Returns:
-            取消的订单数量
+            {'method': 'cancel_all'|'batch'|'single'|None, 'cancelled': [订单ID],
+             'failed': {订单ID: 错误}, 'all': 是否整单撤销}
         """
+        with self.bracket_lock:
+            return self._cancel_existing_orders(side)
+    
+    def _cancel_existing_orders(self, side: str = None) -> Dict:
+        result = {'method': None, 'cancelled': [], 'failed': {}, 'all': False}
+        
         try:
-            # 获取所有活动订单（包括条件订单）
-            params = {'stop': True}  # 获取条件订单
-            orders = self.exchange.fetch_open_orders(self.symbol, params=params)
-            
-            cancelled_count = 0
+            if side is None and self._cancel_all(result):
+                return result
             
-            for order in orders:
-                try:
-                    # 检查订单信息
-                    info = order.get('info', {})
-                    order_id = order.get('id')
-                    order_side = order.get('side', '').lower()
-                    
-                    # 如果指定了方向，检查是否匹配
-                    if side is not None and order_side != side.lower():
-                        continue
-                    
-                    # 检查是否条件订单（通过算法类型或reduceOnly判断）
-                    is_conditional = (
-                        info.get('algoType') == 'CONDITIONAL' or
-                        order.get('reduceOnly', False) or
-                        info.get('closePosition') == 'true'
-                    )
-                    
-                    if is_conditional:
-                        logger.info(f"取消条件订单: {order_id} - {order.get('type', 'N/A')}")
-                        
-                        # 尝试取消订单
-                        try:
-                            self.exchange.cancel_order(order_id, self.symbol, params={'stop': True})
-                            cancelled_count += 1
-                            time.sleep(0.1)  # 避免API限频
-                        except Exception as cancel_error:
-                            logger.error(f"取消订单 {order_id} 失败: {cancel_error}")
-                            
-                except Exception as order_error:
-                    logger.error(f"处理订单时出错: {order_error}")
-                    continue
+            # 获取所有活动订单（包括条件订单）
+            orders = [
+                order for order in self.fetch_conditional_orders()
+                if self._is_conditional(order) and
+                (side is None or order.get('side', '').lower() == side.lower())
+            ]
             
-            if cancelled_count > 0:
-                logger.info(f"已取消 {cancelled_count} 个条件订单")
-            else:
+            if not orders:
                 logger.info("没有需要取消的条件订单")
+                return result
+            
+            self._cancel_orders(orders, result)
             
-            return cancelled_count
+            failed_text = f"，失败 {len(result['failed'])} 个" if result['failed'] else ""
+            logger.info(f"已取消 {len(result['cancelled'])} 个条件订单 ({result['method']}){failed_text}")
+            return result
             
         except Exception as e:
             logger.error(f"取消现有订单失败: {e}")
-            return 0
+            return result
+    
+    @staticmethod
+    def _is_conditional(order: Dict) -> bool:
+        """是否条件订单（通过算法类型或reduceOnly判断）"""
+        info = order.get('info', {})
+        return (
+            info.get('algoType') == 'CONDITIONAL' or
+            order.get('reduceOnly', False) or
+            info.get('closePosition') == 'true'
+        )
+    
+    def _cancel_all(self, result: Dict) -> bool:
+        """
+        整单撤销该交易对的条件单
+        
+        算法条件单走 algoOpenOrders 整单撤销；allOpenOrders 会连同普通限价单一起撤销，
+        只在普通挂单全部是条件单时使用，否则普通条件单按批量撤销，保留其他挂单
+        """
+        if not hasattr(self.exchange, 'fapiPrivateDeleteAlgoOpenOrders'):
+            return False
+        
+        market_id = self.exchange.market_id(self.symbol)
+        success = True
+        # 整单撤销接口不返回订单号，先取出算法条件单用于记录撤销结果
+        try:
+            algo_orders = [order for order in self.fetch_conditional_orders() if 'algoId' in order.get('info', {})]
+        except Exception as e:
+            logger.warning(f"获取算法条件单失败，改为逐单撤销: {e}")
+            return False
+        
+        try:
+            self.exchange.fapiPrivateDeleteAlgoOpenOrders({'symbol': market_id})
+            result['cancelled'].extend(str(order['id']) for order in algo_orders)
+        except Exception as e:
+            logger.warning(f"整单撤销算法条件单失败，改为逐单撤销: {e}")
+            success = False
+        
+        try:
+            regular = [
+                order for order in self.exchange.fetch_open_orders(self.symbol)
+                if 'algoId' not in order.get('info', {})
+            ]
+        except Exception as e:
+            logger.warning(f"获取普通挂单失败，改为逐单撤销: {e}")
+            return False
+        
+        conditional = [order for order in regular if self._is_conditional(order)]
+        if conditional and len(conditional) == len(regular) and hasattr(self.exchange, 'fapiPrivateDeleteAllOpenOrders'):
+            try:
+                self.exchange.fapiPrivateDeleteAllOpenOrders({'symbol': market_id})
+                result['cancelled'].extend(str(order['id']) for order in conditional)
+            except Exception as e:
+                logger.warning(f"整单撤销普通挂单失败，改为逐单撤销: {e}")
+                success = False
+        elif conditional:
+            logger.info(f"存在 {len(regular) - len(conditional)} 个非条件挂单，普通条件单改为批量撤销")
+            self._cancel_orders(conditional, result)
+            success = success and not result['failed']
+        
+        if success:
+            result['method'] = 'cancel_all'
+            result['all'] = True
+            logger.info("已整单撤销全部条件订单")
+        return success
     
-    def create_market_order(self, side: str, amount: float, reduce_only: bool = False) -> Optional[Dict]:
+    def _cancel_orders(self, orders: List[Dict], result: Dict):
+        """普通单按10个一批批量撤销，算法单及批量失败的订单逐笔撤销"""
+        regular = [order for order in orders if 'algoId' not in order.get('info', {})]
+        singles = [order for order in orders if 'algoId' in order.get('info', {})]
+        result['method'] = 'single'
+        
+        if regular and hasattr(self.exchange, 'fapiPrivateDeleteBatchOrders'):
+            market_id = self.exchange.market_id(self.symbol)
+            for i in range(0, len(regular), 10):
+                chunk = regular[i:i + 10]
+                try:
+                    response = self.exchange.fapiPrivateDeleteBatchOrders({
+                        'symbol': market_id,
+                        'orderIdList': self.exchange.json([int(order['id']) for order in chunk])
+                    })
+                    for order, item in zip(chunk, response):
+                        if isinstance(item, dict) and item.get('orderId') is not None:
+                            result['cancelled'].append(str(order['id']))
+                        else:
+                            result['failed'][str(order['id'])] = (item or {}).get('msg', '未知错误')
+                    result['method'] = 'batch'
+                except Exception as e:
+                    logger.warning(f"批量撤销失败，改为逐笔撤销: {e}")
+                    singles.extend(chunk)
+        else:
+            singles.extend(regular)
+        
+        # 同一ccxt实例的会话与限频状态不是线程安全的，逐笔撤销按顺序执行
+        for order in singles:
+            order_id = str(order['id'])
+            try:
+                self.exchange.cancel_order(order['id'], self.symbol, params={'stop': True})
+                result['cancelled'].append(order_id)
+            except Exception as e:
+                logger.error(f"取消订单 {order_id} 失败: {e}")
+                result['failed'][order_id] = str(e)
+    
+    def fetch_conditional_orders(self) -> List[Dict]:
+        """获取未成交条件单（推送镜像可用时直接读内存）"""
+        stream = self.account_state.stream if self.account_state else None
+        if stream and stream.is_live():
+            return stream.get_open_orders()
+        
+        params = {'stop': True}  # 获取条件订单
+        return self.exchange.fetch_open_orders(self.symbol, params=params)
+    
+    def create_market_order(self, side: str, amount: float, reduce_only: bool = False,
+                            params: Dict = None) -> Optional[Dict]:
         """创建市价订单"""
         try:
-            params = {}
+            params = dict(params or {})
             if reduce_only:
                 params['reduceOnly'] = True
             
+            sent_at = time.time()
             order = self.exchange.create_order(
                 symbol=self.symbol,
                 type='market',
@@ -654,6 +1427,10 @@ class OrderManager:
             )
             
             logger.info(f"市价订单创建成功: {side} {amount} {self.symbol}")
+            
+            # 成交后余额和持仓已变化
+            if self.account_state:
+                self.account_state.invalidate("市价单成交", since=sent_at)
             return order
             
         except Exception as e:
@@ -700,6 +1477,7 @@ class OrderManager:
                 price=None,
                 params={
                     'takeProfitPrice': take_profit_price,
+                    'reduceOnly': True,   # 只减仓，避免无持仓时触发反向开仓
                     'timeInForce': 'GTC'  # 一直有效直至取消
                 }
             )
@@ -711,47 +1489,300 @@ class OrderManager:
             logger.error(f"创建止盈订单失败: {e}")
             return None
     
-    def setup_stop_loss_take_profit(self, position_side: str, position_size: float, 
-                                   stop_loss_price: float, take_profit_price: float) -> bool:
-        """设置止盈止损"""
-        try:
-            logger.info(f"设置止盈止损: {position_side} {position_size}张")
-            
-            # 先取消现有条件订单
-            self.cancel_existing_orders()
-            
-            # 创建止损订单
-            stop_order = self.create_stop_loss_order(position_side, position_size, stop_loss_price)
-            if not stop_order:
-                logger.error("止损订单创建失败")
-                return False
+    @staticmethod
+    def _normalize_side(position_side: str) -> str:
+        """持仓方向统一为 long/short（信号方向 buy/sell 也可传入）"""
+        return 'long' if position_side.lower() in ('long', 'buy') else 'short'
+    
+    def _bracket_legs(self, side: str, amount: float, stop_price: float, take_profit_price: float) -> List[Dict]:
+        """构建batchOrders的止损、止盈两条腿（交易所原始参数格式）"""
+        market_id = self.exchange.market_id(self.symbol)
+        exit_side = 'SELL' if side == 'long' else 'BUY'
+        working_type = self.config.order_config['working_type']
+        
+        return [
+            {
+                'symbol': market_id,
+                'side': exit_side,
+                'type': 'STOP_MARKET',
+                'stopPrice': self.exchange.price_to_precision(self.symbol, stop_price),
+                'closePosition': 'true',
+                'workingType': working_type,
+                'priceProtect': 'TRUE'
+            },
+            {
+                'symbol': market_id,
+                'side': exit_side,
+                'type': 'TAKE_PROFIT_MARKET',
+                'stopPrice': self.exchange.price_to_precision(self.symbol, take_profit_price),
+                'quantity': self.exchange.amount_to_precision(self.symbol, amount),
+                'reduceOnly': 'true',
+                'workingType': working_type,
+                'timeInForce': 'GTC'
+            }
+        ]
+    
+    def _submit_batch(self, legs: List[Dict]) -> List[Tuple[Optional[Dict], Optional[Dict]]]:
+        """
+        一次请求提交多条腿
+        
+        Returns:
+            每条腿的 (订单, 错误)，错误格式 {'code', 'msg'}
+        """
+        response = self.exchange.fapiPrivatePostBatchOrders({'batchOrders': self.exchange.json(legs)})
+        
+        results = []
+        for leg, item in zip(legs, response):
+            if isinstance(item, dict) and item.get('orderId') is not None:
+                results.append(({
+                    'id': str(item['orderId']),
+                    'type': leg['type'],
+                    'side': leg['side'].lower(),
+                    'stopPrice': float(item.get('stopPrice') or leg['stopPrice']),
+                    'info': item
+                }, None))
+            else:
+                item = item if isinstance(item, dict) else {}
+                results.append((None, {'code': item.get('code'), 'msg': item.get('msg', '未知错误')}))
+        return results
+    
+    def _place_legs(self, side: str, amount: float, prices: Dict[str, float],
+                    names: List[str]) -> Dict[str, Optional[Dict]]:
+        """逐条腿单笔下单（走交易所条件单接口，止损在前）"""
+        creators = {
+            'stop_loss': self.create_stop_loss_order,
+            'take_profit': self.create_take_profit_order
+        }
+        return {name: creators[name](side, amount, prices[name]) for name in names}
+    
+    def place_bracket(self, position_side: str, amount: float,
+                      stop_loss_price: float, take_profit_price: float) -> Dict:
+        """
+        挂止损止盈组合单
+        
+        优先一次batchOrders请求提交两条腿；失败的腿单独重试一次；
+        仍失败时按 bracket_rollback 处理另一条腿
+        
+        Returns:
+            {'stop_loss': 订单或None, 'take_profit': 订单或None, 'errors': {腿: 错误}, 'method': 'batch'|'single'}
+        """
+        side = self._normalize_side(position_side)
+        prices = {'stop_loss': stop_loss_price, 'take_profit': take_profit_price}
+        result = {'stop_loss': None, 'take_profit': None, 'errors': {}, 'method': 'single'}
+        names = ['stop_loss', 'take_profit']
+        
+        if self.config.order_config['bracket_batch'] and self.batch_supported:
+            try:
+                legs = self._bracket_legs(side, amount, stop_loss_price, take_profit_price)
+                for name, (order, error) in zip(names, self._submit_batch(legs)):
+                    result[name] = order
+                    if error:
+                        result['errors'][name] = error
+                result['method'] = 'batch'
+                
+                # 条件单已迁移到算法单接口的账户，批量接口会整体拒绝，之后改用单笔下单
+                if not result['stop_loss'] and not result['take_profit'] and \
+                        any(error.get('code') == -4120 for error in result['errors'].values()):
+                    logger.warning("批量接口不支持条件单，改用单笔下单")
+                    self.batch_supported = False
+                    result['method'] = 'single'
+                    
+            except Exception as e:
+                logger.error(f"批量提交止盈止损失败: {e}")
+                result['errors']['batch'] = {'code': None, 'msg': str(e)}
+        
+        # 失败的腿（或未走批量时的全部腿）逐条单独下单
+        missing = [name for name in names if not result[name]]
+        if missing:
+            for name in missing:
+                if name in result['errors']:
+                    logger.warning(f"{name} 提交失败: {result['errors'][name].get('msg')}，单独重试")
+            for name, order in self._place_legs(side, amount, prices, missing).items():
+                result[name] = order
+                if order:
+                    result['errors'].pop(name, None)
+                else:
+                    result['errors'].setdefault(name, {'code': None, 'msg': '单独下单失败'})
+        
+        self._apply_rollback(result)
+        return result
+    
+    def _apply_rollback(self, result: Dict):
+        """某条腿最终失败时按策略处理另一条腿"""
+        if result['stop_loss'] and result['take_profit']:
+            return
+        
+        policy = self.config.order_config['bracket_rollback']
+        if not result['stop_loss']:
+            logger.error("止损单最终失败，持仓无止损保护！")
+        
+        if policy == 'all_or_none':
+            for name in ('stop_loss', 'take_profit'):
+                order = result[name]
+                if order:
+                    try:
+                        self.exchange.cancel_order(order['id'], self.symbol, params={'stop': True})
+                        logger.info(f"回滚: 已撤销 {name} 订单 {order['id']}")
+                    except Exception as e:
+                        logger.error(f"回滚撤销 {name} 订单失败: {e}")
+                    result[name] = None
+        elif result['stop_loss']:
+            logger.warning("止盈单失败，保留止损单")
+    
+    @staticmethod
+    def _order_leg(order: Dict) -> Tuple[Optional[str], float, float]:
+        """
+        识别条件单属于哪条腿
+        
+        Returns:
+            ('stop_loss'|'take_profit'|None, 触发价, 数量（closePosition为0）)
+        """
+        info = order.get('info', {})
+        raw_type = str(info.get('type') or info.get('orderType') or order.get('type') or '').upper()
+        trigger = (order.get('stopPrice') or order.get('triggerPrice') or info.get('stopPrice') or
+                   info.get('triggerPrice') or order.get('takeProfitPrice') or order.get('stopLossPrice') or 0)
+        amount = 0.0 if info.get('closePosition') == 'true' else float(order.get('amount') or 0)
+        
+        if 'TAKE_PROFIT' in raw_type or order.get('takeProfitPrice'):
+            return 'take_profit', float(trigger), amount
+        if 'STOP' in raw_type and 'TRAILING' not in raw_type:
+            return 'stop_loss', float(trigger), amount
+        return None, float(trigger), amount
+    
+    def _create_leg(self, leg: str, side: str, amount: float, price: float) -> Optional[Dict]:
+        """
+        单独创建一条腿
+        
+        止损用reduceOnly按数量挂单：交易所不允许同方向同时存在两张closePosition止损，
+        先建后撤替换时新旧止损需要短暂共存
+        """
+        if leg == 'take_profit':
+            return self.create_take_profit_order(side, amount, price)
+        
+        try:
+            order = self.exchange.create_order(
+                symbol=self.symbol,
+                type='STOP_MARKET',
+                side='sell' if side == 'long' else 'buy',
+                amount=amount,
+                price=None,
+                params={
+                    'stopPrice': price,
+                    'reduceOnly': True,
+                    'workingType': self.config.order_config['working_type'],
+                    'priceProtect': True
+                }
+            )
+            logger.info(f"止损订单创建成功: {price}")
+            return order
+        except Exception as e:
+            logger.error(f"创建止损订单失败: {e}")
+            return None
+    
+    def reconcile_bracket(self, position_side: str, amount: float,
+                          stop_loss_price: Optional[float], take_profit_price: Optional[float]) -> Dict:
+        """
+        按差异调整止损止盈
+        
+        对比目标（方向、数量、止损、止盈，价格容差内视为一致）与现有条件单，只做最少的操作：
+        一致的腿保留；缺失或偏离的腿先建新单再撤旧单（交易所不支持修改条件单），全程不出现无保护窗口。
+        目标价为None的腿不管理：不新建，现有的该腿条件单原样保留
+        
+        Returns:
+            {'kept': [订单ID], 'created': {腿: 订单}, 'cancelled': [订单ID], 'failed': {键: 错误}}
+        """
+        with self.bracket_lock:
+            return self._reconcile_bracket(position_side, amount, stop_loss_price, take_profit_price)
+    
+    def _reconcile_bracket(self, position_side: str, amount: float,
+                           stop_loss_price: Optional[float], take_profit_price: Optional[float]) -> Dict:
+        side = self._normalize_side(position_side)
+        exit_side = 'sell' if side == 'long' else 'buy'
+        tolerance = self.config.order_config['bracket_tolerance_pct'] / 100
+        targets = {'stop_loss': stop_loss_price, 'take_profit': take_profit_price}
+        result = {'kept': [], 'created': {}, 'cancelled': [], 'failed': {}}
+        
+        live_orders = [order for order in self.fetch_conditional_orders() if self._is_conditional(order)]
+        
+        matched = {}
+        stale = []
+        for order in live_orders:
+            leg, trigger, order_amount = self._order_leg(order)
+            target = targets.get(leg)
+            if leg is not None and not target:
+                continue
+            is_match = (
+                leg is not None and leg not in matched and
+                order.get('side', '').lower() == exit_side and
+                abs(trigger - target) <= target * tolerance and
+                (order_amount == 0 or abs(order_amount - amount) < (self.config.min_amount or 1e-9))
+            )
+            if is_match:
+                matched[leg] = order
+                result['kept'].append(str(order['id']))
+            else:
+                stale.append(order)
+        
+        # 先补齐缺失的腿
+        missing = [leg for leg in ('stop_loss', 'take_profit') if targets[leg] and leg not in matched]
+        if len(missing) == 2 and not live_orders:
+            # 没有任何现有条件单，直接批量挂单
+            bracket = self.place_bracket(side, amount, stop_loss_price, take_profit_price)
+            for leg in missing:
+                if bracket[leg]:
+                    result['created'][leg] = bracket[leg]
+                else:
+                    result['failed'][leg] = bracket['errors'].get(leg, {}).get('msg', '下单失败')
+        elif missing:
+            # 同一ccxt实例不是线程安全的，逐条下单（止损在前）
+            for leg in missing:
+                order = self._create_leg(leg, side, amount, targets[leg])
+                if order:
+                    result['created'][leg] = order
+                else:
+                    result['failed'][leg] = '下单失败'
+        
+        # 新单挂好后再撤旧单；新止损没挂上时保留旧止损，避免裸仓
+        to_cancel = [
+            order for order in stale
+            if not (self._order_leg(order)[0] == 'stop_loss' and 'stop_loss' in result['failed'])
+        ]
+        if to_cancel:
+            cancelled = {'method': None, 'cancelled': [], 'failed': {}, 'all': False}
+            self._cancel_orders(to_cancel, cancelled)
+            result['cancelled'] = cancelled['cancelled']
+            result['failed'].update(cancelled['failed'])
+        
+        logger.info(f"止盈止损对账: 保留 {len(result['kept'])}, 新建 {len(result['created'])}, "
+                    f"撤销 {len(result['cancelled'])}, 失败 {len(result['failed'])}")
+        return result
+    
+    def setup_stop_loss_take_profit(self, position_side: str, position_size: float, 
+                                   stop_loss_price: float, take_profit_price: float,
+                                   current_price: float = None) -> bool:
+        """设置止盈止损（按差异调整现有条件单）"""
+        try:
+            logger.info(f"设置止盈止损: {position_side} {position_size}张")
             
-            # 创建止盈订单
-            tp_order = self.create_take_profit_order(position_side, position_size, take_profit_price)
-            if not tp_order:
-                logger.error("止盈订单创建失败")
-                # 尝试取消已创建的止损订单
-                try:
-                    self.exchange.cancel_order(stop_order['id'], self.symbol, params={'stop': True})
-                except:
-                    pass
+            result = self.reconcile_bracket(position_side, position_size, stop_loss_price, take_profit_price)
+            if result['failed'].get('stop_loss') or result['failed'].get('take_profit'):
+                logger.error(f"止盈止损设置失败: {result['failed']}")
                 return False
             
-            # 获取当前价格
-            ticker = self.exchange.fetch_ticker(self.symbol)
-            current_price = ticker['last']
-            
-            # 计算价格距离
-            stop_distance_pct = abs((stop_loss_price - current_price) / current_price * 100)
-            tp_distance_pct = abs((take_profit_price - current_price) / current_price * 100)
+            # 价格距离（使用调用方传入的当前价，不再单独请求行情）
+            distance_text = ""
+            if current_price:
+                stop_distance_pct = abs((stop_loss_price - current_price) / current_price * 100)
+                tp_distance_pct = abs((take_profit_price - current_price) / current_price * 100)
+                distance_text = f"当前价: ${current_price:.2f}, 止损距离 {stop_distance_pct:.1f}%, 止盈距离 {tp_distance_pct:.1f}%"
             
             logger.info(f"""
-            止盈止损设置成功:
-            方向: {position_side}
+            止盈止损设置成功 (保留{len(result['kept'])} 新建{len(result['created'])} 撤销{len(result['cancelled'])}):
+            方向: {self._normalize_side(position_side)}
             数量: {position_size:.2f}张
-            当前价: ${current_price:.2f}
-            止损: ${stop_loss_price:.2f} ({stop_distance_pct:.1f}%)
-            止盈: ${take_profit_price:.2f} ({tp_distance_pct:.1f}%)
+            止损: ${stop_loss_price:.2f}
+            止盈: ${take_profit_price:.2f}
+            {distance_text}
             """)
             
             return True
@@ -760,6 +1791,1274 @@ class OrderManager:
             logger.error(f"设置止盈止损失败: {e}")
             return False
 
+class TrailingStopEngine:
+    """本地分档移动止损（标记价格推送驱动，不经过AI；止损只收紧不放宽，经对账器节流改单）"""
+    
+    def __init__(self, exchange, order_manager: OrderManager, account_state: AccountStateService,
+                 config: TradeConfig, metrics: PerformanceMetrics = None):
+        self.exchange = exchange
+        self.order_manager = order_manager
+        self.account_state = account_state
+        self.symbol = config.symbol
+        self.trailing_config = config.trailing_config
+        self.stream_config = config.stream_config
+        self.metrics = metrics
+        
+        # 跟踪状态：推送线程写价格，改单线程读，统一由condition保护
+        self.condition = threading.Condition()
+        self.position = None           # {'side', 'size', 'entry_price'}
+        self.atr = 0.0
+        self.stop_loss = None
+        self.take_profit = None
+        self.best_price = None         # 持仓期间最有利的标记价格
+        self.mark_price = None
+        self.mark_time = 0.0
+        self.last_move_time = 0.0
+        self.paused = False            # 交易周期下单期间暂停，周期同步后恢复
+        
+        self.ws_app = None
+        self.thread = None
+        self.worker = None
+        self.is_running = False
+        self.connected = False
+        self.last_message_time = 0.0
+        self.reconnect_count = 0
+        self.reconnect_delay = self.stream_config['reconnect_delay']
+    
+    def _stream_url(self) -> str:
+        """构建标记价格订阅地址"""
+        try:
+            market_id = self.exchange.market_id(self.symbol)
+        except Exception:
+            market_id = self.symbol.split(':')[0].replace('/', '')
+        return f"{self.stream_config['ws_base_url']}/{market_id.lower()}@{self.trailing_config['stream_suffix']}"
+    
+    def start(self) -> bool:
+        """启动标记价格推送和改单线程"""
+        if websocket is None:
+            logger.warning("未安装websocket-client，移动止损不可用")
+            return False
+        
+        if self.is_running:
+            return True
+        
+        self.is_running = True
+        self.thread = threading.Thread(target=self._run, name="trailing-stream", daemon=True)
+        self.thread.start()
+        self.worker = threading.Thread(target=self._work, name="trailing-worker", daemon=True)
+        self.worker.start()
+        tiers = ", ".join(f"{threshold:g}%→{multiple:g}ATR" for threshold, multiple in self.trailing_config['tiers'])
+        logger.info(f"移动止损已启动: {self._stream_url()} 档位 {tiers}")
+        return True
+    
+    def stop(self):
+        """停止推送和改单线程"""
+        self.is_running = False
+        with self.condition:
+            self.condition.notify_all()
+        if self.ws_app:
+            try:
+                self.ws_app.close()
+            except Exception:
+                pass
+        logger.info("移动止损已停止")
+    
+    def is_live(self) -> bool:
+        """推送连接正常且价格新鲜"""
+        is_fresh = time.time() - self.last_message_time < self.stream_config['stale_seconds']
+        return self.is_running and self.connected and is_fresh
+    
+    def pause(self):
+        """交易周期下单前暂停跟踪，避免用旧的持仓和止盈改单"""
+        with self.condition:
+            self.paused = True
+    
+    def resume(self):
+        """解除暂停（周期同步失败时沿用已跟踪的状态继续）"""
+        with self.condition:
+            self.paused = False
+            self.condition.notify_all()
+    
+    def sync(self, position: Optional[Dict], atr: float, stop_loss: float = None, take_profit: float = None):
+        """
+        同步持仓与止损止盈（每个交易周期下单后调用，同时解除暂停）
+        
+        未传入止损止盈时沿用已跟踪的价格，首次跟踪则从现有条件单读取
+        """
+        if not position or position.get('size', 0) <= 0:
+            with self.condition:
+                self.paused = False
+                if self.position:
+                    logger.info("已无持仓，移动止损暂停跟踪")
+                self.position = None
+                self.best_price = None
+                self.stop_loss = None
+                self.take_profit = None
+            return
+        
+        side = self.order_manager._normalize_side(position['side'])
+        entry_price = float(position['entry_price'])
+        
+        with self.condition:
+            is_new = not self.position or self.position['side'] != side
+            needs_levels = (stop_loss is None or take_profit is None) and (is_new or self.stop_loss is None)
+        
+        if needs_levels:
+            live_stop, live_target = self._load_levels(side)
+            stop_loss = stop_loss or live_stop
+            take_profit = take_profit or live_target
+        
+        with self.condition:
+            if is_new:
+                self.best_price = entry_price
+                self.stop_loss = None
+                self.take_profit = None
+            self.position = {'side': side, 'size': float(position['size']), 'entry_price': entry_price}
+            if atr and atr > 0:
+                self.atr = atr
+            if stop_loss:
+                self.stop_loss = stop_loss
+            if take_profit:
+                self.take_profit = take_profit
+            self.paused = False
+            self.condition.notify_all()
+    
+    def tighten_stop(self, side: str, stop_loss: float) -> float:
+        """新信号与跟踪持仓同向时，取信号止损与已移动止损中更紧的一个，避免周期下单把止损放宽"""
+        with self.condition:
+            if not self.position or self.stop_loss is None:
+                return stop_loss
+            if self.position['side'] != self.order_manager._normalize_side(side):
+                return stop_loss
+            if self.position['side'] == 'long':
+                return max(stop_loss, self.stop_loss)
+            return min(stop_loss, self.stop_loss)
+    
+    def _load_levels(self, side: str) -> Tuple[Optional[float], Optional[float]]:
+        """从现有条件单读取止损止盈价格"""
+        exit_side = 'sell' if side == 'long' else 'buy'
+        levels = {}
+        try:
+            for order in self.order_manager.fetch_conditional_orders():
+                leg, trigger, _ = self.order_manager._order_leg(order)
+                if leg and trigger and order.get('side', '').lower() == exit_side:
+                    levels.setdefault(leg, trigger)
+        except Exception as e:
+            logger.error(f"读取现有止损止盈失败: {e}")
+        return levels.get('stop_loss'), levels.get('take_profit')
+    
+    def _target_stop(self) -> Optional[float]:
+        """
+        按当前档位计算新止损（调用方持有condition）
+        
+        档位只按相对入场价的盈利激活，与是否挂有止盈单无关；没有止损单时激活后直接挂出新止损
+        
+        Returns:
+            需要上移（空头为下移）的新止损价，无需改单时返回None
+        """
+        position = self.position
+        if self.paused or not position or not self.mark_price or not self.atr:
+            return None
+        
+        entry_price = position['entry_price']
+        is_long = position['side'] == 'long'
+        direction = 1 if is_long else -1
+        profit_pct = (self.best_price - entry_price) / entry_price * 100 * direction
+        
+        multiple = None
+        for threshold, tier_multiple in self.trailing_config['tiers']:
+            if profit_pct >= threshold:
+                multiple = tier_multiple
+        if multiple is None:
+            return None
+        
+        target = self.best_price - direction * self.atr * multiple
+        if self.trailing_config['lock_breakeven']:
+            target = max(target, entry_price) if is_long else min(target, entry_price)
+        
+        # 只在有效改善时改单，且新止损不能越过当前价（否则挂单即触发）
+        if self.stop_loss:
+            min_step = self.stop_loss * self.trailing_config['min_step_pct'] / 100
+            if (target - self.stop_loss) * direction < min_step:
+                return None
+        if (self.mark_price - target) * direction <= 0:
+            return None
+        return target
+    
+    def _work(self):
+        """改单线程：每次价格更新后重新计算，按最小间隔节流"""
+        pending = False
+        while self.is_running:
+            with self.condition:
+                if not pending:
+                    self.condition.wait(timeout=1)
+                target = self._target_stop()
+                throttle = self.last_move_time + self.trailing_config['min_interval'] - time.time()
+                tick_time = self.mark_time
+            
+            pending = False
+            if target is None:
+                continue
+            if throttle > 0:
+                # 节流结束后按最新价格立即重新计算，不等下一次推送
+                time.sleep(throttle)
+                pending = True
+                continue
+            
+            self._move_stop(target, tick_time)
+    
+    def _move_stop(self, target: float, tick_time: float):
+        """通过对账器移动交易所止损（止盈不变，没有止盈时只管理止损腿；先建新止损再撤旧止损）"""
+        start = time.time()
+        
+        # 持有止损止盈锁：确认持仓和改单之间交易周期不会开平仓或反手
+        with self.order_manager.bracket_lock:
+            with self.condition:
+                if self.paused or not self.position:
+                    return
+                tracked = dict(self.position)
+                take_profit = self.take_profit
+                previous = self.stop_loss
+            
+            # 以账户镜像确认持仓仍在，止损已触发或已反手时停止跟踪
+            position = self.account_state.get_position() if self.account_state else tracked
+            if not position or self.order_manager._normalize_side(position['side']) != tracked['side']:
+                self.sync(position, self.atr)
+                return
+            
+            try:
+                result = self.order_manager.reconcile_bracket(tracked['side'], float(position['size']),
+                                                              target, take_profit)
+                success = not result['failed'].get('stop_loss')
+            except Exception as e:
+                logger.error(f"移动止损改单失败: {e}")
+                success = False
+        
+        with self.condition:
+            self.last_move_time = time.time()
+            if success:
+                self.stop_loss = target
+        
+        if self.metrics:
+            self.metrics.record('trailing.reconcile', time.time() - start)
+            if success:
+                self.metrics.increment('trailing.moves')
+                self.metrics.record('trailing.reaction', time.time() - tick_time)
+            else:
+                self.metrics.increment('trailing.failures')
+        
+        if success:
+            previous_text = f"{previous:.2f}" if previous else "无"
+            logger.info(f"📈 移动止损: {tracked['side']} {previous_text} → {target:.2f} "
+                        f"(最优价 {self.best_price:.2f}, ATR {self.atr:.3f})")
+        else:
+            logger.warning(f"移动止损失败，{self.trailing_config['min_interval']}秒后重试: 目标 {target:.2f}")
+    
+    def _run(self):
+        """推送主循环（断线自动重连，连接成功后重置退避）"""
+        while self.is_running:
+            try:
+                self.ws_app = websocket.WebSocketApp(
+                    self._stream_url(),
+                    on_open=self._on_open,
+                    on_message=self._on_message,
+                    on_error=self._on_error,
+                    on_close=self._on_close
+                )
+                self.ws_app.run_forever(ping_interval=self.stream_config['ping_interval'])
+                
+            except Exception as e:
+                logger.error(f"标记价格推送异常: {e}")
+            
+            self.connected = False
+            if not self.is_running:
+                break
+            
+            # 指数退避重连
+            self.reconnect_count += 1
+            logger.warning(f"标记价格推送断开，{self.reconnect_delay}秒后重连 (第{self.reconnect_count}次)")
+            time.sleep(self.reconnect_delay)
+            self.reconnect_delay = min(self.reconnect_delay * 2, self.stream_config['max_reconnect_delay'])
+        
+        self.connected = False
+    
+    def _on_open(self, ws):
+        self.connected = True
+        self.last_message_time = time.time()
+        self.reconnect_delay = self.stream_config['reconnect_delay']
+        logger.info(f"标记价格推送连接成功: {self.symbol}")
+    
+    def _on_error(self, ws, error):
+        logger.error(f"标记价格推送错误: {error}")
+    
+    def _on_close(self, ws, status_code, message):
+        self.connected = False
+        logger.warning(f"标记价格推送连接关闭: {status_code} {message}")
+    
+    def _on_message(self, ws, message: str):
+        """处理标记价格推送，更新持仓最优价"""
+        try:
+            data = json.loads(message)
+            if data.get('e') != 'markPriceUpdate':
+                return
+            
+            price = float(data['p'])
+            now = time.time()
+            self.last_message_time = now
+            
+            with self.condition:
+                self.mark_price = price
+                self.mark_time = now
+                if self.position and self.best_price is not None:
+                    if self.position['side'] == 'long':
+                        self.best_price = max(self.best_price, price)
+                    else:
+                        self.best_price = min(self.best_price, price)
+                self.condition.notify_all()
+                
+        except Exception as e:
+            logger.error(f"处理标记价格推送失败: {e}")
+
+class CandleRingBuffer:
+    """定长K线环形缓冲区（numpy数组，镜像双写保证窗口视图连续、零拷贝）"""
+    
+    COLUMNS = ['timestamp', 'open', 'high', 'low', 'close', 'volume']
+    
+    def __init__(self, capacity: int, columns: List[str] = None):
+        self.capacity = capacity
+        self.columns = columns or self.COLUMNS
+        # 每行同时写入 pos 和 pos+capacity，任意窗口都是连续切片
+        self._data = np.full((capacity * 2, len(self.columns)), np.nan)
+        self._start = 0
+        self._size = 0
+        self.lock = threading.Lock()
+    
+    def __len__(self) -> int:
+        return self._size
+    
+    @property
+    def last_timestamp(self) -> Optional[float]:
+        """最后一根K线的开盘时间（毫秒）"""
+        if self._size == 0:
+            return None
+        return float(self._data[self._start + self._size - 1, 0])
+    
+    def _write(self, pos: int, row):
+        self._data[pos] = row
+        self._data[pos + self.capacity] = row
+    
+    def upsert(self, rows) -> Tuple[int, int]:
+        """
+        合并K线（时间戳升序）
+        
+        Args:
+            rows: 行数据列表（首列为时间戳，默认 [timestamp, open, high, low, close, volume]）
+            
+        Returns:
+            (新增根数, 原地更新根数)
+        """
+        appended = 0
+        updated = 0
+        
+        with self.lock:
+            for row in rows:
+                ts = float(row[0])
+                last_ts = self.last_timestamp
+                
+                if last_ts is not None and ts < last_ts:
+                    # 早于末尾的旧K线忽略
+                    continue
+                
+                if last_ts is not None and ts == last_ts:
+                    # 未收盘K线原地更新
+                    self._write((self._start + self._size - 1) % self.capacity, row)
+                    updated += 1
+                    continue
+                
+                if self._size < self.capacity:
+                    pos = (self._start + self._size) % self.capacity
+                    self._size += 1
+                else:
+                    pos = self._start
+                    self._start = (self._start + 1) % self.capacity
+                self._write(pos, row)
+                appended += 1
+        
+        return appended, updated
+    
+    def clear(self):
+        """清空缓冲区"""
+        with self.lock:
+            self._start = 0
+            self._size = 0
+    
+    def view(self, limit: int = None) -> np.ndarray:
+        """
+        最近limit根K线的只读视图（不拷贝）
+        
+        注意：视图与缓冲区共享内存，后续写入（包括未收盘K线更新）会反映到视图中
+        """
+        with self.lock:
+            size = self._size if limit is None else min(limit, self._size)
+            end = self._start + self._size
+            window = self._data[end - size:end]
+        window = window.view()
+        window.flags.writeable = False
+        return window
+    
+    def column(self, name: str, limit: int = None) -> np.ndarray:
+        """单列视图"""
+        return self.view(limit)[:, self.columns.index(name)]
+
+class KlineStreamFeed:
+    """Binance合约K线推送（WebSocket订阅，内存维护K线窗口，断线/缺口时REST补齐）"""
+    
+    def __init__(self, exchange, symbol: str, timeframe: str, window: int, stream_config: Dict):
+        self.exchange = exchange
+        self.symbol = symbol
+        self.timeframe = timeframe
+        self.window = window
+        self.stream_config = stream_config
+        self.timeframe_ms = exchange.parse_timeframe(timeframe) * 1000
+        
+        self.buffer = CandleRingBuffer(window)
+        self.ws_app = None
+        self.thread = None
+        self.is_running = False
+        self.connected = False
+        self.last_message_time = 0.0
+        self.reconnect_count = 0
+        self.backfill_count = 0
+    
+    def _stream_url(self) -> str:
+        """构建K线订阅地址"""
+        try:
+            market_id = self.exchange.market_id(self.symbol)
+        except Exception:
+            market_id = self.symbol.split(':')[0].replace('/', '')
+        return f"{self.stream_config['ws_base_url']}/{market_id.lower()}@kline_{self.timeframe}"
+    
+    def start(self) -> bool:
+        """启动推送线程"""
+        if websocket is None:
+            logger.warning("未安装websocket-client，K线推送不可用，继续使用REST轮询")
+            return False
+        
+        if self.is_running:
+            return True
+        
+        self.is_running = True
+        self.thread = threading.Thread(target=self._run, name=f"kline-{self.timeframe}", daemon=True)
+        self.thread.start()
+        logger.info(f"K线推送已启动: {self._stream_url()}")
+        return True
+    
+    def stop(self):
+        """停止推送"""
+        self.is_running = False
+        if self.ws_app:
+            try:
+                self.ws_app.close()
+            except Exception:
+                pass
+        logger.info("K线推送已停止")
+    
+    def is_ready(self) -> bool:
+        """连接正常、数据新鲜且窗口已填满"""
+        has_window = len(self.buffer) >= self.window
+        is_fresh = time.time() - self.last_message_time < self.stream_config['stale_seconds']
+        return self.connected and has_window and is_fresh
+    
+    def get_candles(self) -> Optional[np.ndarray]:
+        """获取当前K线窗口快照（未就绪时返回None，由调用方回退REST）"""
+        if not self.is_ready():
+            return None
+        # 推送线程会原地更新未收盘K线，这里取一份快照避免读到半更新的行
+        return self.buffer.view(self.window).copy()
+    
+    def _run(self):
+        """推送主循环（断线自动重连，重连前REST补齐）"""
+        delay = self.stream_config['reconnect_delay']
+        
+        while self.is_running:
+            try:
+                self._backfill()
+                
+                self.ws_app = websocket.WebSocketApp(
+                    self._stream_url(),
+                    on_open=self._on_open,
+                    on_message=self._on_message,
+                    on_error=self._on_error,
+                    on_close=self._on_close
+                )
+                self.ws_app.run_forever(ping_interval=self.stream_config['ping_interval'])
+                
+            except Exception as e:
+                logger.error(f"K线推送异常: {e}")
+            
+            self.connected = False
+            if not self.is_running:
+                break
+            
+            # 指数退避重连
+            self.reconnect_count += 1
+            logger.warning(f"K线推送断开，{delay}秒后重连 (第{self.reconnect_count}次)")
+            time.sleep(delay)
+            delay = min(delay * 2, self.stream_config['max_reconnect_delay'])
+        
+        self.connected = False
+    
+    def _on_open(self, ws):
+        self.connected = True
+        self.last_message_time = time.time()
+        logger.info(f"K线推送连接成功: {self.symbol} {self.timeframe}")
+    
+    def _on_error(self, ws, error):
+        logger.error(f"K线推送错误: {error}")
+    
+    def _on_close(self, ws, status_code, message):
+        self.connected = False
+        logger.warning(f"K线推送连接关闭: {status_code} {message}")
+    
+    def _on_message(self, ws, message: str):
+        """处理K线推送消息"""
+        try:
+            data = json.loads(message)
+            kline = data.get('k')
+            if data.get('e') != 'kline' or not kline:
+                return
+            
+            self.last_message_time = time.time()
+            row = [
+                float(kline['t']),
+                float(kline['o']),
+                float(kline['h']),
+                float(kline['l']),
+                float(kline['c']),
+                float(kline['v'])
+            ]
+            
+            if not self._apply_candle(row):
+                # 出现缺口（断档/漏推），用REST补齐
+                logger.warning(f"K线推送出现缺口，REST补齐: {self.timeframe}")
+                self._backfill()
+                self._apply_candle(row)
+                
+        except Exception as e:
+            logger.error(f"处理K线推送失败: {e}")
+    
+    def _apply_candle(self, row: List[float]) -> bool:
+        """
+        合并一根K线
+        
+        Returns:
+            False表示与已有窗口之间存在缺口
+        """
+        last_ts = self.buffer.last_timestamp
+        if last_ts is None or row[0] > last_ts + self.timeframe_ms:
+            return False
+        
+        # 同一根K线原地更新，下一根追加，旧K线忽略
+        self.buffer.upsert([row])
+        return True
+    
+    def _backfill(self):
+        """REST补齐K线窗口"""
+        ohlcv = RetryManager.retry_operation(
+            lambda: self.exchange.fetch_ohlcv(self.symbol, self.timeframe, limit=self.window),
+            max_retries=3,
+            delay=1,
+            exponential_backoff=True
+        )
+        
+        if not ohlcv:
+            logger.error("K线REST补齐失败")
+            return
+        
+        self.buffer.upsert(ohlcv)
+        
+        self.backfill_count += 1
+        logger.info(f"K线REST补齐完成: {self.timeframe}, {len(ohlcv)} 条记录")
+
+def _safe_div(numerator: float, denominator: float) -> float:
+    """按numpy语义做除法（除零得inf/NaN，不抛异常）"""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return float(np.float64(numerator) / np.float64(denominator))
+
+class _RollingState:
+    """滚动窗口均值/标准差状态（维护窗口和与偏移平方和，定期精确重算抑制误差累积）"""
+    
+    def __init__(self, window: int, min_periods: int = None):
+        self.window = window
+        self.min_periods = window if min_periods is None else min_periods
+        self.values = deque()
+        self.anchor = 0.0
+        self.total = 0.0
+        self.shifted_sq = 0.0
+        self.nonzero = 0
+        self.pushes = 0
+    
+    def update(self, x: float, commit: bool = False) -> Tuple[float, float]:
+        """
+        加入x后的窗口 (均值, 样本标准差)
+        
+        commit=False 时只试算（未收盘K线），不修改状态
+        """
+        n = len(self.values)
+        anchor = self.anchor if n else x
+        total = self.total + x
+        shifted_sq = self.shifted_sq + (x - anchor) ** 2
+        nonzero = self.nonzero + (x != 0)
+        
+        if n == self.window:
+            old = self.values[0]
+            total -= old
+            shifted_sq -= (old - anchor) ** 2
+            nonzero -= (old != 0)
+        else:
+            n += 1
+        
+        if commit:
+            self.values.append(x)
+            if len(self.values) > self.window:
+                self.values.popleft()
+            self.anchor, self.total, self.shifted_sq, self.nonzero = anchor, total, shifted_sq, nonzero
+            self.pushes += 1
+            if self.pushes % self.window == 0:
+                self._resync()
+        
+        if n < self.min_periods:
+            return np.nan, np.nan
+        
+        mean = total / n if nonzero else 0.0
+        if n < 2:
+            return mean, np.nan
+        
+        shifted_mean = mean - anchor
+        variance = (shifted_sq - n * shifted_mean ** 2) / (n - 1)
+        return mean, math.sqrt(variance) if variance > 0 else 0.0
+    
+    def _resync(self):
+        """按窗口精确重算累计量"""
+        self.anchor = math.fsum(self.values) / len(self.values)
+        self.total = math.fsum(self.values)
+        self.shifted_sq = math.fsum((v - self.anchor) ** 2 for v in self.values)
+        self.nonzero = sum(1 for v in self.values if v != 0)
+
+class _RollingExtremeState:
+    """滚动窗口最大/最小值状态（单调队列，均摊O(1)）"""
+    
+    def __init__(self, window: int, use_max: bool = True):
+        self.window = window
+        self.sign = 1.0 if use_max else -1.0
+        self.queue = deque()  # (序号, 带符号值)，值单调递减
+        self.seq = 0
+    
+    def update(self, x: float, commit: bool = False) -> float:
+        """加入x后的窗口极值（窗口未满时返回NaN）"""
+        value = self.sign * x
+        count = min(self.seq, self.window)
+        
+        if not commit:
+            # 窗口已满时最旧值将被移出
+            oldest_seq = self.seq - self.window
+            best = value
+            for seq, v in self.queue:
+                if seq > oldest_seq:
+                    best = max(best, v)
+                    break
+            return self.sign * best if count + 1 >= self.window else np.nan
+        
+        while self.queue and self.queue[-1][1] <= value:
+            self.queue.pop()
+        self.queue.append((self.seq, value))
+        self.seq += 1
+        while self.queue[0][0] <= self.seq - 1 - self.window:
+            self.queue.popleft()
+        
+        return self.sign * self.queue[0][1] if count + 1 >= self.window else np.nan
+
+class _EMAState:
+    """指数移动平均状态（等价于 ewm(span, adjust=False)）"""
+    
+    def __init__(self, span: int):
+        self.alpha = 2.0 / (span + 1)
+        self.value = None
+    
+    def update(self, x: float, commit: bool = False) -> float:
+        value = x if self.value is None else self.alpha * x + (1 - self.alpha) * self.value
+        if commit:
+            self.value = value
+        return value
+
+class IncrementalIndicatorEngine:
+    """
+    增量技术指标引擎
+    
+    每根K线按O(1)更新各指标的运行状态：已收盘K线提交状态，未收盘K线只试算。
+    输出与 TechnicalAnalyzer.calculate_indicators 对同一段K线历史的批量计算结果一致。
+    """
+    
+    INDICATORS = [
+        'sma_5', 'sma_10', 'sma_20', 'sma_50',
+        'ema_9', 'ema_12', 'ema_26',
+        'macd', 'macd_signal', 'macd_hist',
+        'rsi',
+        'bb_middle', 'bb_upper', 'bb_lower', 'bb_width',
+        'atr',
+        'volume_ma', 'volume_ratio',
+        'resistance', 'support'
+    ]
+    
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.reset()
+    
+    def reset(self):
+        """清空全部运行状态"""
+        self.sma = {window: _RollingState(window, min_periods=1) for window in (5, 10, 20, 50)}
+        self.ema = {span: _EMAState(span) for span in (9, 12, 26)}
+        self.macd_signal = _EMAState(9)
+        self.gain = _RollingState(14)
+        self.loss = _RollingState(14)
+        self.bollinger = _RollingState(20)
+        self.true_range = _RollingState(14)
+        self.volume = _RollingState(20)
+        self.resistance = _RollingExtremeState(20, use_max=True)
+        self.support = _RollingExtremeState(20, use_max=False)
+        
+        self.prev_close = None
+        self.last_closed_ts = None
+        self.last_valid: Dict[str, float] = {}
+        self.latest: Dict[str, float] = {}
+        # 指标历史（与K线按时间戳对齐），首列为时间戳
+        self.history = CandleRingBuffer(self.capacity, columns=['timestamp'] + self.INDICATORS)
+    
+    def update(self, candle, closed: bool) -> Dict[str, float]:
+        """
+        处理一根K线
+        
+        Args:
+            candle: [timestamp, open, high, low, close, volume]
+            closed: 是否已收盘（已收盘则提交状态，否则仅试算未收盘K线）
+            
+        Returns:
+            该K线的指标值
+        """
+        ts, _, high, low, close, volume = (float(v) for v in candle[:6])
+        commit = closed
+        
+        sma = {window: state.update(close, commit)[0] for window, state in self.sma.items()}
+        ema = {span: state.update(close, commit) for span, state in self.ema.items()}
+        
+        macd = ema[12] - ema[26]
+        macd_signal = self.macd_signal.update(macd, commit)
+        
+        # 首根K线无前收盘价，涨跌按0计（与批量计算中 where 的处理一致）
+        delta = close - self.prev_close if self.prev_close is not None else 0.0
+        avg_gain = self.gain.update(delta if delta > 0 else 0.0, commit)[0]
+        avg_loss = self.loss.update(-delta if delta < 0 else 0.0, commit)[0]
+        rsi = 100 - _safe_div(100, 1 + _safe_div(avg_gain, avg_loss))
+        
+        bb_middle, bb_std = self.bollinger.update(close, commit)
+        bb_upper = bb_middle + bb_std * 2
+        bb_lower = bb_middle - bb_std * 2
+        
+        if self.prev_close is None:
+            tr = high - low
+        else:
+            tr = max(high - low, abs(high - self.prev_close), abs(low - self.prev_close))
+        atr = self.true_range.update(tr, commit)[0]
+        
+        volume_ma = self.volume.update(volume, commit)[0]
+        
+        values = {
+            'sma_5': sma[5],
+            'sma_10': sma[10],
+            'sma_20': sma[20],
+            'sma_50': sma[50],
+            'ema_9': ema[9],
+            'ema_12': ema[12],
+            'ema_26': ema[26],
+            'macd': macd,
+            'macd_signal': macd_signal,
+            'macd_hist': macd - macd_signal,
+            'rsi': rsi,
+            'bb_middle': bb_middle,
+            'bb_upper': bb_upper,
+            'bb_lower': bb_lower,
+            'bb_width': _safe_div(bb_upper - bb_lower, bb_middle),
+            'atr': atr,
+            'volume_ma': volume_ma,
+            'volume_ratio': _safe_div(volume, volume_ma),
+            'resistance': self.resistance.update(high, commit),
+            'support': self.support.update(low, commit)
+        }
+        
+        # 仅向前填充（不使用未来数据）
+        for name, value in values.items():
+            if np.isnan(value):
+                values[name] = self.last_valid.get(name, np.nan)
+            elif commit:
+                self.last_valid[name] = value
+        
+        if commit:
+            self.prev_close = close
+            self.last_closed_ts = ts
+        
+        self.latest = values
+        self.history.upsert([[ts] + [values[name] for name in self.INDICATORS]])
+        return values
+    
+    def sync(self, candles: np.ndarray) -> Dict[str, float]:
+        """
+        用K线窗口同步引擎：末根视为未收盘K线，其余为已收盘K线
+        
+        引擎已处理过的K线直接跳过；窗口与引擎状态不连续（断档、重建缓冲区）时重新预热
+        """
+        with self.lock:
+            if len(candles) == 0:
+                return self.latest
+            
+            timestamps = candles[:, 0]
+            start = 0
+            if self.last_closed_ts is not None:
+                idx = int(np.searchsorted(timestamps, self.last_closed_ts))
+                if idx < len(timestamps) and timestamps[idx] == self.last_closed_ts:
+                    start = idx + 1
+                else:
+                    logger.info("K线与指标状态不连续，重新预热指标引擎")
+                    self.reset()
+            
+            for i in range(start, len(candles) - 1):
+                self.update(candles[i], closed=True)
+            
+            if start <= len(candles) - 1:
+                return self.update(candles[-1], closed=False)
+            return self.latest
+
+class VectorizedIndicatorKernel:
+    """
+    多交易对向量化指标计算
+    
+    输入 symbols × candles 二维数组，一次向量化计算完整v8指标集（与 TechnicalAnalyzer 口径一致），
+    输出缓冲区按形状预分配并在后续调用中复用，热路径不经过pandas
+    """
+    
+    INDICATORS = IncrementalIndicatorEngine.INDICATORS
+    
+    def __init__(self):
+        self._shape = None
+        self._outputs: Dict[str, np.ndarray] = {}
+    
+    def _allocate(self, shape: Tuple[int, int]) -> Dict[str, np.ndarray]:
+        """按形状预分配（或复用）输出缓冲区"""
+        if self._shape != shape:
+            self._outputs = {name: np.empty(shape) for name in self.INDICATORS}
+            self._shape = shape
+        return self._outputs
+    
+    def compute(self, high: np.ndarray, low: np.ndarray, close: np.ndarray,
+                volume: np.ndarray) -> Dict[str, np.ndarray]:
+        """
+        计算全部指标
+        
+        Args:
+            high, low, close, volume: 形状 (交易对数, K线数) 的数组，K线按时间升序
+            
+        Returns:
+            指标名 -> (交易对数, K线数) 数组；缓冲区会被下一次调用覆盖，需要保留时请自行拷贝
+        """
+        high = np.asarray(high, dtype=float)
+        low = np.asarray(low, dtype=float)
+        close = np.asarray(close, dtype=float)
+        volume = np.asarray(volume, dtype=float)
+        
+        out = self._allocate(close.shape)
+        
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # ========== 移动平均线 ==========
+            for window in (5, 10, 20, 50):
+                self._rolling_mean(close, window, 1, out[f'sma_{window}'])
+            
+            # ========== 指数移动平均 / MACD ==========
+            for span in (9, 12, 26):
+                self._ema(close, span, out[f'ema_{span}'])
+            np.subtract(out['ema_12'], out['ema_26'], out=out['macd'])
+            self._ema(out['macd'], 9, out['macd_signal'])
+            np.subtract(out['macd'], out['macd_signal'], out=out['macd_hist'])
+            
+            # ========== RSI ==========
+            delta = np.zeros_like(close)
+            np.subtract(close[:, 1:], close[:, :-1], out=delta[:, 1:])
+            gain = np.maximum(delta, 0.0)
+            loss = np.maximum(-delta, 0.0)
+            avg_gain = self._rolling_mean(gain, 14, 14, np.empty_like(close))
+            avg_loss = self._rolling_mean(loss, 14, 14, np.empty_like(close))
+            np.subtract(100.0, 100.0 / (1.0 + avg_gain / avg_loss), out=out['rsi'])
+            
+            # ========== 布林带 ==========
+            self._rolling_mean(close, 20, 20, out['bb_middle'])
+            bb_std = self._rolling_std(close, 20, np.empty_like(close))
+            np.add(out['bb_middle'], bb_std * 2, out=out['bb_upper'])
+            np.subtract(out['bb_middle'], bb_std * 2, out=out['bb_lower'])
+            np.divide(out['bb_upper'] - out['bb_lower'], out['bb_middle'], out=out['bb_width'])
+            
+            # ========== ATR ==========
+            tr = high - low
+            prev_close = close[:, :-1]
+            np.maximum(tr[:, 1:], np.abs(high[:, 1:] - prev_close), out=tr[:, 1:])
+            np.maximum(tr[:, 1:], np.abs(low[:, 1:] - prev_close), out=tr[:, 1:])
+            self._rolling_mean(tr, 14, 14, out['atr'])
+            
+            # ========== 成交量 ==========
+            self._rolling_mean(volume, 20, 20, out['volume_ma'])
+            np.divide(volume, out['volume_ma'], out=out['volume_ratio'])
+            
+            # ========== 支撑阻力 ==========
+            self._rolling_extreme(high, 20, np.max, out['resistance'])
+            self._rolling_extreme(low, 20, np.min, out['support'])
+        
+        # 仅向前填充（不使用未来数据）
+        for name in self.INDICATORS:
+            self._ffill(out[name])
+        
+        return out
+    
+    def compute_ohlcv(self, ohlcv: np.ndarray) -> Dict[str, np.ndarray]:
+        """
+        由 (交易对数, K线数, 6) 的OHLCV数组计算指标
+        
+        列顺序与 fetch_ohlcv 一致: timestamp, open, high, low, close, volume
+        """
+        return self.compute(ohlcv[:, :, 2], ohlcv[:, :, 3], ohlcv[:, :, 4], ohlcv[:, :, 5])
+    
+    @staticmethod
+    def _rolling_mean(x: np.ndarray, window: int, min_periods: int, out: np.ndarray) -> np.ndarray:
+        """沿时间轴滚动均值（窗口不足 min_periods 为NaN）"""
+        length = x.shape[1]
+        full_start = min(window - 1, length)
+        
+        if full_start > 0:
+            head = np.cumsum(x[:, :full_start], axis=1) / np.arange(1, full_start + 1)
+            head[:, :min_periods - 1] = np.nan
+            out[:, :full_start] = head
+        if length >= window:
+            windows = np.lib.stride_tricks.sliding_window_view(x, window, axis=1)
+            np.mean(windows, axis=-1, out=out[:, window - 1:])
+        return out
+    
+    @staticmethod
+    def _rolling_std(x: np.ndarray, window: int, out: np.ndarray) -> np.ndarray:
+        """沿时间轴滚动样本标准差（窗口未满为NaN）"""
+        out[:, :window - 1] = np.nan
+        if x.shape[1] >= window:
+            windows = np.lib.stride_tricks.sliding_window_view(x, window, axis=1)
+            np.std(windows, axis=-1, ddof=1, out=out[:, window - 1:])
+        return out
+    
+    @staticmethod
+    def _rolling_extreme(x: np.ndarray, window: int, reducer, out: np.ndarray) -> np.ndarray:
+        """沿时间轴滚动极值（窗口未满为NaN）"""
+        out[:, :window - 1] = np.nan
+        if x.shape[1] >= window:
+            windows = np.lib.stride_tricks.sliding_window_view(x, window, axis=1)
+            reducer(windows, axis=-1, out=out[:, window - 1:])
+        return out
+    
+    @staticmethod
+    def _ema(x: np.ndarray, span: int, out: np.ndarray) -> np.ndarray:
+        """沿时间轴指数移动平均（等价于 ewm(span, adjust=False)，按时间步对全部交易对向量化递推）"""
+        alpha = 2.0 / (span + 1)
+        out[:, 0] = x[:, 0]
+        for t in range(1, x.shape[1]):
+            np.add(alpha * x[:, t], (1 - alpha) * out[:, t - 1], out=out[:, t])
+        return out
+    
+    @staticmethod
+    def _ffill(x: np.ndarray):
+        """沿时间轴原地向前填充NaN"""
+        mask = np.isnan(x)
+        if not mask.any():
+            return
+        idx = np.where(mask, 0, np.arange(x.shape[1]))
+        np.maximum.accumulate(idx, axis=1, out=idx)
+        x[:] = np.take_along_axis(x, idx, axis=1)
+
+class CandleStore:
+    """本地K线库（SQLite WAL模式，按交易对+周期存储，支持缺口检测与分页补齐）"""
+    
+    def __init__(self, path: str, page_size: int = 1000, empty_ttl: int = 86400):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        
+        self.path = path
+        self.page_size = page_size
+        self.empty_ttl = empty_ttl
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS candles (
+                symbol TEXT NOT NULL,
+                timeframe TEXT NOT NULL,
+                timestamp INTEGER NOT NULL,
+                open REAL, high REAL, low REAL, close REAL, volume REAL,
+                PRIMARY KEY (symbol, timeframe, timestamp)
+            ) WITHOUT ROWID
+        ''')
+        # 交易所无数据的区间（停机维护等），避免每次启动重复补齐；
+        # expires_at 为空表示已确认（交易所返回了区间之后的K线），否则为临时标记的到期时间（毫秒）
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS empty_ranges (
+                symbol TEXT NOT NULL,
+                timeframe TEXT NOT NULL,
+                start INTEGER NOT NULL,
+                end INTEGER NOT NULL,
+                expires_at INTEGER,
+                PRIMARY KEY (symbol, timeframe, start)
+            )
+        ''')
+        columns = [row[1] for row in self.conn.execute('PRAGMA table_info(empty_ranges)')]
+        if 'expires_at' not in columns:
+            # 旧库的标记无法区分是否确认过，全部置为已到期，下次补齐时重新确认
+            self.conn.execute('ALTER TABLE empty_ranges ADD COLUMN expires_at INTEGER')
+            self.conn.execute('UPDATE empty_ranges SET expires_at = 0')
+        self.conn.commit()
+        logger.info(f"K线库已打开: {path}")
+    
+    def close(self):
+        """关闭数据库连接"""
+        with self.lock:
+            self.conn.close()
+    
+    def save(self, symbol: str, timeframe: str, rows) -> int:
+        """写入K线（同一时间戳覆盖，未收盘K线会在之后被最终值覆盖）"""
+        records = [
+            (symbol, timeframe, int(row[0]), float(row[1]), float(row[2]),
+             float(row[3]), float(row[4]), float(row[5]))
+            for row in rows
+        ]
+        if not records:
+            return 0
+        
+        with self.lock:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO candles VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                records
+            )
+            self.conn.commit()
+        return len(records)
+    
+    def load(self, symbol: str, timeframe: str, limit: int = None,
+             start: int = None, end: int = None) -> List[List[float]]:
+        """读取K线（时间升序；指定limit时取区间内最近的limit根）"""
+        sql = 'SELECT timestamp, open, high, low, close, volume FROM candles WHERE symbol = ? AND timeframe = ?'
+        args = [symbol, timeframe]
+        if start is not None:
+            sql += ' AND timestamp >= ?'
+            args.append(int(start))
+        if end is not None:
+            sql += ' AND timestamp <= ?'
+            args.append(int(end))
+        sql += ' ORDER BY timestamp DESC'
+        if limit is not None:
+            sql += ' LIMIT ?'
+            args.append(int(limit))
+        
+        with self.lock:
+            rows = self.conn.execute(sql, args).fetchall()
+        return [list(row) for row in reversed(rows)]
+    
+    def last_timestamp(self, symbol: str, timeframe: str) -> Optional[int]:
+        """库中最后一根K线的时间戳"""
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT MAX(timestamp) FROM candles WHERE symbol = ? AND timeframe = ?',
+                (symbol, timeframe)
+            ).fetchone()
+        return row[0] if row else None
+    
+    def find_gaps(self, symbol: str, timeframe: str, timeframe_ms: int,
+                  start: int = None, end: int = None) -> List[Tuple[int, int]]:
+        """检测库内相邻K线之间的缺口，返回缺失区间 [(起始时间戳, 结束时间戳)]"""
+        sql = '''
+            SELECT prev + ?, timestamp - ? FROM (
+                SELECT timestamp, LAG(timestamp) OVER (ORDER BY timestamp) AS prev
+                FROM candles
+                WHERE symbol = ? AND timeframe = ? AND timestamp >= ? AND timestamp <= ?
+            )
+            WHERE prev IS NOT NULL AND timestamp - prev > ?
+        '''
+        args = (timeframe_ms, timeframe_ms, symbol, timeframe,
+                int(start if start is not None else 0),
+                int(end if end is not None else 2 ** 62),
+                timeframe_ms)
+        
+        with self.lock:
+            gaps = self.conn.execute(sql, args).fetchall()
+        return [(int(a), int(b)) for a, b in gaps]
+    
+    def missing_ranges(self, symbol: str, timeframe: str, timeframe_ms: int,
+                       start: int, end: int) -> List[Tuple[int, int]]:
+        """[start, end] 内需要从交易所补齐的区间（头部、内部缺口、尾部），已确认为空的区间除外"""
+        with self.lock:
+            first, last = self.conn.execute(
+                'SELECT MIN(timestamp), MAX(timestamp) FROM candles '
+                'WHERE symbol = ? AND timeframe = ? AND timestamp >= ? AND timestamp <= ?',
+                (symbol, timeframe, int(start), int(end))
+            ).fetchone()
+            empty = self.conn.execute(
+                'SELECT start, end FROM empty_ranges WHERE symbol = ? AND timeframe = ? '
+                'AND (expires_at IS NULL OR expires_at > ?)',
+                (symbol, timeframe, int(time.time() * 1000))
+            ).fetchall()
+        
+        if first is None:
+            ranges = [(start, end)]
+        else:
+            ranges = []
+            if first - timeframe_ms >= start:
+                ranges.append((start, first - timeframe_ms))
+            ranges.extend(self.find_gaps(symbol, timeframe, timeframe_ms, start, end))
+            # 最后一根可能是写入时尚未收盘的K线，从它开始重新拉取
+            ranges.append((last, end))
+        
+        return [
+            (a, b) for a, b in ranges
+            if not any(e_start <= a and b <= e_end for e_start, e_end in empty)
+        ]
+    
+    def sync(self, exchange, symbol: str, timeframe: str, start: int, end: int = None) -> int:
+        """
+        从交易所分页补齐 [start, end] 内缺失的K线
+        
+        每页拉取后立即落库，中途失败或进程重启后再次调用会从库中已有数据之后继续
+        
+        Returns:
+            写入的K线根数
+        """
+        timeframe_ms = exchange.parse_timeframe(timeframe) * 1000
+        end = int(end if end is not None else time.time() * 1000)
+        start = int(start) - int(start) % timeframe_ms
+        
+        written = 0
+        for range_start, range_end in self.missing_ranges(symbol, timeframe, timeframe_ms, start, end):
+            written += self._fetch_range(exchange, symbol, timeframe, timeframe_ms, range_start, range_end)
+        
+        if written:
+            logger.info(f"K线库补齐完成: {symbol} {timeframe}, 写入 {written} 条记录")
+        return written
+    
+    def _fetch_range(self, exchange, symbol: str, timeframe: str, timeframe_ms: int,
+                     start: int, end: int) -> int:
+        """分页拉取单个区间"""
+        written = 0
+        since = start
+        
+        while since <= end:
+            page = RetryManager.retry_operation(
+                lambda: exchange.fetch_ohlcv(symbol, timeframe, since=since, limit=self.page_size),
+                max_retries=3,
+                delay=1,
+                exponential_backoff=True
+            )
+            
+            if page is None:
+                logger.error(f"K线分页拉取失败，下次启动时从 {since} 继续")
+                break
+            
+            if not page:
+                # 空页可能是临时的（维护、限频边缘），只做限时标记
+                self._mark_empty(symbol, timeframe, since, end, confirmed=False)
+                break
+            
+            if page[0][0] > end:
+                # 交易所返回了区间之后的K线，确认该区间无数据
+                self._mark_empty(symbol, timeframe, since, end)
+                break
+            
+            if page[0][0] > since:
+                self._mark_empty(symbol, timeframe, since, page[0][0] - timeframe_ms)
+            
+            written += self.save(symbol, timeframe, page)
+            since = int(page[-1][0]) + timeframe_ms
+            
+            if len(page) < self.page_size:
+                break
+        
+        return written
+    
+    def _mark_empty(self, symbol: str, timeframe: str, start: int, end: int, confirmed: bool = True):
+        """记录交易所无数据的区间（未确认的标记在 empty_ttl 后到期）"""
+        expires_at = None if confirmed else int((time.time() + self.empty_ttl) * 1000)
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO empty_ranges VALUES (?, ?, ?, ?, ?)',
+                (symbol, timeframe, int(start), int(end), expires_at)
+            )
+            self.conn.commit()
+
+class CandleResampler:
+    """由基础周期K线（如1m）增量聚合高周期K线，按交易所UTC桶边界对齐"""
+    
+    MAX_TIMEFRAME_MS = 86400000  # 周线/月线桶边界不是固定毫秒数，不参与聚合
+    
+    def __init__(self, base_timeframe_ms: int):
+        self.base_timeframe_ms = base_timeframe_ms
+    
+    def supports(self, timeframe_ms: int) -> bool:
+        """目标周期能否由基础周期聚合"""
+        return (timeframe_ms > self.base_timeframe_ms and
+                timeframe_ms % self.base_timeframe_ms == 0 and
+                timeframe_ms <= self.MAX_TIMEFRAME_MS)
+    
+    def resample(self, base: np.ndarray, target: CandleRingBuffer, timeframe_ms: int) -> bool:
+        """
+        从目标缓冲区最后一根（可能未收盘）的桶开始，用基础K线重新聚合到最新的桶
+        
+        每次只处理最近一两个桶，耗时与历史长度无关
+        
+        Args:
+            base: 基础周期K线（时间升序）
+            target: 已有历史的目标周期缓冲区
+            timeframe_ms: 目标周期毫秒数
+            
+        Returns:
+            False表示基础K线未覆盖待聚合桶的起点（需要REST刷新目标周期）
+        """
+        last_bucket = target.last_timestamp
+        if last_bucket is None or len(base) == 0:
+            return False
+        
+        timestamps = base[:, 0]
+        if timestamps[0] > last_bucket:
+            return False
+        
+        rows = []
+        bucket = last_bucket
+        final_bucket = timestamps[-1] - timestamps[-1] % timeframe_ms
+        while bucket <= final_bucket:
+            lo = int(np.searchsorted(timestamps, bucket, side='left'))
+            hi = int(np.searchsorted(timestamps, bucket + timeframe_ms, side='left'))
+            if hi > lo:
+                segment = base[lo:hi]
+                rows.append([
+                    bucket,
+                    segment[0, 1],
+                    segment[:, 2].max(),
+                    segment[:, 3].min(),
+                    segment[-1, 4],
+                    segment[:, 5].sum()
+                ])
+            bucket += timeframe_ms
+        
+        target.upsert(rows)
+        return True
+
 class MarketDataFetcher:
     """市场数据获取器"""
     
@@ -768,8 +3067,58 @@ class MarketDataFetcher:
         self.symbol = symbol
         self.config = config
         self.cache = {}
-        self.cache_time = {}
-        self.cache_duration = 60  # 缓存60秒
+        self.cache_expiry = {}  # 缓存键 -> 到期时间（服务器时间毫秒）
+        self.time_offset_ms = 0.0
+        self.last_time_sync = 0.0
+        self.buffers: Dict[str, CandleRingBuffer] = {}
+        self.engines: Dict[str, IncrementalIndicatorEngine] = {}
+        self.stream = None
+        self.store = self._init_store()
+        self.resampler = CandleResampler(self.exchange.parse_timeframe(config.base_timeframe) * 1000)
+    
+    def _init_store(self) -> Optional[CandleStore]:
+        """打开本地K线库（失败时退回纯REST模式）"""
+        store_config = self.config.store_config
+        if not store_config['enable_candle_store']:
+            return None
+        try:
+            return CandleStore(store_config['path'], page_size=store_config['page_size'],
+                               empty_ttl=store_config['empty_ttl'])
+        except Exception as e:
+            logger.error(f"打开K线库失败，不使用本地K线库: {e}")
+            return None
+    
+    def start_stream(self) -> bool:
+        """
+        启动K线推送（需在load_markets之后调用）
+        
+        开启周期聚合时只订阅基础周期，主周期和多周期都由其聚合；否则订阅主周期
+        """
+        if not self.config.stream_config['enable_kline_stream']:
+            return False
+        
+        if self._can_resample(self.config.timeframe):
+            timeframe, window = self.config.base_timeframe, self._base_limit()
+        else:
+            timeframe, window = self.config.timeframe, self.config.data_points
+        
+        self.stream = KlineStreamFeed(
+            self.exchange,
+            self.symbol,
+            timeframe,
+            window,
+            self.config.stream_config
+        )
+        if not self.stream.start():
+            self.stream = None
+            return False
+        return True
+    
+    def stop_stream(self):
+        """停止K线推送"""
+        if self.stream:
+            self.stream.stop()
+            self.stream = None
     
     def fetch_ohlcv_data(self, timeframe: str = None, limit: int = None) -> Optional[pd.DataFrame]:
         """获取K线数据"""
@@ -777,46 +3126,273 @@ class MarketDataFetcher:
             tf = timeframe or self.config.timeframe
             lim = limit or self.config.data_points
             
-            # 检查缓存
-            cache_key = f"ohlcv_{tf}_{lim}"
-            current_time = time.time()
+            # 推送模式：直接使用内存K线窗口，无REST请求
+            if self.stream and tf == self.stream.timeframe and lim <= self.stream.window:
+                candles = self.stream.get_candles()
+                if candles is not None:
+                    logger.debug(f"使用推送K线数据: {tf}")
+                    if self.store:
+                        self.store.save(self.symbol, tf, candles[-2:])
+                    return self._build_dataframe(candles, tf, lim)
+                logger.warning("K线推送未就绪，回退REST获取")
             
-            if (cache_key in self.cache and 
-                cache_key in self.cache_time and
-                current_time - self.cache_time[cache_key] < self.cache_duration):
+            resample = self._can_resample(tf)
+            
+            # 检查缓存（按K线收盘边界失效；基础周期走推送时无网络开销，不缓存）
+            cache_key = f"ohlcv_{tf}_{lim}"
+            use_cache = not (resample and self._is_base_streaming())
+            if use_cache and cache_key in self.cache and self._is_cache_valid(cache_key):
                 logger.debug(f"使用缓存数据: {cache_key}")
-                return self.cache[cache_key].copy()
+                # 返回浅视图（不拷贝数据）：调用方增加列只作用于视图，原地修改按写时复制另拷一份，不影响缓存
+                return self.cache[cache_key].copy(deep=False)
             
-            # 从交易所获取数据
-            ohlcv = RetryManager.retry_operation(
-                lambda: self.exchange.fetch_ohlcv(self.symbol, tf, limit=lim),
-                max_retries=3,
-                delay=1,
-                exponential_backoff=True
-            )
+            # 聚合模式：由基础周期K线聚合，只在首次（播种历史）时请求该周期
+            df = self._fetch_resampled(tf, lim) if resample else None
             
-            if not ohlcv:
-                logger.error("获取K线数据失败")
-                return None
+            if df is None:
+                buffer = self._refresh_buffer(tf, lim)
+                if buffer is None:
+                    return None
+                df = self._build_dataframe(buffer.view(), tf, lim)
             
-            # 转换为DataFrame
-            df = pd.DataFrame(ohlcv, columns=['timestamp', 'open', 'high', 'low', 'close', 'volume'])
-            df['timestamp'] = pd.to_datetime(df['timestamp'], unit='ms')
+            # 更新缓存（缓存保留原件，调用方拿到的是浅视图）
+            if use_cache:
+                self.cache[cache_key] = df
+                self.cache_expiry[cache_key] = self._cache_expiry(tf)
+                return df.copy(deep=False)
             
-            # 计算技术指标
-            analyzer = TechnicalAnalyzer()
-            df = analyzer.calculate_indicators(df)
+            return df
             
-            # 更新缓存
-            self.cache[cache_key] = df.copy()
-            self.cache_time[cache_key] = current_time
+        except Exception as e:
+            logger.error(f"获取K线数据异常: {e}")
+            return None
+    
+    def sync_server_time(self) -> bool:
+        """用交易所服务器时间校准本地时钟偏移（取请求往返中点）"""
+        try:
+            local_start = time.time() * 1000
+            server_time = self.exchange.fetch_time()
+            local_end = time.time() * 1000
             
-            logger.info(f"获取K线数据成功: {tf}, {len(df)} 条记录")
-            return df
+            self.time_offset_ms = server_time - (local_start + local_end) / 2
+            self.last_time_sync = local_end / 1000
+            logger.info(f"服务器时间偏移: {self.time_offset_ms:+.0f}ms (往返 {local_end - local_start:.0f}ms)")
+            return True
             
         except Exception as e:
-            logger.error(f"获取K线数据异常: {e}")
-            return None
+            logger.error(f"校准服务器时间失败: {e}")
+            return False
+    
+    def server_time_ms(self) -> float:
+        """当前服务器时间（毫秒），超过校准间隔时自动重新校准"""
+        if time.time() - self.last_time_sync >= self.config.cache_config['time_sync_interval']:
+            # 失败时同样推迟下次校准，避免每次调用都请求
+            if not self.sync_server_time():
+                self.last_time_sync = time.time()
+        return time.time() * 1000 + self.time_offset_ms
+    
+    def _cache_expiry(self, timeframe: str) -> float:
+        """
+        缓存到期时间（服务器时间毫秒）
+        
+        已收盘K线在下一次收盘前不会变化，缓存到收盘边界为止（收盘前取得的数据不能在收盘后使用，
+        定稿延迟由 _await_finalized 在收盘后拉取时等待）；未收盘K线按 open_candle_refresh 刷新，取两者中较早者
+        """
+        cache_config = self.config.cache_config
+        timeframe_ms = self.exchange.parse_timeframe(timeframe) * 1000
+        now_ms = self.server_time_ms()
+        
+        expiry = now_ms - now_ms % timeframe_ms + timeframe_ms
+        if cache_config['open_candle_refresh'] > 0:
+            expiry = min(expiry, now_ms + cache_config['open_candle_refresh'] * 1000)
+        return expiry
+    
+    def _await_finalized(self, timeframe: str):
+        """刚过收盘边界时等待交易所定稿（close_delay_ms）再拉取，避免拿到未定稿的收盘K线"""
+        timeframe_ms = self.exchange.parse_timeframe(timeframe) * 1000
+        since_close = self.server_time_ms() % timeframe_ms
+        remaining = self.config.cache_config['close_delay_ms'] - since_close
+        if remaining > 0:
+            time.sleep(remaining / 1000)
+    
+    def _is_cache_valid(self, cache_key: str) -> bool:
+        """缓存是否仍在有效期内"""
+        return cache_key in self.cache_expiry and self.server_time_ms() < self.cache_expiry[cache_key]
+    
+    def _refresh_buffer(self, timeframe: str, limit: int) -> Optional[CandleRingBuffer]:
+        """增量获取：只拉取缓冲区最后一根K线之后的数据"""
+        self._await_finalized(timeframe)
+        buffer = self._get_buffer(timeframe, limit)
+        ohlcv = self._fetch_incremental(timeframe, limit, buffer)
+        
+        if ohlcv is None:
+            logger.error("获取K线数据失败")
+            return None
+        
+        if self.store:
+            self.store.save(self.symbol, timeframe, ohlcv)
+        
+        appended, updated = buffer.upsert(ohlcv)
+        if len(buffer) == 0:
+            logger.error("K线缓冲区为空")
+            return None
+        
+        logger.info(f"获取K线数据成功: {timeframe}, {len(buffer)} 条记录 (新增{appended}, 更新{updated})")
+        return buffer
+    
+    def _can_resample(self, timeframe: str) -> bool:
+        """该周期是否由基础周期聚合"""
+        if not self.config.resample_timeframes or timeframe == self.config.base_timeframe:
+            return False
+        return self.resampler.supports(self.exchange.parse_timeframe(timeframe) * 1000)
+    
+    def _base_limit(self) -> int:
+        """基础周期窗口长度：至少覆盖最大聚合周期的两个桶"""
+        base_ms = self.resampler.base_timeframe_ms
+        ratios = [
+            self.exchange.parse_timeframe(tf) * 1000 // base_ms
+            for tf in [self.config.timeframe] + list(self.config.timeframes.values())
+            if self._can_resample(tf)
+        ]
+        return max([2 * ratio for ratio in ratios] + [self.config.data_points])
+    
+    def _is_base_streaming(self) -> bool:
+        """基础周期是否由推送提供"""
+        return self.stream is not None and self.stream.timeframe == self.config.base_timeframe
+    
+    def _get_base_candles(self) -> Optional[np.ndarray]:
+        """获取基础周期K线（推送优先，否则REST增量刷新，按基础周期收盘边界缓存）"""
+        base_tf = self.config.base_timeframe
+        
+        if self._is_base_streaming():
+            candles = self.stream.get_candles()
+            if candles is not None:
+                if self.store:
+                    self.store.save(self.symbol, base_tf, candles[-2:])
+                return candles
+        
+        cache_key = f"base_{base_tf}"
+        buffer = self.buffers.get(base_tf)
+        if buffer is None or not self._is_cache_valid(cache_key):
+            buffer = self._refresh_buffer(base_tf, self._base_limit())
+            if buffer is None:
+                return None
+            self.cache_expiry[cache_key] = self._cache_expiry(base_tf)
+        
+        return buffer.view() if len(buffer) else None
+    
+    def _fetch_resampled(self, timeframe: str, limit: int) -> Optional[pd.DataFrame]:
+        """由基础周期聚合出目标周期K线（目标周期缓冲区尚无足够历史时返回None）"""
+        buffer = self.buffers.get(timeframe)
+        if buffer is None or len(buffer) < limit:
+            return None
+        
+        base = self._get_base_candles()
+        if base is None:
+            return None
+        
+        timeframe_ms = self.exchange.parse_timeframe(timeframe) * 1000
+        if not self.resampler.resample(base, buffer, timeframe_ms):
+            logger.info(f"基础K线未覆盖 {timeframe} 最新桶，改用REST刷新")
+            return None
+        
+        logger.debug(f"使用聚合K线数据: {timeframe} <- {self.config.base_timeframe}")
+        return self._build_dataframe(buffer.view(), timeframe, limit)
+    
+    def _get_buffer(self, timeframe: str, limit: int) -> CandleRingBuffer:
+        """获取（必要时创建）周期对应的K线缓冲区"""
+        buffer = self.buffers.get(timeframe)
+        if buffer is None or buffer.capacity < limit:
+            capacity = max(limit, self.config.data_points)
+            if self.store:
+                capacity = max(capacity, self.config.store_config['history_points'])
+            buffer = CandleRingBuffer(capacity)
+            self.buffers[timeframe] = buffer
+        return buffer
+    
+    def _fetch_incremental(self, timeframe: str, limit: int, buffer: CandleRingBuffer) -> Optional[List]:
+        """
+        增量拉取K线
+        
+        缓冲区已覆盖窗口时用since=最后一根K线时间拉取（首根即未收盘K线，原地更新），
+        冷启动或断档超过窗口长度时先从本地K线库补齐加载，无K线库时全量拉取
+        """
+        last_ts = buffer.last_timestamp
+        timeframe_ms = self.exchange.parse_timeframe(timeframe) * 1000
+        now_ms = self.server_time_ms()
+        
+        if self.store and (last_ts is None or now_ms - last_ts > limit * timeframe_ms):
+            self._load_from_store(timeframe, buffer, now_ms - buffer.capacity * timeframe_ms, now_ms)
+            last_ts = buffer.last_timestamp
+        
+        if last_ts is None or len(buffer) < limit or now_ms - last_ts > limit * timeframe_ms:
+            buffer.clear()
+            return RetryManager.retry_operation(
+                lambda: self.exchange.fetch_ohlcv(self.symbol, timeframe, limit=limit),
+                max_retries=3,
+                delay=1,
+                exponential_backoff=True
+            )
+        
+        return RetryManager.retry_operation(
+            lambda: self.exchange.fetch_ohlcv(self.symbol, timeframe, since=int(last_ts), limit=limit),
+            max_retries=3,
+            delay=1,
+            exponential_backoff=True
+        )
+    
+    def _load_from_store(self, timeframe: str, buffer: CandleRingBuffer, start_ms: float, end_ms: float):
+        """从本地K线库补齐缺失区间后加载到缓冲区（热启动）"""
+        try:
+            self.store.sync(self.exchange, self.symbol, timeframe, start_ms, end_ms)
+            rows = self.store.load(self.symbol, timeframe, limit=buffer.capacity)
+            buffer.clear()
+            buffer.upsert(rows)
+            logger.info(f"从K线库加载: {timeframe}, {len(rows)} 条记录")
+        except Exception as e:
+            logger.error(f"K线库加载失败: {e}")
+    
+    def _get_engine(self, timeframe: str) -> IncrementalIndicatorEngine:
+        """获取（必要时创建）周期对应的增量指标引擎"""
+        engine = self.engines.get(timeframe)
+        if engine is None:
+            engine = IncrementalIndicatorEngine(self.config.data_points)
+            self.engines[timeframe] = engine
+        return engine
+    
+    def _build_dataframe(self, ohlcv, timeframe: str, limit: int) -> pd.DataFrame:
+        """
+        K线数组转DataFrame并附加技术指标（OHLCV列直接引用数组，不拷贝）
+        
+        增量模式下由指标引擎同步全部K线后取最近limit行指标，否则批量计算
+        """
+        data = np.asarray(ohlcv, dtype=float)
+        
+        engine = None
+        if self.config.incremental_indicators:
+            engine = self._get_engine(timeframe)
+            engine.sync(data)
+        
+        data = data[-limit:]
+        df = pd.DataFrame({
+            'timestamp': pd.to_datetime(data[:, 0], unit='ms'),
+            'open': data[:, 1],
+            'high': data[:, 2],
+            'low': data[:, 3],
+            'close': data[:, 4],
+            'volume': data[:, 5]
+        }, copy=False)
+        
+        if engine is not None:
+            indicators = engine.history.view(len(df))
+            if len(indicators) == len(df) and indicators[-1, 0] == data[-1, 0]:
+                for i, name in enumerate(engine.INDICATORS, start=1):
+                    df[name] = indicators[:, i]
+                return df
+            logger.warning("指标引擎与K线未对齐，改用批量计算")
+        
+        analyzer = TechnicalAnalyzer()
+        return analyzer.calculate_indicators(df)
     
     def fetch_multi_timeframe_data(self) -> Dict[str, pd.DataFrame]:
         """获取多时间框架数据"""
@@ -834,6 +3410,18 @@ class MarketDataFetcher:
             logger.error(f"获取多时间框架数据失败: {e}")
             return {}
     
+    def get_latest_price(self) -> Optional[float]:
+        """最新成交价（推送就绪时读内存，否则REST）"""
+        if self.stream:
+            candles = self.stream.get_candles()
+            if candles is not None and len(candles):
+                return float(candles[-1, 4])
+        try:
+            return float(self.exchange.fetch_ticker(self.symbol)['last'])
+        except Exception as e:
+            logger.error(f"获取最新价格失败: {e}")
+            return None
+    
     def get_price_data(self) -> Optional[Dict]:
         """获取价格数据"""
         try:
@@ -850,6 +3438,9 @@ class MarketDataFetcher:
             # 支撑阻力
             levels_analysis = self._analyze_support_resistance(df)
             
+            # 多周期上下文
+            multi_timeframe = self._analyze_multi_timeframe(self.fetch_multi_timeframe_data())
+            
             # 技术指标
             technical_data = {
                 'sma_5': current_data.get('sma_5', 0),
@@ -861,6 +3452,7 @@ class MarketDataFetcher:
                 'macd_hist': current_data.get('macd_hist', 0),
                 'bb_upper': current_data.get('bb_upper', 0),
                 'bb_lower': current_data.get('bb_lower', 0),
+                'bb_width': current_data.get('bb_width', 0),
                 'atr': current_data.get('atr', 0),
                 'volume_ratio': current_data.get('volume_ratio', 1)
             }
@@ -876,6 +3468,7 @@ class MarketDataFetcher:
                 'technical_data': technical_data,
                 'trend_analysis': trend_analysis,
                 'levels_analysis': levels_analysis,
+                'multi_timeframe': multi_timeframe,
                 'full_data': df
             }
             
@@ -920,6 +3513,29 @@ class MarketDataFetcher:
             logger.error(f"趋势分析失败: {e}")
             return {}
     
+    def _analyze_multi_timeframe(self, data: Dict[str, pd.DataFrame]) -> Dict:
+        """分析多周期趋势"""
+        try:
+            result = {}
+            for name, df in data.items():
+                if df.empty or 'sma_20' not in df:
+                    continue
+                
+                current = df.iloc[-1]
+                previous = df.iloc[-2] if len(df) > 1 else current
+                result[name] = {
+                    'timeframe': self.config.timeframes[name],
+                    'trend': "上涨" if current['close'] > current['sma_20'] else "下跌",
+                    'macd': "bullish" if current['macd'] > current['macd_signal'] else "bearish",
+                    'rsi': float(current['rsi']),
+                    'price_change': float((current['close'] - previous['close']) / previous['close'] * 100)
+                }
+            return result
+            
+        except Exception as e:
+            logger.error(f"多周期分析失败: {e}")
+            return {}
+    
     def _analyze_support_resistance(self, df: pd.DataFrame, lookback: int = 20) -> Dict:
         """分析支撑阻力"""
         try:
@@ -943,38 +3559,483 @@ class MarketDataFetcher:
             logger.error(f"支撑阻力分析失败: {e}")
             return {}
 
+class AIResponseCache:
+    """
+    AI响应缓存（按量化后的行情指纹命中，TTL过期 + LRU淘汰）
+    
+    止损止盈按相对价格比例保存，命中时换算到当前价格
+    """
+    
+    def __init__(self, ttl: float = 1800, max_size: int = 64, rsi_bucket: float = 10):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.rsi_bucket = rsi_bucket
+        self.lock = threading.Lock()
+        self.entries: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+    
+    def fingerprint(self, market_data: Dict, position_info: Optional[Dict]) -> Tuple:
+        """行情指纹：趋势标签、RSI分档、MACD方向、多周期趋势、持仓方向与盈亏方向"""
+        trend = market_data.get('trend_analysis', {})
+        tech = market_data.get('technical_data', {})
+        rsi = tech.get('rsi', 50)
+        rsi_bucket = int(rsi // self.rsi_bucket) if rsi == rsi else -1  # NaN单独一档
+        
+        multi_timeframe = tuple(
+            (name, item.get('trend'), item.get('macd'))
+            for name, item in sorted(market_data.get('multi_timeframe', {}).items())
+        )
+        
+        position = None
+        if position_info:
+            position = (position_info['side'], position_info['unrealized_pnl'] >= 0)
+        
+        return (
+            trend.get('overall'),
+            trend.get('short_term'),
+            rsi_bucket,
+            tech.get('macd_hist', 0) > 0,
+            multi_timeframe,
+            position
+        )
+    
+    def get(self, key: Tuple, price: float) -> Optional[SignalData]:
+        """查找缓存，命中时按当前价格还原止损止盈"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or time.time() - entry['created'] > self.ttl:
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return None
+            
+            self.entries.move_to_end(key)
+            self.hits += 1
+        
+        return SignalData(
+            signal=entry['signal'],
+            reason=entry['reason'],
+            stop_loss=price * entry['stop_loss_ratio'],
+            take_profit=price * entry['take_profit_ratio'],
+            confidence=entry['confidence'],
+            risk_level=entry['risk_level'],
+            timestamp=datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            price=price
+        )
+    
+    def put(self, key: Tuple, signal_data: SignalData):
+        """写入缓存（备用信号和无价格的信号不缓存）"""
+        if signal_data.is_fallback or signal_data.price <= 0:
+            return
+        
+        with self.lock:
+            self.entries[key] = {
+                'created': time.time(),
+                'signal': signal_data.signal,
+                'reason': signal_data.reason,
+                'stop_loss_ratio': signal_data.stop_loss / signal_data.price,
+                'take_profit_ratio': signal_data.take_profit / signal_data.price,
+                'confidence': signal_data.confidence,
+                'risk_level': signal_data.risk_level
+            }
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+    
+    @property
+    def hit_ratio(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+class LLMJSONParser:
+    """
+    容错JSON解析器（单遍递归下降）
+    
+    支持单引号字符串、未加引号的键、末尾逗号、注释、代码块包裹和多个对象；
+    标准JSON先走C实现的 raw_decode，失败才进入容错解析。字符串内容原样保留，不做正则替换
+    """
+    
+    _DECODER = json.JSONDecoder(strict=False)
+    _WHITESPACE = re.compile(r'(?:\s+|//[^\n]*|/\*.*?\*/)*', re.S)
+    _NUMBER = re.compile(r'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?')
+    _KEY = re.compile(r'[^\s:,{}\[\]"\']+')
+    _BARE_VALUE = re.compile(r'[^,:{}\[\]\n"\']+')
+    _STRINGS = {
+        '"': re.compile(r'"((?:[^"\\]|\\.)*)"', re.S),
+        "'": re.compile(r"'((?:[^'\\]|\\.)*)'", re.S)
+    }
+    _ESCAPE = re.compile(r'(\\.)|"', re.S)
+    _LITERALS = {'true': True, 'false': False, 'null': None,
+                 'True': True, 'False': False, 'None': None}
+    
+    @classmethod
+    def extract_objects(cls, text: str) -> List[Dict]:
+        """提取文本中所有顶层JSON对象"""
+        objects = []
+        pos = text.find('{')
+        
+        while pos != -1:
+            try:
+                value, end = cls._DECODER.raw_decode(text, pos)
+            except ValueError:
+                try:
+                    value, end = cls._parse_object(text, pos)
+                except (ValueError, IndexError):
+                    value, end = None, pos + 1
+            
+            if isinstance(value, dict):
+                objects.append(value)
+            pos = text.find('{', end)
+        
+        return objects
+    
+    @classmethod
+    def parse(cls, text: str, required_fields: List[str] = None) -> Optional[Dict]:
+        """返回最后一个（包含全部必需字段的）对象"""
+        for value in reversed(cls.extract_objects(text)):
+            if not required_fields or all(field in value for field in required_fields):
+                return value
+        return None
+    
+    @classmethod
+    def _skip(cls, text: str, pos: int) -> int:
+        return cls._WHITESPACE.match(text, pos).end()
+    
+    @classmethod
+    def _parse_value(cls, text: str, pos: int) -> Tuple[object, int]:
+        char = text[pos]
+        if char == '{':
+            return cls._parse_object(text, pos)
+        if char == '[':
+            return cls._parse_array(text, pos)
+        if char in cls._STRINGS:
+            return cls._parse_string(text, pos)
+        
+        match = cls._NUMBER.match(text, pos)
+        if match:
+            end = cls._skip(text, match.end())
+            if end >= len(text) or text[end] in ',}]':
+                number = match.group()
+                is_float = any(c in number for c in '.eE')
+                return (float(number) if is_float else int(number)), match.end()
+        
+        # 其余按裸值处理（true/false/null 或未加引号的文本）
+        match = cls._BARE_VALUE.match(text, pos)
+        if not match:
+            raise ValueError(f"无法解析的值 @ {pos}")
+        word = match.group().strip()
+        if word in cls._LITERALS:
+            return cls._LITERALS[word], pos + len(match.group().rstrip())
+        return word, pos + len(match.group().rstrip())
+    
+    @classmethod
+    def _parse_string(cls, text: str, pos: int) -> Tuple[str, int]:
+        match = cls._STRINGS[text[pos]].match(text, pos)
+        if not match:
+            raise ValueError(f"字符串未闭合 @ {pos}")
+        
+        content = match.group(1)
+        if '\\' in content or '"' in content:
+            # 统一转成双引号JSON字符串再解码；\' 不是合法JSON转义，直接还原
+            content = cls._ESCAPE.sub(
+                lambda m: ("'" if m.group(1) == "\\'" else m.group(1)) if m.group(1) else '\\"',
+                content
+            )
+            content = cls._DECODER.decode(f'"{content}"')
+        return content, match.end()
+    
+    @classmethod
+    def _parse_key(cls, text: str, pos: int) -> Tuple[str, int]:
+        if text[pos] in cls._STRINGS:
+            return cls._parse_string(text, pos)
+        match = cls._KEY.match(text, pos)
+        if not match:
+            raise ValueError(f"无法解析的键 @ {pos}")
+        return match.group(), match.end()
+    
+    @classmethod
+    def _parse_object(cls, text: str, pos: int) -> Tuple[Dict, int]:
+        result = {}
+        pos = cls._skip(text, pos + 1)
+        
+        while text[pos] != '}':
+            key, pos = cls._parse_key(text, pos)
+            pos = cls._skip(text, pos)
+            if text[pos] not in ':=':
+                raise ValueError(f"缺少冒号 @ {pos}")
+            
+            value, pos = cls._parse_value(text, cls._skip(text, pos + 1))
+            result[key] = value
+            
+            pos = cls._skip(text, pos)
+            if text[pos] == ',':
+                pos = cls._skip(text, pos + 1)
+            elif text[pos] != '}':
+                raise ValueError(f"缺少逗号 @ {pos}")
+        
+        return result, pos + 1
+    
+    @classmethod
+    def _parse_array(cls, text: str, pos: int) -> Tuple[List, int]:
+        result = []
+        pos = cls._skip(text, pos + 1)
+        
+        while text[pos] != ']':
+            value, pos = cls._parse_value(text, pos)
+            result.append(value)
+            
+            pos = cls._skip(text, pos)
+            if text[pos] == ',':
+                pos = cls._skip(text, pos + 1)
+            elif text[pos] != ']':
+                raise ValueError(f"缺少逗号 @ {pos}")
+        
+        return result, pos + 1
+
+class StreamingJSONScanner:
+    """
+    流式JSON扫描器
+    
+    逐块喂入模型输出，跟踪花括号深度和字符串状态，每当一个顶层对象闭合时返回该对象文本
+    """
+    
+    def __init__(self):
+        self.buffer = []
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.object_start = None
+        self.length = 0
+    
+    @property
+    def text(self) -> str:
+        return ''.join(self.buffer)
+    
+    def feed(self, chunk: str) -> Optional[str]:
+        """喂入一块文本，返回本块内闭合的最后一个顶层对象"""
+        completed = None
+        self.buffer.append(chunk)
+        
+        for char in chunk:
+            position = self.length
+            self.length += 1
+            
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == '\\':
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = self.depth > 0
+            elif char == '{':
+                if self.depth == 0:
+                    self.object_start = position
+                self.depth += 1
+            elif char == '}' and self.depth > 0:
+                self.depth -= 1
+                if self.depth == 0:
+                    completed = (self.object_start, position + 1)
+        
+        if completed:
+            return self.text[completed[0]:completed[1]]
+        return None
+
+class AICassette:
+    """
+    AI调用录制/回放
+    
+    record: 每次调用的提示词、参数、回复、用量和耗时追加写入gzip JSONL（每条一个gzip成员，只追加不改写）；
+    replay: 按提示词哈希返回录制的回复，不访问网络，用于复现周期和回测
+    """
+    
+    # 提示词中的墙钟时间（行情时间、交易历史时间），用历史K线重建周期时必然不同，计算哈希前统一替换
+    WALL_CLOCK = re.compile(r'(?:\d{4}-)?\d{2}-\d{2} \d{2}:\d{2}(?::\d{2})?')
+    
+    def __init__(self, path: str, mode: str = 'record'):
+        self.path = path
+        self.mode = mode
+        self.lock = threading.Lock()
+        self.index: Dict[str, List[Dict]] = {}
+        self.cursor: Dict[str, int] = {}
+        
+        if mode == 'replay':
+            self._load()
+        else:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+    
+    @staticmethod
+    def key(model: str, system_prompt: str, prompt: str) -> str:
+        """提示词哈希（模型 + 系统提示词 + 去除墙钟时间后的用户提示词）"""
+        prompt = AICassette.WALL_CLOCK.sub('<time>', prompt)
+        payload = json.dumps([model, system_prompt, prompt], ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+    
+    def _load(self):
+        """加载录制文件建立索引"""
+        count = 0
+        try:
+            with gzip.open(self.path, 'rt', encoding='utf-8') as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    record = json.loads(line)
+                    # 按当前规则重新计算哈希，兼容旧规则下的录制
+                    key = self.key(record['model'], record['system_prompt'], record['prompt'])
+                    self.index.setdefault(key, []).append(record)
+                    count += 1
+        except FileNotFoundError:
+            logger.warning(f"AI录制文件不存在: {self.path}")
+        except (OSError, EOFError, json.JSONDecodeError) as e:
+            # 写入中途被中断时最后一条可能不完整，保留已读取的部分
+            logger.warning(f"AI录制文件读取中断，已加载{count}条: {e}")
+        logger.info(f"AI回放模式: 加载{count}条录制，{len(self.index)}个不同提示词")
+    
+    def replay(self, key: str) -> Optional[Dict]:
+        """按哈希取录制（同一提示词多次录制时依次返回，用完后重复最后一条）"""
+        with self.lock:
+            records = self.index.get(key)
+            if not records:
+                return None
+            position = self.cursor.get(key, 0)
+            self.cursor[key] = position + 1
+            return records[min(position, len(records) - 1)]
+    
+    def record(self, key: str, endpoint: Dict, system_prompt: str, prompt: str, params: Dict,
+               response: str, usage: Optional[Dict], latency: float):
+        """追加一条录制"""
+        record = {
+            'key': key,
+            'time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'endpoint': endpoint['name'],
+            'model': endpoint['model'],
+            'system_prompt': system_prompt,
+            'prompt': prompt,
+            'params': params,
+            'response': response,
+            'usage': usage,
+            'latency': latency
+        }
+        line = json.dumps(record, ensure_ascii=False) + '\n'
+        try:
+            with self.lock:
+                with gzip.open(self.path, 'at', encoding='utf-8') as f:
+                    f.write(line)
+        except Exception as e:
+            logger.error(f"写入AI录制失败: {e}")
+
 class AIAnalyzer:
     """AI分析器"""
     
-    def __init__(self, api_key: str, base_url: str = "https://api.deepseek.com", config: TradeConfig = {}):
-        self.client = OpenAI(api_key=api_key, base_url=base_url)
+    REQUIRED_FIELDS = ['signal', 'reason', 'stop_loss', 'take_profit', 'confidence', 'risk_level']
+    
+    FAST_SYSTEM_PROMPT = (
+        "你是SOL/USDT永续合约交易员。根据给定指标判断信号，趋势明确时跟随趋势，方向不明时HOLD。"
+        '只回复JSON：{"signal": "BUY|SELL|HOLD", "reason": "一句话理由", "stop_loss": 止损价, '
+        '"take_profit": 止盈价, "confidence": "HIGH|MEDIUM|LOW", "risk_level": "LOW|MEDIUM|HIGH"}'
+    )
+    
+    def __init__(self, api_key: str, base_url: str = "https://api.deepseek.com", config: TradeConfig = {},
+                 metrics: PerformanceMetrics = None):
         self.config = config
+        self.metrics = metrics
+        self.system_prompt = self._build_system_prompt() if config else ""
+        
+        # SDK内部重试会突破决策截止时间，这里关闭，由对冲请求兜底
+        timeout = config.ai_config['decision_deadline'] if config else 60
+        self.client = OpenAI(api_key=api_key, base_url=base_url, timeout=timeout, max_retries=0)
+        self.endpoints = self._build_endpoints(api_key, base_url, timeout)
+        self.executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='ai')
+        self._usage_local = threading.local()
+        
+        # 录制/回放
+        self.cassette = None
+        if config and config.ai_config['cassette_mode'] in ('record', 'replay'):
+            self.cassette = AICassette(config.ai_config['cassette_path'], config.ai_config['cassette_mode'])
+        
+        # 快速档：短提示词 + 各接口自己的快速模型（备用接口可能不提供主接口的快速模型），沿用同一组接口做对冲
+        self.fast_endpoints = [
+            dict(endpoint, name=f"fast_{endpoint['name']}", model=endpoint['fast_model'],
+                 system_prompt=self.FAST_SYSTEM_PROMPT)
+            for endpoint in self.endpoints
+        ]
+        
+        self.response_cache = None
+        if config and config.ai_config['enable_response_cache']:
+            self.response_cache = AIResponseCache(
+                ttl=config.ai_config['cache_ttl'],
+                max_size=config.ai_config['cache_size'],
+                rsi_bucket=config.ai_config['rsi_bucket']
+            )
     
     def analyze_market(self, market_data: Dict, signal_history: List, 
-                      position_info: Optional[Dict] = None) -> Optional[SignalData]:
-        """分析市场并生成交易信号"""
+                      position_info: Optional[Dict] = None, use_cache: bool = True) -> Optional[SignalData]:
+        """
+        分析市场并生成交易信号
+        
+        Args:
+            use_cache: 是否读写响应缓存（收盘前预分析传False：缓存指纹不含价格，
+                       预分析因价格偏移被弃用后，重新分析不能命中它写入的结果）
+        """
         try:
+            # 分档路由：明显的震荡行情直接由规则给出HOLD
+            tier, route_reason = 'full', ''
+            if self.config and self.config.ai_config['enable_routing']:
+                tier, route_reason = self._route(market_data, position_info)
+                if self.metrics:
+                    self.metrics.increment(f"ai.route.{tier}")
+                logger.info(f"AI路由: {tier} ({route_reason})")
+                
+                if tier == 'rules':
+                    rules_start = time.perf_counter()
+                    signal_data = self._create_rules_signal(market_data, route_reason)
+                    if self.metrics:
+                        self.metrics.record('ai.tier.rules', time.perf_counter() - rules_start)
+                    return signal_data
+            
+            # 行情与上次调用基本一致时直接复用缓存结果
+            cache_key = None
+            if self.response_cache and use_cache:
+                cache_key = (tier, self.response_cache.fingerprint(market_data, position_info))
+                cached = self.response_cache.get(cache_key, market_data.get('price', 0))
+                if cached:
+                    self._report_cache(hit=True)
+                    logger.info(f"AI缓存命中: {cached.signal.value}, 信心: {cached.confidence.value}")
+                    return cached
+                self._report_cache(hit=False)
+            
             # 构建提示词
-            prompt = self._build_prompt2(market_data, signal_history, position_info)
+            if tier == 'fast':
+                prompt = self._build_fast_prompt(market_data, position_info)
+                endpoints = self.fast_endpoints
+            else:
+                prompt = self._build_prompt2(market_data, signal_history, position_info)
+                endpoints = self.endpoints
 
             # logger.info(prompt)
             
             # 调用AI
-            response = RetryManager.retry_operation(
-                lambda: self._call_ai_api(prompt),
-                max_retries=2,
-                delay=2
-            )
+            llm_start = time.time()
+            data = self._call_ai_hedged(prompt, endpoints)
+            if data and self.metrics:
+                self.metrics.record('ai.llm_latency', time.time() - llm_start)
+                self.metrics.record(f"ai.tier.{tier}", time.time() - llm_start)
             
-            if not response:
+            if not data:
                 logger.warning("AI分析失败，使用备用信号")
                 return self._create_fallback_signal(market_data)
             
-            # 解析响应
-            signal_data = self._parse_ai_response(response, market_data)
+            # 由解析结果创建信号
+            signal_data = self._create_signal(data, market_data)
             
             if signal_data:
                 logger.info(f"AI分析成功: {signal_data.signal.value}, 信心: {signal_data.confidence.value}")
+                if cache_key is not None:
+                    self.response_cache.put(cache_key, signal_data)
                 return signal_data
             else:
                 logger.warning("AI响应解析失败，使用备用信号")
@@ -984,47 +4045,115 @@ class AIAnalyzer:
             logger.error(f"AI分析异常: {e}")
             return self._create_fallback_signal(market_data)
         
-    def _build_prompt2(self, market_data: Dict, signal_history: List, 
-                     position_info: Optional[Dict]) -> str:
-        """构建AI提示词2"""
-        technical_analysis = self._generate_technical_analysis(market_data)
-
-        # 历史信号
-        history_text = ""
-        if signal_history:
-            last_signal = signal_history[-1]
-            history_text = f"\n上次信号: {last_signal.signal.value} (信心: {last_signal.confidence.value})"
+    def _route(self, market_data: Dict, position_info: Optional[Dict]) -> Tuple[str, str]:
+        """
+        按行情模糊程度和影响选择分析档位
         
-        # 持仓信息
-        position_text = "无持仓" if not position_info else f"{position_info['side']}仓, 数量: {position_info['size']}, 盈亏: {position_info['unrealized_pnl']:.2f}USDT"
-        pnl_text = f", 持仓盈亏: {position_info['unrealized_pnl']:.2f} USDT" if position_info else ""
-
-        prompt = f"""
-        你是一个专业的加密货币交易分析师，最近波动频繁通过你交易的都亏麻了，已经吃不上饭了，多上点心吧，一定要注意短期波动呀，稳妥点呀。请基于以下SOL/USDT {self.config.timeframe}周期数据进行分析：
-
-        【当前行情】
-        - 价格: ${market_data.get('price', 0):.2f}
-        - 变化: {market_data.get('price_change', 0):+.2f}%
-        - 时间: {market_data.get('timestamp', 'N/A')}
-        - 成交量: {market_data.get('volume', 0):.0f} SOL
-        - 当前持仓: {position_text}{pnl_text}
-
-        【技术分析】
-        {technical_analysis}
-
-        【市场趋势】
-        - 整体趋势: {market_data.get('trend_analysis', {}).get('overall', 'N/A')}
-        - 短期趋势: {market_data.get('trend_analysis', {}).get('short_term', 'N/A')}
-        - RSI: {market_data.get('technical_data', {}).get('rsi', 50):.1f}
-        - MACD: {'看涨' if market_data.get('technical_data', {}).get('macd_hist', 0) > 0 else '看跌'}
-
-        【关键价位】
-        - 阻力: ${market_data.get('levels_analysis', {}).get('static_resistance', 0):.2f}
-        - 支撑: ${market_data.get('levels_analysis', {}).get('static_support', 0):.2f}
-        - ATR波动率: {market_data.get('technical_data', {}).get('atr', 0):.3f}
-
-        【交易历史】
-        {signal_history}
+        Returns:
+            (档位 'rules'|'fast'|'full', 原因)
+        """
+        ai_config = self.config.ai_config
+        tech = market_data.get('technical_data', {})
+        trend = market_data.get('trend_analysis', {})
+        price = market_data.get('price', 0)
+        rsi = tech.get('rsi', 50)
+        overall = trend.get('overall', '')
+        short_term = trend.get('short_term', '')
+        macd_bullish = tech.get('macd_hist', 0) > 0
+        outside_bands = (tech.get('bb_upper') and price > tech['bb_upper']) or \
+                        (tech.get('bb_lower') and price < tech['bb_lower'])
+        mtf_trends = {item.get('trend') for item in market_data.get('multi_timeframe', {}).values()}
+        bb_width = tech.get('bb_width')
+        if bb_width is None:
+            # 缺少布林宽度时按上下轨推算，避免规则档永远不触发
+            bb_middle = (tech.get('bb_upper', 0) + tech.get('bb_lower', 0)) / 2
+            bb_width = (tech.get('bb_upper', 0) - tech.get('bb_lower', 0)) / bb_middle if bb_middle else 1
+        
+        # 规则档：无持仓、震荡整理、RSI居中、布林带收窄且价格在带内
+        rsi_low, rsi_high = ai_config['route_rsi_range']
+        if (not position_info and overall == '震荡整理' and rsi_low <= rsi <= rsi_high and
+                bb_width <= ai_config['route_bb_width'] and not outside_bands):
+            return 'rules', f"窄幅震荡 RSI {rsi:.1f} 布林宽度 {bb_width:.2%}"
+        
+        # 模糊度：各信号之间相互矛盾的数量
+        conflicts = []
+        if overall == '震荡整理':
+            conflicts.append('趋势不明')
+        if ('上涨' in overall and not macd_bullish) or ('下跌' in overall and macd_bullish):
+            conflicts.append('MACD背离趋势')
+        if rsi > 70 or rsi < 30:
+            conflicts.append('RSI极值')
+        if len(mtf_trends) > 1:
+            conflicts.append('多周期分歧')
+        if outside_bands:
+            conflicts.append('突破布林带')
+        
+        # 影响：持仓方向与短期趋势相反，可能需要平仓或反手
+        if position_info:
+            against = (position_info['side'] == 'long' and short_term == '下跌') or \
+                      (position_info['side'] == 'short' and short_term == '上涨')
+            if against:
+                conflicts.append('趋势逆持仓')
+        
+        if len(conflicts) >= 2 or '趋势逆持仓' in conflicts:
+            return 'full', '、'.join(conflicts)
+        return 'fast', '、'.join(conflicts) or '趋势明确'
+    
+    def _create_rules_signal(self, market_data: Dict, reason: str) -> SignalData:
+        """规则档信号（震荡行情HOLD）"""
+        current_price = market_data.get('price', 0)
+        stop_loss_pct = self.config.position_config['stop_loss_pct'] / 100
+        take_profit_pct = self.config.position_config['take_profit_pct'] / 100
+        
+        return SignalData(
+            signal=SignalType.HOLD,
+            reason=f"规则判断: {reason}，观望",
+            stop_loss=current_price * (1 - stop_loss_pct),
+            take_profit=current_price * (1 + take_profit_pct),
+            confidence=ConfidenceLevel.MEDIUM,
+            risk_level=RiskLevel.LOW,
+            timestamp=datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            price=current_price
+        )
+    
+    def _build_fast_prompt(self, market_data: Dict, position_info: Optional[Dict]) -> str:
+        """快速档短提示词（只含关键指标）"""
+        tech = market_data.get('technical_data', {})
+        trend = market_data.get('trend_analysis', {})
+        levels = market_data.get('levels_analysis', {})
+        position_text = "无" if not position_info else \
+            f"{position_info['side']} {position_info['size']} 盈亏{position_info['unrealized_pnl']:.2f}"
+        
+        return (
+            f"SOL/USDT {self.config.timeframe} 价格{market_data.get('price', 0):.2f} "
+            f"变化{market_data.get('price_change', 0):+.2f}%\n"
+            f"趋势 {trend.get('overall', 'N/A')}/{trend.get('short_term', 'N/A')} "
+            f"RSI {tech.get('rsi', 50):.1f} MACD柱 {tech.get('macd_hist', 0):.4f} ATR {tech.get('atr', 0):.3f}\n"
+            f"支撑 {levels.get('static_support', 0):.2f} 阻力 {levels.get('static_resistance', 0):.2f} "
+            f"持仓 {position_text}"
+        )
+    
+    def _report_cache(self, hit: bool):
+        """记录缓存命中率和节省的LLM耗时（按历史LLM耗时中位数估算）"""
+        if self.metrics:
+            self.metrics.increment('ai.cache_hit' if hit else 'ai.cache_miss')
+            if hit:
+                saved = self.metrics.percentile('ai.llm_latency', 50)
+                if saved:
+                    self.metrics.increment('ai.cache_saved_seconds', saved)
+        
+        if hit:
+            logger.info(f"AI缓存命中率: {self.response_cache.hit_ratio:.1%} "
+                        f"({self.response_cache.hits}/{self.response_cache.hits + self.response_cache.misses})")
+    
+    def _build_system_prompt(self) -> str:
+        """
+        构建固定前缀（角色、交易规则、输出格式）
+        
+        前缀内容不随行情变化，DeepSeek可命中前缀缓存；行情等易变数据全部放在用户消息里
+        """
+        return f"""
+        你是一个专业的加密货币交易分析师，最近波动频繁通过你交易的都亏麻了，已经吃不上饭了，多上点心吧，一定要注意短期波动呀，稳妥点呀。你将收到SOL/USDT {self.config.timeframe}周期数据，请基于数据进行分析。
 
         【防频繁交易重要原则】
         1. **趋势持续性优先**: 不要因单根K线或短期波动改变整体趋势判断
@@ -1059,9 +4188,6 @@ class AIAnalyzer:
 
         【重要】请基于技术分析做出明确判断，避免因过度谨慎而错过趋势行情！
 
-        【分析要求】
-        基于以上分析，请给出明确的交易信号
-
         请用以下JSON格式回复：
         {{
             "signal": "BUY|SELL|HOLD",
@@ -1072,6 +4198,47 @@ class AIAnalyzer:
             "risk_level": "LOW|MEDIUM|HIGH"
         }}
         """
+    
+    def _build_prompt2(self, market_data: Dict, signal_history: List, 
+                     position_info: Optional[Dict]) -> str:
+        """构建AI提示词2（只含易变数据，规则在固定前缀中）"""
+        technical_analysis = self._generate_technical_analysis(market_data)
+        
+        # 持仓信息
+        position_text = "无持仓" if not position_info else f"{position_info['side']}仓, 数量: {position_info['size']}, 盈亏: {position_info['unrealized_pnl']:.2f}USDT"
+        pnl_text = f", 持仓盈亏: {position_info['unrealized_pnl']:.2f} USDT" if position_info else ""
+
+        prompt = f"""
+        【技术分析】
+        {technical_analysis}
+
+        【市场趋势】
+        - 整体趋势: {market_data.get('trend_analysis', {}).get('overall', 'N/A')}
+        - 短期趋势: {market_data.get('trend_analysis', {}).get('short_term', 'N/A')}
+        - RSI: {market_data.get('technical_data', {}).get('rsi', 50):.1f}
+        - MACD: {'看涨' if market_data.get('technical_data', {}).get('macd_hist', 0) > 0 else '看跌'}
+
+        【多周期】
+        {self._generate_multi_timeframe_analysis(market_data)}
+
+        【关键价位】
+        - 阻力: ${market_data.get('levels_analysis', {}).get('static_resistance', 0):.2f}
+        - 支撑: ${market_data.get('levels_analysis', {}).get('static_support', 0):.2f}
+        - ATR波动率: {market_data.get('technical_data', {}).get('atr', 0):.3f}
+
+        【交易历史】
+        {self._encode_signal_history(signal_history)}
+
+        【当前行情】
+        - 价格: ${market_data.get('price', 0):.2f}
+        - 变化: {market_data.get('price_change', 0):+.2f}%
+        - 时间: {market_data.get('timestamp', 'N/A')}
+        - 成交量: {market_data.get('volume', 0):.0f} SOL
+        - 当前持仓: {position_text}{pnl_text}
+
+        【分析要求】
+        基于以上分析，请给出明确的交易信号，按约定JSON格式回复
+        """
 
         return prompt
     
@@ -1142,39 +4309,243 @@ class AIAnalyzer:
         return prompt
     
     def _generate_technical_analysis(self, market_data: Dict) -> str:
-        """生成技术分析文本"""
+        """生成技术分析文本（紧凑表格）"""
         try:
             tech = market_data.get('technical_data', {})
+            rsi = tech.get('rsi', 50)
+            rsi_state = '超买' if rsi > 70 else '超卖' if rsi < 30 else '正常'
+            
+            rows = [
+                "指标|值",
+                f"SMA5/20/50|{tech.get('sma_5', 0):.2f}/{tech.get('sma_20', 0):.2f}/{tech.get('sma_50', 0):.2f}",
+                f"RSI|{rsi:.1f}({rsi_state})",
+                f"MACD柱|{tech.get('macd_hist', 0):.4f}",
+                f"布林上/下/宽|{tech.get('bb_upper', 0):.2f}/{tech.get('bb_lower', 0):.2f}/{tech.get('bb_width', 0):.2%}"
+            ]
+            return "\n        ".join(rows)
             
-            analysis = f"""
-            【移动平均线】
-            - SMA5: ${tech.get('sma_5', 0):.2f}
-            - SMA20: ${tech.get('sma_20', 0):.2f}
-            - SMA50: ${tech.get('sma_50', 0):.2f}
-            
-            【动量指标】
-            - RSI: {tech.get('rsi', 50):.1f} ({'超买' if tech.get('rsi', 50) > 70 else '超卖' if tech.get('rsi', 50) < 30 else '正常'})
-            - MACD直方图: {tech.get('macd_hist', 0):.4f}
-            
-            【布林带】
-            - 上轨: ${tech.get('bb_upper', 0):.2f}
-            - 下轨: ${tech.get('bb_lower', 0):.2f}
-            - 宽度: {tech.get('bb_width', 0):.3%}
-            """
+        except Exception as e:
+            logger.error(f"生成技术分析失败: {e}")
+            return "技术分析数据不可用"
+    
+    @staticmethod
+    def _estimate_tokens(text: str) -> int:
+        """粗略估算token数（中文约1字1token，其余约3字符1token）"""
+        cjk = sum(1 for char in text if '\u4e00' <= char <= '\u9fff')
+        return cjk + (len(text) - cjk + 2) // 3
+    
+    def _encode_signal_history(self, signal_history: List) -> str:
+        """
+        交易历史编码为紧凑表格，从最近一条往前取，直到行数或token预算用完
+        
+        只保留最近一条的理由摘要，其余只保留信号、信心、价格和止损止盈
+        """
+        if not signal_history:
+            return "无"
+        
+        ai_config = self.config.ai_config
+        header = "时间|信号|信心|价格|止损|止盈"
+        budget = ai_config['history_token_budget'] - self._estimate_tokens(header)
+        
+        rows = []
+        for item in reversed(signal_history[-ai_config['history_max_rows']:]):
+            row = (f"{item.timestamp[5:16]}|{item.signal.value}|{item.confidence.value[0]}|"
+                   f"{item.price:.2f}|{item.stop_loss:.2f}|{item.take_profit:.2f}")
+            cost = self._estimate_tokens(row)
+            if cost > budget:
+                break
+            rows.append(row)
+            budget -= cost
+        
+        lines = [header] + rows[::-1]
+        last_reason = f"上次理由: {signal_history[-1].reason[:60]}"
+        if self._estimate_tokens(last_reason) <= budget:
+            lines.append(last_reason)
+        
+        return "\n        ".join(lines)
+
+    def _generate_multi_timeframe_analysis(self, market_data: Dict) -> str:
+        """生成多周期分析文本"""
+        multi_timeframe = market_data.get('multi_timeframe', {})
+        if not multi_timeframe:
+            return "多周期数据不可用"
+        
+        lines = []
+        for item in multi_timeframe.values():
+            lines.append(
+                f"- {item['timeframe']}: {item['trend']}, RSI {item['rsi']:.1f}, "
+                f"MACD{'看涨' if item['macd'] == 'bullish' else '看跌'}, 变化 {item['price_change']:+.2f}%"
+            )
+        return "\n        ".join(lines)
+    
+    def _build_endpoints(self, api_key: str, base_url: str, timeout: float) -> List[Dict]:
+        """主接口 + 可选的备用接口（备用base_url或备用模型）"""
+        ai_config = self.config.ai_config if self.config else {}
+        model = ai_config.get('model', 'deepseek-chat')
+        endpoints = [{'name': 'primary', 'client': None, 'model': model,
+                      'fast_model': ai_config.get('fast_model') or model}]
+        
+        alt_base_url = ai_config.get('alt_base_url')
+        alt_model = ai_config.get('alt_model')
+        if alt_base_url or alt_model:
+            client = OpenAI(
+                api_key=ai_config.get('alt_api_key') or api_key,
+                base_url=alt_base_url or base_url,
+                timeout=timeout,
+                max_retries=0
+            )
+            endpoints.append({'name': 'alternate', 'client': client, 'model': alt_model or model,
+                              'fast_model': ai_config.get('alt_fast_model') or alt_model or model})
+            logger.info(f"AI对冲接口: {alt_base_url or base_url} / {alt_model or model}")
+        
+        return endpoints
+    
+    def _call_ai_hedged(self, prompt: str, endpoints: List[Dict] = None) -> Optional[Dict]:
+        """
+        在决策截止时间内调用AI：主接口超过 hedge_delay 未返回（或返回无效结果）时
+        向备用接口发出对冲请求，取最先到达的有效回复；全部失败时在截止时间内按 retry_config 退避重试，
+        超过截止时间返回None
+        
+        Returns:
+            有效回复解析出的JSON对象（校验时已解析，调用方无需再次解析）
+        """
+        ai_config = self.config.ai_config
+        retry_config = self.config.retry_config
+        start = time.time()
+        deadline = start + ai_config['decision_deadline']
+        cancel_event = threading.Event()
+        
+        all_endpoints = list(endpoints or self.endpoints)
+        remaining = list(all_endpoints)
+        primary = remaining[0]
+        pending = {}
+        attempts = 0
+        
+        def launch():
+            endpoint = remaining.pop(0)
+            future = self.executor.submit(self._call_endpoint, endpoint, prompt, cancel_event)
+            pending[future] = endpoint
+        
+        launch()
+        next_hedge = start + ai_config['hedge_delay']
+        
+        try:
+            while pending or remaining:
+                if not pending:
+                    launch()
+                
+                now = time.time()
+                if now >= deadline:
+                    logger.warning(f"AI调用超过决策截止时间 {ai_config['decision_deadline']}秒")
+                    if self.metrics:
+                        self.metrics.increment('ai.deadline_exceeded')
+                    return None
+                
+                wake_at = min(deadline, next_hedge) if remaining else deadline
+                done, _ = wait(list(pending), timeout=max(wake_at - now, 0), return_when=FIRST_COMPLETED)
+                
+                for future in done:
+                    endpoint = pending.pop(future)
+                    result = future.result()
+                    # 容错解析（单引号、未加引号的键、末尾逗号、多个对象），取最后一个字段完整的对象
+                    data = LLMJSONParser.parse(result, self.REQUIRED_FIELDS) if result else None
+                    if data is not None:
+                        if endpoint is not primary:
+                            logger.info(f"对冲请求胜出: {endpoint['name']}")
+                            if self.metrics:
+                                self.metrics.increment('ai.hedge_won')
+                        return data
+                    logger.debug(f"原始响应: {result}")
+                    logger.warning(f"AI接口 {endpoint['name']} 未返回有效回复")
+                
+                # 全部接口都已失败（连接重置、5xx、无效JSON）：截止时间允许时退避后重新请求
+                if not pending and not remaining:
+                    delay = retry_config['retry_delay']
+                    if retry_config['exponential_backoff']:
+                        delay *= 2 ** attempts
+                    if attempts >= retry_config['max_retries'] or time.time() + delay >= deadline:
+                        break
+                    attempts += 1
+                    logger.info(f"AI接口均未返回有效回复，{delay}秒后第{attempts}次重试")
+                    if self.metrics:
+                        self.metrics.increment('ai.retry')
+                    time.sleep(delay)
+                    remaining = list(all_endpoints)
+                    next_hedge = time.time() + ai_config['hedge_delay']
+                    continue
+                
+                # 主接口太慢，发出对冲请求
+                if remaining and pending and time.time() >= next_hedge:
+                    logger.info(f"AI接口{ai_config['hedge_delay']}秒未返回，发出对冲请求")
+                    if self.metrics:
+                        self.metrics.increment('ai.hedge_fired')
+                    launch()
+                    next_hedge = time.time() + ai_config['hedge_delay']
             
-            return analysis
+            return None
             
-        except Exception as e:
-            logger.error(f"生成技术分析失败: {e}")
-            return "技术分析数据不可用"
-
-    def _call_ai_api(self, prompt: str) -> Optional[str]:
-        """调用AI API"""
+        finally:
+            # 通知仍在读取的流式请求停止
+            cancel_event.set()
+    
+    def _call_endpoint(self, endpoint: Dict, prompt: str, cancel_event: threading.Event) -> Optional[str]:
+        """调用单个接口并记录该接口的耗时"""
+        start = time.time()
+        result = self._call_ai_api(prompt, endpoint, cancel_event)
+        if self.metrics:
+            if result is not None:
+                self.metrics.record(f"ai.endpoint.{endpoint['name']}", time.time() - start)
+            else:
+                self.metrics.increment(f"ai.endpoint.{endpoint['name']}.error")
+        return result
+    
+    def _call_ai_api(self, prompt: str, endpoint: Dict = None,
+                     cancel_event: threading.Event = None) -> Optional[str]:
+        """调用AI API（开启录制/回放时经过cassette）"""
+        endpoint = endpoint or self.endpoints[0]
+        if not self.cassette:
+            return self._request_ai_api(prompt, endpoint, cancel_event)
+        
+        system_prompt = endpoint.get('system_prompt', self.system_prompt)
+        key = AICassette.key(endpoint['model'], system_prompt, prompt)
+        
+        if self.cassette.mode == 'replay':
+            record = self.cassette.replay(key)
+            if record is None:
+                logger.warning(f"AI回放未找到录制: {key[:12]}")
+                if self.metrics:
+                    self.metrics.increment('ai.cassette.miss')
+                return None
+            if self.metrics:
+                self.metrics.increment('ai.cassette.hit')
+            return record['response']
+        
+        self._usage_local.usage = None
+        start = time.time()
+        result = self._request_ai_api(prompt, endpoint, cancel_event)
+        if result is not None:
+            self.cassette.record(
+                key, endpoint, system_prompt, prompt,
+                params={'temperature': 0.1, 'stream': self.config.ai_config['stream_response']},
+                response=result,
+                usage=self._usage_local.usage,
+                latency=time.time() - start
+            )
+        return result
+    
+    def _request_ai_api(self, prompt: str, endpoint: Dict,
+                        cancel_event: threading.Event = None) -> Optional[str]:
+        """向接口发起请求"""
+        client = endpoint['client'] or self.client
+        
+        if self.config and self.config.ai_config['stream_response']:
+            return self._call_ai_api_stream(prompt, endpoint, cancel_event)
+        
         try:
-            response = self.client.chat.completions.create(
-                model="deepseek-chat",
+            response = client.chat.completions.create(
+                model=endpoint['model'],
                 messages=[
-                    {"role": "system", "content": "你是一个专业的加密货币交易员，专注SOL/USDT永续合约交易。"},
+                    {"role": "system", "content": endpoint.get('system_prompt', self.system_prompt)},
                     {"role": "user", "content": prompt}
                 ],
                 stream=False,
@@ -1182,37 +4553,135 @@ class AIAnalyzer:
             )
             result = response.choices[0].message.content
             logger.info(f"DeepSeek原始回复: {result}")
+            self._record_usage(getattr(response, 'usage', None))
             return result
             
         except Exception as e:
             logger.error(f"调用AI API失败: {e}")
             return None
     
-    def _parse_ai_response(self, response: str, market_data: Dict) -> Optional[SignalData]:
-        """解析AI响应"""
+    def _call_ai_api_stream(self, prompt: str, endpoint: Dict,
+                            cancel_event: threading.Event = None) -> Optional[str]:
+        """流式调用AI API，收到包含全部必需字段的完整JSON后立即停止读取"""
+        stream = None
         try:
-            # 查找JSON部分
-            start_idx = response.find('{')
-            end_idx = response.rfind('}') + 1
+            request_start = time.time()
+            stream = (endpoint['client'] or self.client).chat.completions.create(
+                model=endpoint['model'],
+                messages=[
+                    {"role": "system", "content": endpoint.get('system_prompt', self.system_prompt)},
+                    {"role": "user", "content": prompt}
+                ],
+                stream=True,
+                stream_options={"include_usage": True},
+                temperature=0.1
+            )
             
-            if start_idx == -1 or end_idx == 0:
-                logger.warning("AI响应中未找到JSON")
-                return None
+            scanner = StreamingJSONScanner()
+            first_token_time = None
+            early_stop = False
+            usage_seen = False
+            
+            for chunk in stream:
+                if cancel_event is not None and cancel_event.is_set():
+                    logger.info(f"AI接口 {endpoint['name']} 已被其他请求抢先，停止读取")
+                    return None
+                if getattr(chunk, 'usage', None):
+                    self._record_usage(chunk.usage)
+                    usage_seen = True
+                if not chunk.choices:
+                    continue
+                
+                content = chunk.choices[0].delta.content
+                if not content:
+                    continue
+                if first_token_time is None:
+                    first_token_time = time.time()
+                
+                candidate = scanner.feed(content)
+                if candidate and self._has_required_fields(candidate):
+                    early_stop = True
+                    break
+            
+            decision_time = time.time()
+            result = scanner.text
             
-            json_str = response[start_idx:end_idx]
+            # 用量只在最后一个数据块返回，决策已定后继续读完剩余内容取用量，超时才断开
+            if early_stop and not usage_seen:
+                usage_seen = self._drain_stream_usage(stream, cancel_event)
+            if not usage_seen:
+                logger.warning(f"AI接口 {endpoint['name']} 未返回token用量，本次用量未知")
+                if self.metrics:
+                    self.metrics.increment('ai.usage_unknown')
             
-            # 清理JSON字符串
-            json_str = self._clean_json_string(json_str)
+            ttft = (first_token_time or decision_time) - request_start
+            logger.info(f"DeepSeek原始回复: {result}")
+            logger.info(f"AI流式耗时: 首token {ttft:.2f}s, 决策 {decision_time - request_start:.2f}s"
+                        f"{' (JSON完整提前结束)' if early_stop else ''}")
             
-            # 解析JSON
-            data = json.loads(json_str)
+            if self.metrics:
+                self.metrics.record('ai.ttft', ttft)
+                self.metrics.record('ai.time_to_decision', decision_time - request_start)
+                if early_stop:
+                    self.metrics.increment('ai.stream_early_stop')
             
-            # 验证必需字段
-            required_fields = ['signal', 'reason', 'stop_loss', 'take_profit', 'confidence', 'risk_level']
-            if not all(field in data for field in required_fields):
-                logger.warning("AI响应缺少必需字段")
-                return None
+            return result
             
+        except Exception as e:
+            logger.error(f"调用AI API失败: {e}")
+            return None
+        finally:
+            if stream is not None:
+                try:
+                    stream.close()
+                except Exception:
+                    pass
+    
+    def _drain_stream_usage(self, stream, cancel_event: threading.Event = None) -> bool:
+        """读取流的剩余部分直到用量块到达（最多 stream_usage_wait 秒）"""
+        wait = self.config.ai_config['stream_usage_wait'] if self.config else 3.0
+        deadline = time.time() + wait
+        for chunk in stream:
+            if getattr(chunk, 'usage', None):
+                self._record_usage(chunk.usage)
+                return True
+            if time.time() > deadline or (cancel_event is not None and cancel_event.is_set()):
+                break
+        return False
+    
+    def _has_required_fields(self, json_str: str) -> bool:
+        """JSON对象是否已包含全部必需字段"""
+        return LLMJSONParser.parse(json_str, self.REQUIRED_FIELDS) is not None
+    
+    def _record_usage(self, usage):
+        """记录本次调用的token用量"""
+        if usage is None:
+            return
+        
+        prompt_tokens = getattr(usage, 'prompt_tokens', 0) or 0
+        completion_tokens = getattr(usage, 'completion_tokens', 0) or 0
+        # DeepSeek前缀缓存命中/未命中的提示token
+        cache_hit_tokens = getattr(usage, 'prompt_cache_hit_tokens', 0) or 0
+        cache_miss_tokens = getattr(usage, 'prompt_cache_miss_tokens', 0) or 0
+        logger.info(f"AI token用量: 提示 {prompt_tokens} (缓存命中 {cache_hit_tokens}, 未命中 {cache_miss_tokens}), "
+                    f"生成 {completion_tokens}")
+        self._usage_local.usage = {
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens,
+            'prompt_cache_hit_tokens': cache_hit_tokens,
+            'prompt_cache_miss_tokens': cache_miss_tokens
+        }
+        
+        if self.metrics:
+            self.metrics.increment('ai.calls')
+            self.metrics.increment('ai.prompt_tokens', prompt_tokens)
+            self.metrics.increment('ai.completion_tokens', completion_tokens)
+            self.metrics.increment('ai.prompt_cache_hit_tokens', cache_hit_tokens)
+            self.metrics.increment('ai.prompt_cache_miss_tokens', cache_miss_tokens)
+    
+    def _create_signal(self, data: Dict, market_data: Dict) -> Optional[SignalData]:
+        """由已解析的AI响应（字段已校验齐全）创建信号，取值非法时返回None"""
+        try:
             # 创建信号数据
             signal_data = SignalData(
                 signal=SignalType(data['signal']),
@@ -1227,59 +4696,10 @@ class AIAnalyzer:
             
             return signal_data
             
-        except json.JSONDecodeError as e:
-            logger.error(f"JSON解析失败: {e}")
-            logger.debug(f"原始响应: {response}")
-            return None
         except Exception as e:
             logger.error(f"解析AI响应失败: {e}")
             return None
     
-    def _clean_json_string(self, json_str: str) -> str:
-        """简洁的JSON字符串清理函数"""
-        try:
-            # 先尝试直接解析
-            json.loads(json_str)
-            return json_str
-        except json.JSONDecodeError:
-            pass
-        
-        # 1. 用状态机智能替换字符串边界单引号
-        result = []
-        in_string = False
-        string_quote = None
-        
-        for i, char in enumerate(json_str):
-            if char in ('"', "'"):
-                if i > 0 and json_str[i-1] == '\\':
-                    # 转义引号，直接添加
-                    result.append(char)
-                elif not in_string:
-                    # 字符串开始
-                    in_string = True
-                    string_quote = char
-                    result.append('"')  # 统一用双引号
-                elif char == string_quote:
-                    # 字符串结束
-                    in_string = False
-                    string_quote = None
-                    result.append('"')  # 统一用双引号
-                else:
-                    # 字符串内的其他引号
-                    result.append(char)
-            else:
-                result.append(char)
-        
-        cleaned = ''.join(result)
-        
-        # 2. 给键名加双引号（如果缺失）
-        cleaned = re.sub(r'(\s*)(\w+)(\s*):', r'\1"\2"\3:', cleaned)
-        
-        # 3. 移除末尾逗号
-        cleaned = re.sub(r',(\s*[}\]])', r'\1', cleaned)
-        
-        return cleaned
-    
     def _create_fallback_signal(self, market_data: Dict) -> SignalData:
         """创建备用信号"""
         current_price = market_data.get('price', 0)
@@ -1296,14 +4716,144 @@ class AIAnalyzer:
             is_fallback=True
         )
 
+class InferenceGate:
+    """
+    AI调用门控
+    
+    对比本次与上次调用AI时的特征（趋势标签、RSI区间、布林突破、ATR、持仓盈亏、价格），
+    变化评分达到阈值或超过最长间隔才调用AI；周期之间价格急变时可提前触发
+    """
+    
+    def __init__(self, ai_config: Dict):
+        self.threshold = ai_config['gate_threshold']
+        self.max_staleness = ai_config['gate_max_staleness']
+        self.atr_jump = ai_config['gate_atr_jump']
+        self.pnl_step = ai_config['gate_pnl_step']
+        self.price_move = ai_config['gate_price_move']
+        self.sharp_move = ai_config['gate_sharp_move']
+        self.lock = threading.Lock()
+        self.last_features: Optional[Dict] = None
+        self.last_inference_time = 0.0
+        self.sharp_reference: Optional[float] = None  # 上次急变触发时的价格，避免同一波动重复触发
+    
+    @staticmethod
+    def extract_features(market_data: Dict, position_info: Optional[Dict]) -> Dict:
+        """从行情和持仓中提取门控特征"""
+        tech = market_data.get('technical_data', {})
+        trend = market_data.get('trend_analysis', {})
+        price = market_data.get('price', 0)
+        
+        rsi = tech.get('rsi', 50)
+        rsi_band = 'overbought' if rsi > 70 else 'oversold' if rsi < 30 else 'neutral'
+        
+        bb_upper = tech.get('bb_upper', 0)
+        bb_lower = tech.get('bb_lower', 0)
+        bb_state = 'inside'
+        if bb_upper and price > bb_upper:
+            bb_state = 'above'
+        elif bb_lower and price < bb_lower:
+            bb_state = 'below'
+        
+        position_side = None
+        pnl_pct = 0.0
+        if position_info:
+            position_side = position_info['side']
+            notional = position_info['size'] * position_info['entry_price']
+            pnl_pct = position_info['unrealized_pnl'] / notional * 100 if notional else 0.0
+        
+        return {
+            'price': price,
+            'overall': trend.get('overall'),
+            'short_term': trend.get('short_term'),
+            'rsi_band': rsi_band,
+            'bb_state': bb_state,
+            'atr': tech.get('atr', 0),
+            'position_side': position_side,
+            'pnl_pct': pnl_pct
+        }
+    
+    def score(self, features: Dict) -> Tuple[float, List[str]]:
+        """相对上次调用AI时的特征变化评分"""
+        last = self.last_features
+        if last is None:
+            return float('inf'), ['首次分析']
+        
+        score = 0.0
+        reasons = []
+        
+        if features['overall'] != last['overall']:
+            score += 1.0
+            reasons.append(f"整体趋势 {last['overall']}→{features['overall']}")
+        if features['short_term'] != last['short_term']:
+            score += 0.5
+            reasons.append(f"短期趋势 {last['short_term']}→{features['short_term']}")
+        if features['rsi_band'] != last['rsi_band']:
+            score += 1.0
+            reasons.append(f"RSI区间 {last['rsi_band']}→{features['rsi_band']}")
+        if features['bb_state'] != last['bb_state']:
+            score += 1.0
+            reasons.append(f"布林带 {last['bb_state']}→{features['bb_state']}")
+        if last['atr'] and abs(features['atr'] / last['atr'] - 1) >= self.atr_jump:
+            score += 0.5
+            reasons.append(f"ATR {last['atr']:.3f}→{features['atr']:.3f}")
+        if features['position_side'] != last['position_side']:
+            score += 1.0
+            reasons.append(f"持仓 {last['position_side']}→{features['position_side']}")
+        elif math.floor(features['pnl_pct'] / self.pnl_step) != math.floor(last['pnl_pct'] / self.pnl_step):
+            score += 1.0
+            reasons.append(f"持仓盈亏 {last['pnl_pct']:+.2f}%→{features['pnl_pct']:+.2f}%")
+        if last['price'] and abs(features['price'] / last['price'] - 1) * 100 >= self.price_move:
+            score += 0.5
+            reasons.append(f"价格 {last['price']:.2f}→{features['price']:.2f}")
+        
+        return score, reasons
+    
+    def evaluate(self, features: Dict, trigger: str = None) -> Tuple[bool, float, List[str]]:
+        """
+        是否需要调用AI
+        
+        Returns:
+            (是否调用, 变化评分, 触发原因)
+        """
+        with self.lock:
+            score, reasons = self.score(features)
+            if trigger:
+                return True, score, [trigger] + reasons
+            if time.time() - self.last_inference_time >= self.max_staleness:
+                return True, score, [f"超过{self.max_staleness}秒未分析"] + reasons
+            return score >= self.threshold, score, reasons
+    
+    def mark_inferred(self, features: Dict):
+        """记录本次调用AI时的特征，作为后续比较基准"""
+        with self.lock:
+            self.last_features = features
+            self.last_inference_time = time.time()
+            self.sharp_reference = None
+    
+    def check_sharp_move(self, price: float) -> bool:
+        """相对上次分析价格是否急变（周期外触发）"""
+        with self.lock:
+            if not self.last_features or not price:
+                return False
+            reference = self.sharp_reference or self.last_features['price']
+            if not reference or abs(price / reference - 1) * 100 < self.sharp_move:
+                return False
+            self.sharp_reference = price
+            return True
+
 class PositionManager:
     """仓位管理器"""
     
-    def __init__(self, config: TradeConfig, exchange, order_manager: OrderManager):
+    def __init__(self, config: TradeConfig, exchange, order_manager: OrderManager,
+                 account_state: AccountStateService, metrics: PerformanceMetrics = None):
         self.config = config
         self.exchange = exchange
         self.order_manager = order_manager
+        self.account_state = account_state
+        self.metrics = metrics
         self.current_position = None
+        self.one_way_mode = None  # 首次反手时查询持仓模式
+        self.mode_retry_at = 0.0  # 查询失败时按单向处理，到该时间后再重新查询
     
     def calculate_position_size(self, signal_data: SignalData, price_data: Dict) -> float:
         """计算仓位大小"""
@@ -1389,7 +4939,11 @@ class PositionManager:
             return max(self.config.min_amount, 0.1)
     
     def execute_trade(self, signal_data: SignalData, price_data: Dict, risk_manager: RiskManager):
-        """执行交易"""
+        """执行交易（持有止损止盈锁，开平仓、反手和挂单期间移动止损不会改单）"""
+        with self.order_manager.bracket_lock:
+            self._execute_trade(signal_data, price_data, risk_manager)
+    
+    def _execute_trade(self, signal_data: SignalData, price_data: Dict, risk_manager: RiskManager):
         try:
             # 获取当前持仓
             current_position = self._fetch_position()
@@ -1399,9 +4953,9 @@ class PositionManager:
             
             # 执行交易逻辑
             if signal_data.signal == SignalType.BUY:
-                self._execute_buy(position_size, current_position, signal_data)
+                opened = self._execute_buy(position_size, current_position, signal_data)
             elif signal_data.signal == SignalType.SELL:
-                self._execute_sell(position_size, current_position, signal_data)
+                opened = self._execute_sell(position_size, current_position, signal_data)
             elif signal_data.signal == SignalType.HOLD:
                 logger.info("观望信号，不执行交易")
                 # 即使观望，也检查是否需要更新止盈止损
@@ -1409,13 +4963,24 @@ class PositionManager:
                     #self._update_orders(current_position, signal_data)
                 return
             
+            if not opened:
+                # 反手或开仓未完成：目标方向没有持仓时不挂止盈止损，部分成交时按实际持仓保护
+                target_side = 'long' if signal_data.signal == SignalType.BUY else 'short'
+                position = self._fetch_position()
+                if not position or position['side'] != target_side:
+                    logger.error(f"反手或开仓失败，未建立{target_side}持仓，跳过止盈止损设置")
+                    return
+                logger.warning(f"持仓未按计划建立，按实际持仓 {position['size']:.2f}张 设置止盈止损")
+                position_size = position['size']
+            
             # 设置止盈止损
             if position_size > 0:
                 success = self.order_manager.setup_stop_loss_take_profit(
                     position_side=signal_data.signal.value.lower(),
                     position_size=position_size,
                     stop_loss_price=signal_data.stop_loss,
-                    take_profit_price=signal_data.take_profit
+                    take_profit_price=signal_data.take_profit,
+                    current_price=price_data.get('price')
                 )
                 
                 if success:
@@ -1439,19 +5004,14 @@ class PositionManager:
             logger.error(f"执行交易失败: {e}")
             raise
     
-    def _execute_buy(self, position_size: float, current_position: Optional[Dict], signal_data: SignalData):
-        """执行买入"""
+    def _execute_buy(self, position_size: float, current_position: Optional[Dict],
+                     signal_data: SignalData) -> bool:
+        """执行买入，返回多仓是否按计划建立"""
         try:
             if current_position and current_position['side'] == 'short':
                 # 平空开多
                 logger.info(f"平空仓 {current_position['size']:.2f}张，开多仓 {position_size:.2f}张")
-                
-                # 平空仓
-                self.order_manager.create_market_order('buy', current_position['size'], reduce_only=True)
-                time.sleep(1)
-                
-                # 开多仓
-                self.order_manager.create_market_order('buy', position_size)
+                return self._reverse_position(current_position, 'long', position_size, signal_data.price)
                 
             elif current_position and current_position['side'] == 'long':
                 # 调整多仓
@@ -1468,29 +5028,26 @@ class PositionManager:
                         self.order_manager.create_market_order('sell', reduce_size, reduce_only=True)
                 else:
                     logger.info("仓位合适，保持现状")
+                return True
             
             else:
-                # 开新多仓
+                # 开新多仓（先清掉上一笔持仓遗留的条件单，避免reduceOnly旧单作用到新仓位）
                 logger.info(f"开多仓 {position_size:.2f}张")
-                self.order_manager.create_market_order('buy', position_size)
+                self.order_manager.cancel_existing_orders()
+                return self.order_manager.create_market_order('buy', position_size) is not None
                 
         except Exception as e:
             logger.error(f"执行买入失败: {e}")
             raise
     
-    def _execute_sell(self, position_size: float, current_position: Optional[Dict], signal_data: SignalData):
-        """执行卖出"""
+    def _execute_sell(self, position_size: float, current_position: Optional[Dict],
+                      signal_data: SignalData) -> bool:
+        """执行卖出，返回空仓是否按计划建立"""
         try:
             if current_position and current_position['side'] == 'long':
                 # 平多开空
                 logger.info(f"平多仓 {current_position['size']:.2f}张，开空仓 {position_size:.2f}张")
-                
-                # 平多仓
-                self.order_manager.create_market_order('sell', current_position['size'], reduce_only=True)
-                time.sleep(1)
-                
-                # 开空仓
-                self.order_manager.create_market_order('sell', position_size)
+                return self._reverse_position(current_position, 'short', position_size, signal_data.price)
                 
             elif current_position and current_position['side'] == 'short':
                 # 调整空仓
@@ -1507,72 +5064,132 @@ class PositionManager:
                         self.order_manager.create_market_order('buy', reduce_size, reduce_only=True)
                 else:
                     logger.info("仓位合适，保持现状")
+                return True
             
             else:
-                # 开新空仓
+                # 开新空仓（先清掉上一笔持仓遗留的条件单，避免reduceOnly旧单作用到新仓位）
                 logger.info(f"开空仓 {position_size:.2f}张")
-                self.order_manager.create_market_order('sell', position_size)
+                self.order_manager.cancel_existing_orders()
+                return self.order_manager.create_market_order('sell', position_size) is not None
                 
         except Exception as e:
             logger.error(f"执行卖出失败: {e}")
             raise
     
+    def _is_one_way_mode(self) -> bool:
+        """
+        是否单向持仓模式（结果缓存；查询失败时按单向处理，机器人下单本身不带positionSide，
+        失败结果缓存一小时后再重新查询，避免每次反手都多一次失败请求）
+        """
+        if self.one_way_mode is None and time.time() >= self.mode_retry_at:
+            try:
+                response = self.exchange.fapiPrivateGetPositionSideDual()
+                dual = str(response.get('dualSidePosition')).lower() == 'true'
+                self.one_way_mode = not dual
+            except Exception as e:
+                logger.warning(f"查询持仓模式失败，按单向持仓处理: {e}")
+                self.mode_retry_at = time.time() + 3600
+        return self.one_way_mode if self.one_way_mode is not None else True
+    
+    def _reverse_position(self, current_position: Dict, target_side: str, position_size: float,
+                          reference_price: float) -> bool:
+        """
+        反手
+        
+        单向持仓模式下用一笔 平仓量+开仓量 的市价单完成；成交后按成交回报和最新持仓校验，不再固定等待。
+        记录反手耗时和相对信号价格的滑点
+        """
+        order_side = 'buy' if target_side == 'long' else 'sell'
+        start = time.time()
+        
+        if self._is_one_way_mode():
+            amount = current_position['size'] + position_size
+            order = self.order_manager.create_market_order(
+                order_side, amount, params={'newOrderRespType': 'RESULT'}
+            )
+            orders = [order] if order else []
+        else:
+            # 双向持仓模式无法单笔反手，平仓成交确认后再开仓；
+            # 该模式下必须指定positionSide，且交易所不接受reduceOnly（按positionSide判断开平）
+            logger.info("双向持仓模式，分两步反手")
+            orders = []
+            close_order = self.order_manager.create_market_order(
+                order_side, current_position['size'],
+                params={'newOrderRespType': 'RESULT', 'positionSide': current_position['side'].upper()}
+            )
+            if close_order and close_order.get('status') in ('closed', None):
+                orders.append(close_order)
+                open_order = self.order_manager.create_market_order(
+                    order_side, position_size,
+                    params={'newOrderRespType': 'RESULT', 'positionSide': target_side.upper()}
+                )
+                if open_order:
+                    orders.append(open_order)
+        
+        if not orders:
+            logger.error("反手下单失败")
+            return False
+        
+        # 原持仓的平仓方向与反手下单方向相同，该方向的旧止损止盈已无保护作用，立即撤销
+        self.order_manager.cancel_existing_orders(side=order_side)
+        
+        # 下单后持仓快照已失效，推送模式下等待成交事件，否则REST拉取
+        position = self._fetch_position()
+        elapsed = time.time() - start
+        
+        filled = sum(float(order.get('filled') or 0) for order in orders)
+        cost = sum(float(order.get('filled') or 0) * float(order.get('average') or 0) for order in orders)
+        average = cost / filled if filled else 0.0
+        
+        verified = (position is not None and position['side'] == target_side and
+                    abs(position['size'] - position_size) < (self.config.min_amount or 1e-9))
+        
+        slippage_bps = 0.0
+        if average and reference_price:
+            # 正值表示不利滑点
+            direction = 1 if order_side == 'buy' else -1
+            slippage_bps = (average - reference_price) / reference_price * 10000 * direction
+        
+        logger.info(f"反手{'成功' if verified else '未确认'}: 成交 {filled:.2f}张 均价 ${average:.2f}, "
+                    f"耗时 {elapsed:.2f}秒, 滑点 {slippage_bps:+.1f}bp, "
+                    f"当前持仓 {position['side'] + ' ' + str(position['size']) if position else '无'}")
+        
+        if self.metrics:
+            self.metrics.record('trade.reversal', elapsed)
+            self.metrics.increment('trade.reversals')
+            self.metrics.increment('trade.reversal_slippage_bps', slippage_bps)
+            if not verified:
+                self.metrics.increment('trade.reversal_unverified')
+        
+        return verified
+    
     def _update_orders(self, position: Dict, signal_data: SignalData):
-        """更新订单"""
+        """更新订单（按差异调整，止损止盈未变化时不产生任何订单操作）"""
         try:
             logger.info("更新现有订单...")
             
-            # 取消现有条件订单
-            cancelled = self.order_manager.cancel_existing_orders()
+            success = self.order_manager.setup_stop_loss_take_profit(
+                position_side=position['side'],
+                position_size=position['size'],
+                stop_loss_price=signal_data.stop_loss,
+                take_profit_price=signal_data.take_profit
+            )
             
-            if cancelled > 0:
-                # 重新设置止盈止损
-                success = self.order_manager.setup_stop_loss_take_profit(
-                    position_side=position['side'],
-                    position_size=position['size'],
-                    stop_loss_price=signal_data.stop_loss,
-                    take_profit_price=signal_data.take_profit
-                )
-                
-                if success:
-                    logger.info("订单更新成功")
-                else:
-                    logger.warning("订单更新失败")
+            if success:
+                logger.info("订单更新成功")
+            else:
+                logger.warning("订单更新失败")
             
         except Exception as e:
             logger.error(f"更新订单失败: {e}")
     
     def _fetch_balance(self) -> Dict:
         """获取余额"""
-        try:
-            balance = self.exchange.fetch_balance()
-            return {
-                'free': float(balance.get('USDT', {}).get('free', 1000)),
-                'total': float(balance.get('USDT', {}).get('total', 1000))
-            }
-        except Exception as e:
-            logger.error(f"获取余额失败: {e}")
-            return {'free': 1000.0, 'total': 1000.0}
+        return self.account_state.get_balance() or {'free': 1000.0, 'total': 1000.0}
     
     def _fetch_position(self) -> Optional[Dict]:
         """获取持仓"""
-        try:
-            positions = self.exchange.fetch_positions([self.config.symbol])
-            for pos in positions:
-                if pos['symbol'] == self.config.symbol:
-                    contracts = float(pos['contracts'] or 0)
-                    if contracts > 0:
-                        return {
-                            'side': pos['side'],
-                            'size': contracts,
-                            'entry_price': float(pos['entryPrice'] or 0),
-                            'unrealized_pnl': float(pos['unrealizedPnl'] or 0),
-                            'leverage': float(pos['leverage'] or self.config.leverage)
-                        }
-            return None
-        except Exception as e:
-            logger.error(f"获取持仓失败: {e}")
-            return None
+        return self.account_state.get_position()
 
 # ============================================================================
 # 主交易机器人类
@@ -1595,8 +5212,13 @@ class EnhancedTradingBot:
         # 初始化交易所
         self.exchange = self._init_exchange()
         
+        # 并行执行与性能指标
+        self.executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='cycle')
+        self.metrics = PerformanceMetrics(export_path=os.getenv('METRICS_PATH', 'logs/metrics8.json'))
+        
         # 初始化AI分析器
-        self.ai_analyzer = AIAnalyzer(api_key=os.getenv('DEEPSEEK_API_KEY'), config = self.config)
+        self.ai_analyzer = AIAnalyzer(api_key=os.getenv('DEEPSEEK_API_KEY'), config = self.config,
+                                      metrics=self.metrics)
         
         # 初始化钉钉管理器
         self.dingtalk = DingTalkManager(
@@ -1606,17 +5228,42 @@ class EnhancedTradingBot:
             user=self.config.user
         )
         
+        # 初始化账户状态快照
+        self.account_state = AccountStateService(self.exchange, self.config, self.metrics)
+        
+        # 用户数据推送（持仓、余额、条件单镜像）
+        self.user_stream = None
+        if self.config.stream_config['enable_user_stream']:
+            self.user_stream = UserDataStream(self.exchange, self.config)
+            self.account_state.attach_stream(self.user_stream)
+        
         # 初始化订单管理器
-        self.order_manager = OrderManager(self.exchange, self.config.symbol, self.config)
+        self.order_manager = OrderManager(self.exchange, self.config.symbol, self.config, self.account_state)
         
         # 初始化风险管理器
-        self.risk_manager = RiskManager(self.config, self.exchange)
+        self.risk_manager = RiskManager(self.config, self.exchange, self.account_state)
         
         # 初始化市场数据获取器
-        self.market_fetcher = MarketDataFetcher(self.exchange, self.config.symbol, self.config)
+        # 行情使用独立的公共接口实例：sync ccxt实例（会话、限频计时）不是线程安全的，
+        # 周期内行情与账户查询并行时不能共用同一个实例
+        self.market_exchange = self._init_market_exchange()
+        self.market_fetcher = MarketDataFetcher(self.market_exchange, self.config.symbol, self.config)
         
         # 初始化仓位管理器
-        self.position_manager = PositionManager(self.config, self.exchange, self.order_manager)
+        self.position_manager = PositionManager(self.config, self.exchange, self.order_manager, self.account_state,
+                                                self.metrics)
+        
+        # 本地分档移动止损
+        self.trailing = None
+        if self.config.trailing_config['enable_trailing']:
+            self.trailing = TrailingStopEngine(self.exchange, self.order_manager, self.account_state,
+                                               self.config, self.metrics)
+        
+        # 收盘前预分析结果（Future）
+        self.speculation = None
+        
+        # AI调用门控
+        self.inference_gate = InferenceGate(self.config.ai_config) if self.config.ai_config['enable_gate'] else None
         
         # 交易状态
         self.signal_history = []
@@ -1625,7 +5272,7 @@ class EnhancedTradingBot:
         
         logger.info("交易机器人初始化完成")
     
-    def _init_exchange(self) -> ccxt.Exchange:
+    def _init_exchange(self) -> SerializedExchange:
         """初始化交易所"""
         try:
             exchange = ccxt.binance({
@@ -1640,12 +5287,22 @@ class EnhancedTradingBot:
             # 测试连接
             exchange.fetch_time()
             logger.info("Binance连接成功")
-            return exchange
+            # 交易周期、移动止损、用户数据推送与后台报告线程共用该实例，调用需串行
+            return SerializedExchange(exchange)
             
         except Exception as e:
             logger.error(f"Binance连接失败: {e}")
             raise
     
+    def _init_market_exchange(self) -> ccxt.Exchange:
+        """初始化行情专用交易所实例（只访问公共接口，不带密钥）"""
+        return ccxt.binance({
+            'options': {'defaultType': 'future'},
+            'enableRateLimit': True,
+            'timeout': 30000,
+            'verbose': False,
+        })
+    
     def setup(self) -> bool:
         """设置机器人"""
         try:
@@ -1653,6 +5310,7 @@ class EnhancedTradingBot:
             
             # 加载市场数据
             markets = self.exchange.load_markets()
+            self.market_exchange.set_markets(markets, self.exchange.currencies)
             if self.config.symbol not in markets:
                 logger.error(f"交易对 {self.config.symbol} 不存在")
                 return False
@@ -1666,6 +5324,13 @@ class EnhancedTradingBot:
             logger.info(f"合约规格: 1张 = {self.config.contract_size} SOL")
             logger.info(f"最小交易量: {self.config.min_amount} 张")
             
+            # 校准服务器时间（K线缓存与周期调度按交易所收盘边界对齐）
+            self.market_fetcher.sync_server_time()
+            
+            # 启动K线推送
+            if self.market_fetcher.start_stream():
+                logger.info(f"K线推送模式: {self.config.timeframe}")
+            
             # 设置杠杆
             try:
                 self.exchange.set_leverage(self.config.leverage, self.config.symbol)
@@ -1673,6 +5338,14 @@ class EnhancedTradingBot:
             except Exception as e:
                 logger.warning(f"杠杆设置失败: {e}")
             
+            # 启动用户数据推送
+            if self.user_stream and self.user_stream.start():
+                logger.info("账户镜像模式: 用户数据推送")
+            
+            # 启动移动止损
+            if self.trailing and not self.config.test_mode:
+                self.trailing.start()
+            
             # 获取账户信息
             balance = self._fetch_balance_safe()
             usdt_balance = balance.get('free', 0)
@@ -1713,84 +5386,73 @@ class EnhancedTradingBot:
     
     def _fetch_balance_safe(self) -> Dict:
         """安全获取余额"""
-        return RetryManager.retry_operation(
-            lambda: self._fetch_balance(),
-            max_retries=3,
-            delay=1
-        ) or {'free': 1000.0, 'total': 1000.0}
-    
-    def _fetch_balance(self) -> Dict:
-        """获取余额"""
-        try:
-            balance = self.exchange.fetch_balance()
-            return {
-                'free': float(balance.get('USDT', {}).get('free', 1000)),
-                'total': float(balance.get('USDT', {}).get('total', 1000))
-            }
-        except Exception as e:
-            logger.error(f"获取余额失败: {e}")
-            raise
+        return self.account_state.get_balance() or {'free': 1000.0, 'total': 1000.0}
     
     def _fetch_position_safe(self) -> Optional[Dict]:
         """安全获取持仓"""
-        return RetryManager.retry_operation(
-            lambda: self._fetch_position(),
-            max_retries=3,
-            delay=1
-        )
-    
-    def _fetch_position(self) -> Optional[Dict]:
-        """获取持仓"""
-        try:
-            positions = self.exchange.fetch_positions([self.config.symbol])
-            for pos in positions:
-                if pos['symbol'] == self.config.symbol:
-                    contracts = float(pos['contracts'] or 0)
-                    if contracts > 0:
-                        return {
-                            'side': pos['side'],
-                            'size': contracts,
-                            'entry_price': float(pos['entryPrice'] or 0),
-                            'unrealized_pnl': float(pos['unrealizedPnl'] or 0),
-                            'leverage': float(pos['leverage'] or self.config.leverage)
-                        }
-            return None
-        except Exception as e:
-            logger.error(f"获取持仓失败: {e}")
-            raise
+        return self.account_state.get_position()
     
-    def run_trading_cycle(self):
-        """运行交易周期"""
+    def run_trading_cycle(self, trigger: str = None):
+        """
+        运行交易周期
+        
+        行情（独立的行情连接）在后台获取，同时在当前线程依次拉取持仓和检查风控（共用交易账户连接，
+        sync ccxt实例不跨线程并发使用）；风控通过后才调用AI；通知与状态报告不占用关键路径
+        
+        Args:
+            trigger: 周期外触发原因（如价格急变），门控直接放行
+        """
+        self.cycle_count += 1
+        cycle_start = time.time()
+        decision_time = None
+        stage_times = {}
+        
         try:
-            self.cycle_count += 1
             logger.info(f"🏁 开始第 {self.cycle_count} 个交易周期")
             
+            # 新周期重新拉取账户快照
+            self.account_state.begin_cycle()
+            
             # 重置日统计（如果跨天）
             self.risk_manager.reset_daily_stats()
             
-            # 检查风险限制
-            risk_ok, risk_msg = self.risk_manager.check_risk_limits()
+            market_future = self.executor.submit(self._timed, 'market', stage_times, self.market_fetcher.get_price_data)
+            
+            # 获取当前持仓
+            current_position = self._timed('position', stage_times, self._fetch_position_safe)
+            
+            # 检查风险限制（不通过时不调用AI）
+            risk_ok, risk_msg = self._timed('risk', stage_times, self.risk_manager.check_risk_limits)
             if not risk_ok:
                 logger.warning(f"风险限制: {risk_msg}")
                 self.dingtalk.send_alert("risk", risk_msg, "warning")
                 return
             
             # 获取市场数据
-            price_data = self.market_fetcher.get_price_data()
+            price_data = market_future.result()
             if not price_data:
                 logger.error("获取市场数据失败")
                 self.dingtalk.send_alert("error", "获取市场数据失败", "warning")
                 return
             
-            # 获取当前持仓
-            current_position = self._fetch_position_safe()
-            
-            # AI分析市场
-            signal_data = self.ai_analyzer.analyze_market(
-                market_data=price_data,
-                signal_history=self.signal_history,
-                position_info=current_position
-            )
+            # 特征变化不足时跳过本周期AI分析
+            gate_features = None
+            if self.inference_gate:
+                gate_features = self.inference_gate.extract_features(price_data, current_position)
+                should_infer, score, reasons = self.inference_gate.evaluate(gate_features, trigger)
+                if not should_infer:
+                    logger.info(f"特征无明显变化(评分{score:.1f})，跳过AI分析: {', '.join(reasons) or '无变化'}")
+                    self.metrics.increment('gate.skipped')
+                    return
+                logger.info(f"AI分析触发(评分{score:.1f}): {', '.join(reasons)}")
+                self.metrics.increment('gate.fired')
+            
+            # AI分析市场（收盘前预分析有效时直接采用）
+            signal_data = self._timed('ai', stage_times, self._resolve_signal, price_data, current_position)
+            decision_time = time.time()
+            
+            if self.inference_gate and signal_data and not signal_data.is_fallback:
+                self.inference_gate.mark_inferred(gate_features)
             
             # 保存信号历史
             if signal_data:
@@ -1803,27 +5465,97 @@ class EnhancedTradingBot:
                 logger.warning("信号无效，跳过执行")
                 return
             
-            # 发送信号通知
-            self._send_signal_notification(signal_data, price_data)
+            # 发送信号通知（后台发送，不阻塞下单）
+            self.executor.submit(self._send_signal_notification, signal_data, price_data)
             
-            # 执行交易
+            # 同向信号的止损不低于已移动的止损
+            if self.trailing and signal_data.signal != SignalType.HOLD:
+                side = 'long' if signal_data.signal == SignalType.BUY else 'short'
+                stop_loss = self.trailing.tighten_stop(side, signal_data.stop_loss)
+                if stop_loss != signal_data.stop_loss:
+                    logger.info(f"沿用移动止损: {signal_data.stop_loss:.2f} → {stop_loss:.2f}")
+                    signal_data = replace(signal_data, stop_loss=stop_loss)
+            
+            # 执行交易（移动止损暂停到下单后同步完成）
             if not self.config.test_mode:
-                self.position_manager.execute_trade(signal_data, price_data, self.risk_manager)
+                if self.trailing:
+                    self.trailing.pause()
+                try:
+                    self._timed('trade', stage_times, self.position_manager.execute_trade,
+                                signal_data, price_data, self.risk_manager)
+                finally:
+                    if self.trailing:
+                        self._sync_trailing(signal_data, price_data)
             else:
                 logger.info("测试模式，模拟交易")
             
-            # 记录状态
-            self._log_status_report()
+            # 记录状态（后台执行）
+            self.executor.submit(self._log_status_report)
             
             # 定期发送绩效报告
             if self.cycle_count % 10 == 0:
-                self._send_performance_report()
+                self.executor.submit(self._send_performance_report)
             
             logger.info(f"✅ 第 {self.cycle_count} 个交易周期完成")
             
         except Exception as e:
             logger.error(f"交易周期执行失败: {e}")
             self.dingtalk.send_alert("error", f"交易周期异常: {str(e)[:200]}", "error")
+        
+        finally:
+            # 风控拦截、门控跳过、信号无效等提前返回的周期同样计入耗时统计
+            self._record_cycle_latency(cycle_start, decision_time, stage_times)
+    
+    def _sync_trailing(self, signal_data: SignalData, price_data: Dict):
+        """把下单后的持仓和止损止盈交给移动止损跟踪（HOLD沿用已跟踪的价格）"""
+        try:
+            levels = (None, None)
+            if signal_data.signal != SignalType.HOLD:
+                levels = (signal_data.stop_loss, signal_data.take_profit)
+            atr = price_data.get('technical_data', {}).get('atr', 0)
+            self.trailing.sync(self.account_state.get_position(), atr, *levels)
+        except Exception as e:
+            logger.error(f"同步移动止损失败: {e}")
+            self.trailing.resume()
+    
+    def _timed(self, stage: str, stage_times: Dict[str, float], operation, *args, **kwargs):
+        """执行并记录阶段耗时"""
+        start = time.time()
+        try:
+            return operation(*args, **kwargs)
+        finally:
+            elapsed = time.time() - start
+            stage_times[stage] = elapsed
+            self.metrics.record(f"cycle.{stage}", elapsed)
+    
+    def _record_cycle_latency(self, cycle_start: float, decision_time: Optional[float],
+                              stage_times: Dict[str, float]):
+        """
+        记录关键路径耗时（周期开始到决策/下单完成，以及距K线收盘的延迟）
+        
+        每个周期都记录总耗时；未走到决策（风控拦截、门控跳过、行情失败）的周期不记录决策和收盘到下单耗时
+        """
+        try:
+            end_time = time.time()
+            critical_path = end_time - cycle_start
+            self.metrics.record('cycle.critical_path', critical_path)
+            
+            close_text = ""
+            if decision_time is not None:
+                # 距最近一次K线收盘（服务器时间）的延迟
+                timeframe_ms = self.exchange.parse_timeframe(self.config.timeframe) * 1000
+                close_to_order = (self.market_fetcher.server_time_ms() % timeframe_ms) / 1000
+                self.metrics.record('cycle.decision', decision_time - cycle_start)
+                self.metrics.record('cycle.close_to_order', close_to_order)
+                close_text = f" | 收盘到下单 {close_to_order:.2f}s"
+            else:
+                self.metrics.increment('cycle.no_decision')
+            self.metrics.export()
+            
+            stages = " | ".join(f"{name} {seconds:.2f}s" for name, seconds in stage_times.items())
+            logger.info(f"⏱️ 周期耗时: {stages} | 关键路径 {critical_path:.2f}s{close_text}")
+        except Exception as e:
+            logger.error(f"记录周期耗时失败: {e}")
     
     def _is_signal_valid(self, signal_data: SignalData, price_data: Dict) -> bool:
         """检查信号有效性"""
@@ -2014,9 +5746,103 @@ class EnhancedTradingBot:
         
         return f"{hours}小时{minutes}分钟"
     
+    def _speculate(self) -> Optional[Dict]:
+        """收盘前用未收盘K线预先调用AI"""
+        try:
+            logger.info("🔮 收盘前预分析开始")
+            price_data = self.market_fetcher.get_price_data()
+            if not price_data:
+                return None
+            position = self._fetch_position_safe()
+            
+            start = time.time()
+            signal_data = self.ai_analyzer.analyze_market(
+                market_data=price_data,
+                signal_history=self.signal_history,
+                position_info=position,
+                use_cache=False
+            )
+            return {
+                'price_data': price_data,
+                'position': position,
+                'signal': signal_data,
+                'created': start,
+                'elapsed': time.time() - start
+            }
+        except Exception as e:
+            logger.error(f"预分析失败: {e}")
+            return None
+    
+    def _resolve_signal(self, price_data: Dict, current_position: Optional[Dict]) -> Optional[SignalData]:
+        """收盘后的特征与预分析时一致则采用预分析结果，否则重新调用AI"""
+        signal_data = self._take_speculation(price_data, current_position)
+        if signal_data:
+            return signal_data
+        
+        return self.ai_analyzer.analyze_market(
+            market_data=price_data,
+            signal_history=self.signal_history,
+            position_info=current_position
+        )
+    
+    def _take_speculation(self, price_data: Dict, current_position: Optional[Dict]) -> Optional[SignalData]:
+        """校验并取出预分析结果"""
+        speculation, self.speculation = self.speculation, None
+        if speculation is None:
+            return None
+        
+        ai_config = self.config.ai_config
+        wait_start = time.time()
+        try:
+            result = speculation.result(timeout=ai_config['decision_deadline'])
+        except Exception:
+            result = None
+        waited = time.time() - wait_start
+        
+        if not result or not result['signal'] or result['signal'].is_fallback:
+            self.metrics.increment('speculation.miss')
+            return None
+        
+        # 预分析太久以前（如上一根K线遗留）不再使用
+        if time.time() - result['created'] > ai_config['speculation_lead'] + ai_config['decision_deadline'] + 60:
+            self.metrics.increment('speculation.miss')
+            return None
+        
+        provisional = InferenceGate.extract_features(result['price_data'], result['position'])
+        final = InferenceGate.extract_features(price_data, current_position)
+        drift = abs(final['price'] / provisional['price'] - 1) * 100 if provisional['price'] else float('inf')
+        macd_same = ((result['price_data'].get('technical_data', {}).get('macd_hist', 0) > 0) ==
+                     (price_data.get('technical_data', {}).get('macd_hist', 0) > 0))
+        labels_same = all(provisional[key] == final[key]
+                          for key in ('overall', 'short_term', 'rsi_band', 'bb_state', 'position_side'))
+        
+        if not (labels_same and macd_same and drift <= ai_config['speculation_tolerance']):
+            logger.info(f"预分析未命中: 价格偏移{drift:.3f}%, 特征一致={labels_same and macd_same}，重新分析")
+            self.metrics.increment('speculation.miss')
+            return None
+        
+        saved = max(result['elapsed'] - waited, 0.0)
+        self.metrics.increment('speculation.hit')
+        self.metrics.record('speculation.saved', saved)
+        hits = self.metrics.counters.get('speculation.hit', 0)
+        total = hits + self.metrics.counters.get('speculation.miss', 0)
+        logger.info(f"🔮 预分析命中: 价格偏移{drift:.3f}%, 节省{saved:.2f}秒 (命中率 {hits / total:.0%})")
+        
+        return replace(result['signal'], price=price_data.get('price', result['signal'].price))
+    
+    def _check_sharp_move(self) -> Optional[str]:
+        """周期之间检查价格急变，返回触发原因"""
+        price = self.market_fetcher.get_latest_price()
+        if price and self.inference_gate.check_sharp_move(price):
+            reason = f"价格急变至${price:.2f}"
+            logger.info(f"⚡ {reason}，提前执行交易周期")
+            self.metrics.increment('gate.off_cycle')
+            return reason
+        return None
+    
     def _calculate_wait_time(self) -> int:
-        """计算等待时间"""
-        now = datetime.now()
+        """计算等待时间（按交易所服务器时间对齐K线收盘）"""
+        now = datetime.fromtimestamp(self.market_fetcher.server_time_ms() / 1000)
         current_minute = now.minute
         current_second = now.second
         
@@ -2061,19 +5887,32 @@ class EnhancedTradingBot:
                 try:
                     # 计算等待时间
                     wait_time = self._calculate_wait_time()
+                    trigger = None
                     
                     if wait_time > 0:
                         logger.info(f"等待 {wait_time//60}分{wait_time%60}秒到下一个交易周期...")
                         
-                        # 分段等待，便于响应停止信号
-                        for _ in range(wait_time):
+                        # 分段等待，便于响应停止信号；开启门控时定期检查价格急变
+                        poll_interval = self.config.ai_config['gate_poll_interval']
+                        for elapsed in range(1, wait_time + 1):
                             if not self.is_running:
                                 break
                             time.sleep(1)
+                            if self.inference_gate and elapsed % poll_interval == 0 and wait_time - elapsed > poll_interval:
+                                trigger = self._check_sharp_move()
+                                if trigger:
+                                    break
+                            if (self.config.ai_config['enable_speculation'] and
+                                    wait_time - elapsed == self.config.ai_config['speculation_lead']):
+                                self.speculation = self.executor.submit(self._speculate)
+                    
+                    # 周期外触发时预分析对应的不是本次K线
+                    if trigger:
+                        self.speculation = None
                     
                     # 如果机器人还在运行，执行交易周期
                     if self.is_running:
-                        self.run_trading_cycle()
+                        self.run_trading_cycle(trigger)
                     
                 except KeyboardInterrupt:
                     logger.info("收到停止信号...")
@@ -2085,6 +5924,13 @@ class EnhancedTradingBot:
                     # 异常后等待1分钟再继续
                     time.sleep(60)
             
+            self.market_fetcher.stop_stream()
+            if self.user_stream:
+                self.user_stream.stop()
+            if self.trailing:
+                self.trailing.stop()
+            self.executor.shutdown(wait=True)
+            self.ai_analyzer.executor.shutdown(wait=False)
             logger.info("交易机器人已停止")
             self.dingtalk.send_message(
                 "🛑 交易机器人已停止",